@@ -0,0 +1,292 @@
+"""
+Benchmark the parts of CodeJail that every execution goes through.
+
+By default the code runs unconfined, as the current user, with this Python, so
+the benchmarks can be run anywhere::
+
+    python benchmark.py --output results.json
+
+Use --python and --user to benchmark a real sandbox instead.  The results are
+written as JSON, and the results of two runs (say, before and after an
+upgrade) can be compared::
+
+    python benchmark.py --compare old.json new.json
+
+"""
+
+import argparse
+import io
+import json
+import os
+import os.path
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import codejail
+from codejail import jail_code, proxy, safe_exec, subproc
+from codejail.staging import StagingCache
+
+# The benchmarks, in the order they run, added by the `benchmark` decorator.
+BENCHMARKS = []
+
+
+def benchmark(group):
+    """
+    Register a benchmark in `group`.
+
+    The decorated function takes the parsed command-line arguments, and
+    returns a list of cases: pairs of a name and a function of no arguments to
+    time.  It can also return a function to clean up after the cases have run.
+
+    """
+    def decorator(func):
+        BENCHMARKS.append((group, func))
+        return func
+    return decorator
+
+
+@benchmark("jail_code")
+def bench_jail_code(args):
+    """`jail_code` from start to finish, without and with the proxy."""
+    def run(proxy_count):
+        def run_one():
+            jail_code.set_limit("PROXY", proxy_count)
+            res = jail_code.jail_code("python", code="print('Hello')")
+            assert res.status == 0, res.stderr
+        return run_one
+
+    cases = [("no_proxy", run(0)), ("proxy", run(1))]
+    if args.python_files:
+        def run_with_files():
+            jail_code.set_limit("PROXY", 0)
+            res = jail_code.jail_code("python", code="pass", files=args.python_files)
+            assert res.status == 0, res.stderr
+        cases.append(("files", run_with_files))
+    return cases
+
+
+@benchmark("run_subprocess")
+def bench_run_subprocess(args):
+    """The cost of starting a process with `run_subprocess`."""
+    def run(cmd):
+        def run_one():
+            status, _, _, _ = subproc.run_subprocess(cmd, realtime=10)
+            assert status == 0
+        return run_one
+
+    return [
+        ("true", run(["/bin/true"])),
+        ("python", run([args.python, "-E", "-B", "-c", "pass"])),
+    ]
+
+
+def make_globals(shape, size):
+    """Make a dict of globals of `shape`, with about `size` values."""
+    if shape == "flat":
+        return {"v%d" % i: i for i in range(size)}
+    if shape == "strings":
+        return {"s%d" % i: "text ☃ " * 10 for i in range(size)}
+    if shape == "nested":
+        return {"data": [{"id": i, "tags": ["a", "b"], "pos": (i, i * 0.5)} for i in range(size // 4)]}
+    if shape == "bytes":
+        return {"b%d" % i: b"bytes" * 10 for i in range(size)}
+    raise ValueError(shape)
+
+
+@benchmark("json_safe")
+def bench_json_safe(args):  # pylint: disable=unused-argument
+    """`json_safe` over globals of different sizes and shapes."""
+    cases = []
+    for shape in ["flat", "strings", "nested", "bytes"]:
+        for size in [10, 1000, 100000]:
+            globs = make_globals(shape, size)
+            cases.append(("%s_%d" % (shape, size), lambda globs=globs: safe_exec.json_safe(globs)))
+    return cases
+
+
+@benchmark("proxy_protocol")
+def bench_proxy_protocol(args):  # pylint: disable=unused-argument
+    """Writing and reading a proxy message with small and large payloads."""
+    def round_trip(size):
+        header = {"kwargs": {"cmd": ["python", "jailed_code"], "cwd": "/tmp/codejail-x"}, "stdin": True}
+        blob = b"x" * size
+
+        def run_one():
+            stream = io.BytesIO()
+            proxy.write_message(stream, header, [blob])
+            stream.seek(0)
+            _, blobs = proxy.read_message(stream)
+            assert len(blobs[0]) == size
+        return run_one
+
+    return [("%d_bytes" % size, round_trip(size)) for size in [100, 100 * 1000, 10 * 1000 * 1000]]
+
+
+@benchmark("staging")
+def bench_staging(args):  # pylint: disable=unused-argument
+    """Putting `files` into an execution's directory, by copying and from the staging cache."""
+    root = tempfile.mkdtemp(prefix="codejail-bench-")
+    sources = {}
+
+    # One large file.
+    sources["file_10mb"] = os.path.join(root, "big.bin")
+    with open(sources["file_10mb"], "wb") as f:
+        f.write(os.urandom(10 * 1000 * 1000))
+
+    # Directories of many small files.
+    for count in [10, 1000]:
+        source = os.path.join(root, "dir%d" % count)
+        for i in range(count):
+            subdir = os.path.join(source, "pkg%d" % (i // 100))
+            os.makedirs(subdir, exist_ok=True)
+            with open(os.path.join(subdir, "module%d.py" % i), "w", encoding="utf-8") as f:
+                f.write("x = %d\n" % i * 50)
+        sources["dir_%d_files" % count] = source
+
+    cache = StagingCache(os.path.join(root, "cache"), max_size=1000 * 1000 * 1000)
+    counter = iter(range(sys.maxsize))
+
+    def stage(source, use_cache):
+        def run_one():
+            dest = os.path.join(root, "dest%d" % next(counter))
+            if use_cache:
+                cache.stage(source, dest)
+            elif os.path.isdir(source):
+                shutil.copytree(source, dest, symlinks=True)
+            else:
+                shutil.copy(source, dest)
+            if os.path.isdir(dest):
+                shutil.rmtree(dest)
+            else:
+                os.remove(dest)
+        return run_one
+
+    cases = []
+    for name, source in sources.items():
+        cases.append(("%s_copy" % name, stage(source, False)))
+        cases.append(("%s_cached" % name, stage(source, True)))
+    return cases, lambda: shutil.rmtree(root, ignore_errors=True)
+
+
+def time_case(func, repeat, min_time):
+    """
+    Time `func`.
+
+    It's called in batches big enough to take at least `min_time` seconds,
+    `repeat` times.  Returns the number of calls in a batch, and the seconds
+    per call of each batch.
+
+    """
+    func()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+
+    times = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return number, times
+
+
+def run_benchmarks(args):
+    """Run the selected benchmarks, and return the results as a dict."""
+    jail_code.configure("python", args.python, user=args.user)
+    for name, value in jail_code.DEFAULT_LIMITS.items():
+        jail_code.set_limit(name, value)
+    jail_code.set_limit("REALTIME", 10)
+
+    results = []
+    for group, func in BENCHMARKS:
+        if args.only and group not in args.only:
+            continue
+        cases = func(args)
+        cleanup = None
+        if isinstance(cases, tuple):
+            cases, cleanup = cases
+        try:
+            for name, case in cases:
+                number, times = time_case(case, args.repeat, args.min_time)
+                result = {
+                    "name": "%s.%s" % (group, name),
+                    "number": number,
+                    "times": times,
+                    "min": min(times),
+                    "median": statistics.median(times),
+                    "mean": statistics.mean(times),
+                }
+                print("%-40s %12.3f us" % (result["name"], result["median"] * 1e6), file=sys.stderr)
+                results.append(result)
+        finally:
+            if cleanup is not None:
+                cleanup()
+
+    return {
+        "codejail_version": codejail.__version__,
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "python": args.python,
+        "user": args.user,
+        "timestamp": time.time(),
+        "results": results,
+    }
+
+
+def compare(old_path, new_path):
+    """Print the change in the median time of each benchmark in two result files."""
+    with open(old_path, encoding="utf-8") as f:
+        old = {r["name"]: r for r in json.load(f)["results"]}
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)["results"]
+    for result in new:
+        before = old.get(result["name"])
+        if before is None:
+            continue
+        ratio = result["median"] / before["median"]
+        print("%-40s %12.3f us %12.3f us %8.2fx" % (
+            result["name"], before["median"] * 1e6, result["median"] * 1e6, ratio,
+        ))
+
+
+def main(argv=None):
+    # pylint: disable=missing-function-docstring
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--python", default=sys.executable, help="The Python to run jailed code with.")
+    parser.add_argument("--user", default=None, help="The user to run jailed code as, with sudo.")
+    parser.add_argument(
+        "--python-files", nargs="*", default=[],
+        help="Files to pass to jail_code in an extra jail_code benchmark.",
+    )
+    parser.add_argument("--only", nargs="*", help="The groups of benchmarks to run.")
+    parser.add_argument("--repeat", type=int, default=5, help="How many times to time each benchmark.")
+    parser.add_argument("--min-time", type=float, default=0.2, help="The least time for one timing, in seconds.")
+    parser.add_argument("--output", help="The file to write the results to, instead of stdout.")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files.")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
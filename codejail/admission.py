@@ -0,0 +1,136 @@
+"""
+Admission control: a limit on executions running at once on the host.
+
+When too many executions run at once, they fail for reasons that have nothing
+to do with the code they run: they reach the sandbox user's `RLIMIT_NPROC`,
+run out of memory, or reach their time limits while waiting for a CPU.  An
+`Admission` has a number of slots, each a lock file in a directory that all
+of the worker processes on the host share.  An execution holds a slot while
+it runs, and waits for one if they're all in use, up to a timeout, after which
+it fails with `Overloaded` instead of running.
+
+The slots are locked with `flock`, so a slot held by a process that dies is
+released by the kernel.
+
+"""
+
+import asyncio
+import fcntl
+import logging
+import os
+import os.path
+import random
+import tempfile
+import time
+
+from .util import make_private_directory
+
+log = logging.getLogger("codejail")
+
+# How long to wait before looking for a free slot again, at first, and at most.
+POLL_INTERVAL = 0.005
+MAX_POLL_INTERVAL = 0.1
+
+
+class Overloaded(Exception):
+    """
+    An execution couldn't start because the host was running too many others.
+    """
+
+
+class Admission:
+    """
+    A limit on the executions running at once, shared by the processes on a host.
+    """
+    def __init__(self, slots, timeout=10, directory=None):
+        """
+        Allow `slots` executions at once, waiting up to `timeout` seconds for one.
+
+        The lock files are in `directory`, which is created if it doesn't
+        exist, and is by default "codejail-admission" in the temp directory.
+        Every process sharing the limit must use the same directory and the
+        same number of slots.  Raises `PermissionError` unless the directory
+        is owned by this user with mode 0o700, so no one else can hold or
+        remove the slots.
+
+        """
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), "codejail-admission")
+        make_private_directory(directory)
+        self.directory = directory
+        self.slots = slots
+        self.timeout = timeout
+        # The number of executions that had to wait for a slot.
+        self.waits = 0
+        # The number of executions that failed with `Overloaded`.
+        self.rejections = 0
+
+    def _try_acquire(self):
+        """Lock a free slot, and return its file descriptor, or None if none are free."""
+        first = random.randrange(self.slots)
+        for i in range(self.slots):
+            path = os.path.join(self.directory, "slot-%d.lock" % ((first + i) % self.slots))
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            except BaseException:
+                os.close(fd)
+                raise
+            return fd
+        return None
+
+    def _overloaded(self, slug):
+        """The `Overloaded` error for an execution that waited too long."""
+        self.rejections += 1
+        log.warning(
+            "CodeJail overloaded: no slot free for %r after %.1f seconds (%d slots)",
+            slug, self.timeout, self.slots,
+        )
+        return Overloaded(
+            "Too many executions are running: none of the %d slots was free for %s seconds"
+            % (self.slots, self.timeout)
+        )
+
+    def acquire(self, slug=None):
+        """
+        Take a slot, waiting for one if none are free.
+
+        Returns the slot, which must be given to `release`.  Raises
+        `Overloaded` if no slot is free within the timeout.  `slug` is used
+        in log messages.
+
+        """
+        slot = self._try_acquire()
+        if slot is None:
+            self.waits += 1
+            deadline = time.monotonic() + self.timeout
+            interval = POLL_INTERVAL
+            while slot is None:
+                if time.monotonic() >= deadline:
+                    raise self._overloaded(slug)
+                time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+                slot = self._try_acquire()
+        return slot
+
+    async def async_acquire(self, slug=None):
+        """Like `acquire`, but waits for a slot without blocking the event loop."""
+        slot = self._try_acquire()
+        if slot is None:
+            self.waits += 1
+            deadline = time.monotonic() + self.timeout
+            interval = POLL_INTERVAL
+            while slot is None:
+                if time.monotonic() >= deadline:
+                    raise self._overloaded(slug)
+                await asyncio.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+                slot = self._try_acquire()
+        return slot
+
+    def release(self, slot):
+        """Free `slot`, from `acquire`."""
+        os.close(slot)
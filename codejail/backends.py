@@ -0,0 +1,314 @@
+"""
+Execution backends: where `jail_code` runs its executions.
+
+Normally `jail_code` runs executions on this host.  With a backend configured
+with `jail_code.configure_backend`, it hands them to the backend instead,
+after the quotas and scheduling of this process.  A backend is an object with
+a `run` method, like the subclasses of `Backend`.
+
+`RemoteBackend` sends executions to CodeJail execution servers (see
+`server.py`) on other hosts, so the capacity for running code can grow
+separately from the processes that ask for it.  It spreads the executions
+over the servers, sending each one to the server with the fewest executions
+outstanding from this process, keeps connections open for reuse, and moves on
+to another server if one can't be reached or is overloaded.  Once an
+execution has been sent, the server may have run it, so if anything goes wrong
+after that, `RemoteExecutionError` is raised instead of running it again
+elsewhere.
+
+The servers receive code from their clients and run it, so they must only be
+reachable from the hosts that are allowed to run code.
+
+"""
+
+import abc
+import io
+import logging
+import os.path
+import random
+import select
+import socket
+import tarfile
+import threading
+import time
+
+from .admission import Overloaded
+from .jail_code import JailResult
+from .proxy import ProxyProtocolError, read_message, write_message
+from .quotas import QuotaExceeded
+
+log = logging.getLogger("codejail")
+
+# The version of the protocol between `RemoteBackend` and the execution
+# server.  The server sends it in a hello message when a client connects.
+PROTOCOL_VERSION = 2
+
+# The limits of an execution that `RemoteBackend` sends to the server, which
+# apply them instead of its own.  The quotas and scheduling limits are applied
+# by each side for itself.
+SENT_LIMITS = ("CPU", "REALTIME", "VMEM", "FSIZE", "STDOUT", "STDERR", "NPROC", "MEMORY", "CPUS")
+
+
+class RemoteExecutionError(Exception):
+    """An execution server couldn't run an execution."""
+
+
+class Backend(abc.ABC):
+    """
+    The interface of execution backends.
+    """
+    # pylint: disable=too-many-positional-arguments
+    @abc.abstractmethod
+    def run(self, command, code, files, extra_files, argv, stdin, limit_overrides_context, limits, slug, timings):
+        """
+        Run an execution, and return its `JailResult`.
+
+        The arguments are as for `jail_code.jail_code`, except that `limits`
+        are the effective limits of the execution, and `timings` is the
+        `Timings` of the execution, for the result.
+
+        """
+
+
+def pack_files(paths):
+    """Pack the files and directories at `paths` into a tar archive, as bytes."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for path in paths:
+            tar.add(path, arcname=os.path.basename(path))
+    return buffer.getvalue()
+
+
+def unpack_files(data, directory):
+    """
+    Unpack a tar archive from `pack_files` into `directory`.
+
+    Returns the paths of the files and directories that were packed.
+
+    """
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        names = [member.name for member in tar.getmembers() if "/" not in member.name]
+        tar.extractall(directory, filter="tar")
+    return [os.path.join(directory, name) for name in names]
+
+
+class _Connection:
+    """A connection to an execution server."""
+    def __init__(self, address, timeout, connect_timeout):
+        self.sock = socket.create_connection(address, timeout=connect_timeout)
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock.settimeout(timeout)
+            self.stream = self.sock.makefile("rwb")
+            hello = read_message(self.stream)
+            if hello is None or hello[0].get("protocol") != PROTOCOL_VERSION:
+                raise ProxyProtocolError("Execution server at %s:%s sent a bad hello: %r" % (address + (hello,)))
+        except BaseException:
+            self.sock.close()
+            raise
+
+    def dropped(self):
+        """Has the server closed this idle connection?"""
+        # An idle connection has nothing to read, unless it has been closed.
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        return bool(readable)
+
+    def request(self, header, blobs):
+        """Send a request, and return the response's header and blobs."""
+        write_message(self.stream, header, blobs)
+        response = read_message(self.stream)
+        if response is None:
+            raise EOFError("Execution server closed the connection")
+        return response
+
+    def close(self):
+        """Close the connection."""
+        self.stream.close()
+        self.sock.close()
+
+
+class _Endpoint:
+    """An execution server, and the idle connections to it."""
+    def __init__(self, address, pool_size, timeout, connect_timeout):
+        self.address = address
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        # The number of requests sent and not yet answered.
+        self.outstanding = 0
+        # The `time.monotonic` time until which the server isn't used, after
+        # it couldn't be reached.
+        self.down_until = 0
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def __repr__(self):
+        return "<Endpoint %s:%s>" % self.address
+
+    def _take_idle(self):
+        """Take an idle connection that the server hasn't closed, or return None."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn = self._idle.pop()
+            if not conn.dropped():
+                return conn
+            conn.close()
+
+    def request(self, header, blobs):
+        """
+        Send a request on an idle connection, or a new one.
+
+        Errors connecting to the server are raised as they are, and the
+        request can be sent to another server.  Once the request has been
+        sent, the server may have run it, so any error after that raises
+        `RemoteExecutionError`.
+
+        """
+        with self._lock:
+            self.outstanding += 1
+        conn = None
+        try:
+            conn = self._take_idle()
+            if conn is None:
+                conn = _Connection(self.address, self.timeout, self.connect_timeout)
+            try:
+                response = conn.request(header, blobs)
+            except (OSError, EOFError, ProxyProtocolError) as exc:
+                raise RemoteExecutionError(
+                    "Execution server %s:%s failed once the execution was sent: %s" % (self.address + (exc,))
+                ) from exc
+        except BaseException:
+            if conn is not None:
+                conn.close()
+            raise
+        finally:
+            with self._lock:
+                self.outstanding -= 1
+
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+        return response
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def _parse_address(endpoint):
+    """Make an address tuple of `endpoint`, a "host:port" string or a (host, port) pair."""
+    if isinstance(endpoint, str):
+        host, _, port = endpoint.rpartition(":")
+        return (host.strip("[]"), int(port))
+    host, port = endpoint
+    return (host, int(port))
+
+
+class RemoteBackend(Backend):
+    """
+    A backend running executions on execution servers.
+    """
+    # pylint: disable=too-many-positional-arguments
+    def __init__(self, endpoints, pool_size=4, timeout=60, connect_timeout=1, retry_after=10):
+        """
+        Use the execution servers at `endpoints`.
+
+        `endpoints` is a list of "host:port" strings or (host, port) pairs.
+        `pool_size` is the number of idle connections to keep to each server.
+        `timeout` is the most seconds to wait for a server to answer, and
+        `connect_timeout` the most to wait to connect to one.  A server that
+        can't be reached isn't used for `retry_after` seconds, unless no other
+        server can be.  If a server doesn't answer in time once an execution
+        has been sent to it, `RemoteExecutionError` is raised, since the
+        execution may have run.
+
+        """
+        if not endpoints:
+            raise ValueError("RemoteBackend needs at least one endpoint")
+        self.endpoints = [
+            _Endpoint(_parse_address(endpoint), pool_size, timeout, connect_timeout)
+            for endpoint in endpoints
+        ]
+        self.retry_after = retry_after
+
+    def _choose(self, tried):
+        """
+        Choose the server for a request, among those not in `tried`.
+
+        Servers that are up are chosen before servers that are down, and
+        among them, one with the fewest outstanding requests, at random.
+
+        """
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in tried]
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in candidates if endpoint.down_until <= now] or candidates
+        fewest = min(endpoint.outstanding for endpoint in candidates)
+        return random.choice([endpoint for endpoint in candidates if endpoint.outstanding == fewest])
+
+    # pylint: disable=too-many-positional-arguments
+    def run(self, command, code, files, extra_files, argv, stdin, limit_overrides_context, limits, slug, timings):
+        if isinstance(stdin, str):
+            stdin = stdin.encode("utf-8")
+        extra_files = list(extra_files or ())
+        header = {
+            "command": command,
+            "code": code,
+            "argv": argv,
+            "files": bool(files),
+            "stdin": stdin is not None,
+            "extra_files": [name for name, _ in extra_files],
+            "limit_overrides_context": limit_overrides_context,
+            "limits": {name: limits[name] for name in SENT_LIMITS},
+            "slug": slug,
+        }
+        blobs = [pack_files(files or ()), stdin or b""] + [content for _, content in extra_files]
+
+        tried = []
+        overloaded = None
+        last_error = None
+        while len(tried) < len(self.endpoints):
+            endpoint = self._choose(tried)
+            tried.append(endpoint)
+            try:
+                response, response_blobs = endpoint.request(header, blobs)
+            except (OSError, EOFError, ProxyProtocolError) as exc:
+                # The execution wasn't sent, so it can be sent elsewhere.
+                log.warning("Couldn't reach execution server %s:%s for %r: %s", *endpoint.address, slug, exc)
+                endpoint.down_until = time.monotonic() + self.retry_after
+                last_error = exc
+                continue
+
+            error = response.get("error")
+            if error == "overloaded":
+                overloaded = response["message"]
+                continue
+            if error == "quota":
+                raise QuotaExceeded(response["message"])
+            if error is not None:
+                raise RemoteExecutionError(response["message"])
+
+            result = JailResult()
+            result.status = response["status"]
+            result.stdout, result.stderr = response_blobs
+            result.stdout_truncated = response["stdout_truncated"]
+            result.stderr_truncated = response["stderr_truncated"]
+            result.rusage = response["rusage"]
+            result.timings = timings
+            return result
+
+        if overloaded is not None:
+            raise Overloaded(overloaded)
+        raise RemoteExecutionError("No execution server could run %r" % (slug,)) from last_error
+
+    def close(self):
+        """Close the idle connections to the servers."""
+        for endpoint in self.endpoints:
+            endpoint.close()
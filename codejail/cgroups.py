@@ -0,0 +1,142 @@
+"""
+Control groups (cgroup v2) for jailed processes.
+
+Resource limits set with `setrlimit` are per process, or in the case of
+`RLIMIT_NPROC`, per user across the whole host, so concurrent executions share
+one limit on processes, and memory can only be limited by address space.  With
+cgroups, each execution gets a cgroup of its own, in which the kernel limits
+the number of processes (`pids.max`), the memory actually used
+(`memory.max`), and the CPU bandwidth (`cpu.max`) of that execution alone.
+All of its processes can be killed at once with `cgroup.kill`.
+
+The cgroups are made in a root cgroup that the CodeJail process can write to,
+such as one delegated to it by systemd.  The CodeJail process must be in the
+root's subtree, but not in the root itself, since a cgroup with controllers
+enabled for its children can't have processes of its own.
+
+"""
+
+import errno
+import logging
+import os
+import os.path
+import secrets
+import time
+
+log = logging.getLogger("codejail")
+
+# The controllers CodeJail uses, if they're available.
+CONTROLLERS = ("cpu", "memory", "pids")
+
+# The period for the "cpu.max" bandwidth limit, in microseconds.
+CPU_PERIOD = 100000
+
+# How long to wait for the processes in a cgroup to end after killing them.
+REMOVE_TIMEOUT = 5
+
+
+def _write(path, value):
+    """Write `value` to the cgroup interface file `path`."""
+    with open(path, "w", encoding="ascii") as f:
+        f.write(value)
+
+
+class CgroupRoot:
+    """
+    The cgroup in which the cgroups of executions are made.
+    """
+    def __init__(self, path):
+        """
+        Use the cgroup at `path`, a directory in the cgroup v2 filesystem.
+
+        The controllers in `CONTROLLERS` that are available are enabled for
+        its children.
+
+        """
+        self.path = path
+        with open(os.path.join(path, "cgroup.controllers"), encoding="ascii") as f:
+            available = set(f.read().split())
+        self.controllers = {controller for controller in CONTROLLERS if controller in available}
+        if self.controllers:
+            _write(
+                os.path.join(path, "cgroup.subtree_control"),
+                " ".join("+" + controller for controller in sorted(self.controllers)),
+            )
+        missing = set(CONTROLLERS) - self.controllers
+        if missing:
+            log.warning("CodeJail cgroup %s doesn't have controllers %s", path, ", ".join(sorted(missing)))
+
+    def create(self, pids=0, memory=0, cpus=0):
+        """
+        Make a cgroup for an execution, and return it as a `Cgroup`.
+
+        `pids` is the most processes and threads, `memory` is the most bytes
+        of memory, and `cpus` is how many CPUs' worth of time (which can be a
+        fraction) the execution can use.  0 means no limit.  Limits whose
+        controller isn't available aren't set.
+
+        """
+        cgroup = Cgroup(os.path.join(self.path, "codejail-" + secrets.token_hex(8)), self.controllers)
+        os.mkdir(cgroup.path)
+        try:
+            if pids and "pids" in self.controllers:
+                _write(os.path.join(cgroup.path, "pids.max"), str(pids))
+            if memory and "memory" in self.controllers:
+                _write(os.path.join(cgroup.path, "memory.max"), str(memory))
+                # Memory beyond the limit mustn't be swapped out instead.
+                swap_max = os.path.join(cgroup.path, "memory.swap.max")
+                if os.path.exists(swap_max):
+                    _write(swap_max, "0")
+            if cpus and "cpu" in self.controllers:
+                _write(os.path.join(cgroup.path, "cpu.max"), "%d %d" % (cpus * CPU_PERIOD, CPU_PERIOD))
+        except BaseException:
+            cgroup.remove()
+            raise
+        return cgroup
+
+
+class Cgroup:
+    """
+    The cgroup of one execution.
+    """
+    def __init__(self, path, controllers):
+        """`path` is the directory of the cgroup, with `controllers` enabled."""
+        self.path = path
+        self.controllers = controllers
+
+    @property
+    def procs_path(self):
+        """The file to write a process id (or 0, for the writer) to, to move it here."""
+        return os.path.join(self.path, "cgroup.procs")
+
+    def kill(self):
+        """Kill every process in the cgroup."""
+        _write(os.path.join(self.path, "cgroup.kill"), "1")
+
+    def remove(self):
+        """
+        Kill anything still running in the cgroup, and remove it.
+
+        Processes take a moment to end once they're killed, and the cgroup
+        can't be removed until they have, so this waits up to
+        `REMOVE_TIMEOUT` seconds for them.
+
+        """
+        if not os.path.isdir(self.path):
+            return
+        try:
+            with open(self.procs_path, encoding="ascii") as f:
+                running = bool(f.read().strip())
+        except FileNotFoundError:
+            running = False
+        if running:
+            self.kill()
+        deadline = time.monotonic() + REMOVE_TIMEOUT
+        while True:
+            try:
+                os.rmdir(self.path)
+                return
+            except OSError as exc:
+                if exc.errno != errno.EBUSY or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
@@ -0,0 +1,129 @@
+"""
+Background cleanup of the directories `jail_code` makes for executions.
+
+Each execution has a home directory, with a "tmp" directory that the sandbox
+user can write to.  Cleaning up takes a process running as the sandbox user to
+remove what it wrote, and then removing the rest of the home directory.  A
+`CleanupReaper` does that in a background thread, so the caller gets its
+result without waiting.  Directories handed to the reaper are cleaned in
+batches, with one sandbox-user process for each batch.
+
+"""
+
+import logging
+import os
+import queue
+import shutil
+import threading
+
+log = logging.getLogger("codejail")
+
+
+class CleanupReaper:
+    """
+    Removes execution directories in a background thread.
+    """
+    def __init__(self, max_backlog=1000, batch_size=50):
+        """
+        `max_backlog` is the most directories waiting to be cleaned.  If there
+        are more, the caller cleans up its own directory, rather than letting
+        the backlog grow.  `batch_size` is the most directories to clean with
+        one process.
+
+        """
+        self.max_backlog = max_backlog
+        self.batch_size = batch_size
+        # The number of directories that couldn't be cleaned completely.
+        self.failures = 0
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """Start with no thread and an empty backlog."""
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(self.max_backlog)
+        self._thread = None
+
+    # pylint: disable=too-many-positional-arguments
+    def submit(self, homedir, tmpdir, user_cmd, run_subprocess_fn, remove_fn=shutil.rmtree, clean_fn=None):
+        """
+        Clean up an execution's directory.
+
+        `homedir` is the home directory to remove, and `tmpdir` is the
+        directory within it that the sandbox user could write to.  `user_cmd`
+        is the start of the command line to run a command as the sandbox user,
+        and `run_subprocess_fn` is the function to run it with.  `remove_fn`
+        is called with `homedir` to remove it, once `tmpdir` is empty, such as
+        `HomedirPool.release` for a directory from a pool.  `clean_fn`, if
+        given, is called with a list of `tmpdir`s to empty them without a
+        sandbox-user process, such as a `zygote.zygote_cleaner`; if it returns
+        false, the process is run after all.
+
+        """
+        item = (homedir, tmpdir, tuple(user_cmd), run_subprocess_fn, remove_fn, clean_fn)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="codejail-cleanup", daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            log.warning("CodeJail cleanup backlog is full, cleaning %s now", homedir)
+            self._clean([item])
+
+    def flush(self):
+        """Wait until every directory submitted so far has been cleaned."""
+        self._queue.join()
+
+    def _run(self):
+        """The cleanup thread."""
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._clean(batch)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("CodeJail cleanup failed")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _clean(self, batch):
+        """Clean up a list of submitted directories."""
+        groups = {}
+        for homedir, tmpdir, user_cmd, run_subprocess_fn, remove_fn, clean_fn in batch:
+            groups.setdefault((user_cmd, run_subprocess_fn, clean_fn), []).append((homedir, tmpdir, remove_fn))
+
+        for (user_cmd, run_subprocess_fn, clean_fn), dirs in groups.items():
+            self._clean_tmpdirs([tmpdir for _, tmpdir, _ in dirs], user_cmd, run_subprocess_fn, clean_fn)
+            for homedir, _, remove_fn in dirs:
+                try:
+                    remove_fn(homedir)
+                except OSError:
+                    log.exception("Couldn't remove CodeJail directory %s", homedir)
+                    with self._lock:
+                        self.failures += 1
+
+    def _clean_tmpdirs(self, tmpdirs, user_cmd, run_subprocess_fn, clean_fn):
+        """Remove the contents of the `tmpdirs`, as submitted."""
+        if clean_fn is not None and clean_fn(tmpdirs):
+            return
+        # Remove the contents of the tmp directories as the sandbox user,
+        # since the sandbox user may have written files that we can't delete.
+        rm_cmd = list(user_cmd) + ['/usr/bin/find']
+        rm_cmd.extend(tmpdirs)
+        rm_cmd.extend(['-mindepth', '1', '-maxdepth', '1', '-exec', 'rm', '-rf', '{}', '+'])
+        try:
+            status, _, stderr, _ = run_subprocess_fn(rm_cmd)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Couldn't clean up %d CodeJail directories", len(tmpdirs))
+        else:
+            if status != 0:
+                log.error(
+                    "Couldn't clean up %d CodeJail directories, status %r: %r",
+                    len(tmpdirs), status, stderr,
+                )
@@ -4,17 +4,51 @@ Utility functions to support Django integration for codejail.
 Split out from `django_integration` to allow testing without installing Django.
 """
 
-from . import jail_code
+from . import jail_code, safe_exec
+from .backends import RemoteBackend
 
 
 def apply_django_settings(code_jail_settings):
     """
-    Apply a settings.CODE_JAIL dictionary to the `jail_code` module.
+    Apply a settings.CODE_JAIL dictionary to the `jail_code` and `safe_exec` modules.
     """
     python_bin = code_jail_settings.get('python_bin')
     if python_bin:
         user = code_jail_settings['user']
         jail_code.configure("python", python_bin, user=user)
+    zygote = code_jail_settings.get('zygote')
+    if zygote is not None:
+        jail_code.configure_zygote("python", **zygote)
+    staging_cache = code_jail_settings.get('staging_cache')
+    if staging_cache is not None:
+        jail_code.configure_staging_cache(**staging_cache)
+    background_cleanup = code_jail_settings.get('background_cleanup')
+    if background_cleanup is not None:
+        jail_code.configure_background_cleanup(**background_cleanup)
+    homedir_pool = code_jail_settings.get('homedir_pool')
+    if homedir_pool is not None:
+        jail_code.configure_homedir_pool(**homedir_pool)
+    prlimit = code_jail_settings.get('prlimit')
+    if prlimit:
+        jail_code.configure_prlimit(None if prlimit is True else prlimit)
+    remote_backend = code_jail_settings.get('remote_backend')
+    if remote_backend is not None:
+        jail_code.configure_backend(RemoteBackend(**remote_backend))
+    quotas = code_jail_settings.get('quotas')
+    if quotas is not None:
+        jail_code.configure_quotas(**quotas)
+    scheduler = code_jail_settings.get('scheduler')
+    if scheduler is not None:
+        jail_code.configure_scheduler(**scheduler)
+    admission = code_jail_settings.get('admission')
+    if admission is not None:
+        jail_code.configure_admission(**admission)
+    cgroups = code_jail_settings.get('cgroups')
+    if cgroups is not None:
+        jail_code.configure_cgroups(**cgroups)
+    json_codec = code_jail_settings.get('json_codec')
+    if json_codec is not None:
+        safe_exec.configure_json_codec(json_codec)
     limits = code_jail_settings.get('limits', {})
     for name, value in limits.items():
         jail_code.set_limit(
@@ -0,0 +1,66 @@
+"""
+A `concurrent.futures` executor for running jailed code in parallel.
+
+Use it like any other executor::
+
+    from codejail.executor import JailExecutor
+    from codejail.safe_exec import safe_exec
+
+    with JailExecutor() as executor:
+        futures = [executor.submit(safe_exec, code, globals_dict) for ...]
+
+Each future resolves to whatever the submitted function returns (a
+`JailResult` for `jail_code`), or raises what it raised (such as
+`SafeExecException` for `safe_exec`).
+
+"""
+
+import concurrent.futures
+import os
+
+from . import jail_code
+
+
+def default_max_workers(limit_overrides_context=None):
+    """
+    The number of executions a `JailExecutor` runs at once, by default.
+
+    This is the number of CPUs, but no more than the NPROC limit, since each
+    execution needs at least one process as the sandbox user, and no more than
+    the number of proxy processes, if they are in use, since each execution
+    needs a proxy to itself.
+
+    `limit_overrides_context` is as for `jail_code`.
+
+    """
+    limits = jail_code.get_effective_limits(limit_overrides_context)
+    max_workers = os.cpu_count() or 1
+    if limits["NPROC"]:
+        max_workers = min(max_workers, limits["NPROC"])
+    proxy_count = jail_code.get_proxy_count(limits)
+    if proxy_count:
+        max_workers = min(max_workers, proxy_count)
+    return max(max_workers, 1)
+
+
+class JailExecutor(concurrent.futures.ThreadPoolExecutor):
+    """
+    An executor for running `jail_code` or `safe_exec` calls in parallel.
+
+    Each call runs in a worker thread, and waits for its jailed process there.
+    The number of calls running at once is limited so that they don't exceed
+    the configured limits: see `default_max_workers`.
+
+    """
+    def __init__(self, max_workers=None, limit_overrides_context=None):
+        """
+        Create an executor.
+
+        `max_workers` is the most calls to run at once.  If None, it is
+        computed from the limits in `limit_overrides_context` by
+        `default_max_workers`.
+
+        """
+        if max_workers is None:
+            max_workers = default_max_workers(limit_overrides_context)
+        super().__init__(max_workers=max_workers, thread_name_prefix="codejail")
@@ -0,0 +1,199 @@
+"""
+Home directories for `jail_code` executions, made ahead of time.
+
+Each execution needs a home directory that the sandbox user can read, with a
+"tmp" directory in it that the sandbox user can write to.  Making one takes a
+`mkdtemp`, a `mkdir`, and two `chmod` calls before anything is written into
+it.  A `HomedirPool` makes them in a background thread, so an execution only
+has to take one that's ready.  The pool's directories can be under a root of
+their own, such as a tmpfs mount, to keep the sandbox's scratch files off
+slower disks.  The root can't be listed by the sandbox user, so an execution
+can't find the directories of the others.
+
+"""
+
+import collections
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+
+log = logging.getLogger("codejail")
+
+
+def make_homedir(root=None):
+    """
+    Make a home directory for an execution in `root`, or the temp directory.
+
+    Returns the path of the directory.
+
+    """
+    homedir = tempfile.mkdtemp(prefix="codejail-", dir=root)
+    try:
+        # Make directory readable by other users ('sandbox' user needs to be
+        # able to read it).
+        os.chmod(homedir, 0o775)
+
+        # Make a subdir to use for temp files, world-writable so that the
+        # sandbox user can write to it.
+        tmptmp = os.path.join(homedir, "tmp")
+        os.mkdir(tmptmp)
+        os.chmod(tmptmp, 0o777)
+    except BaseException:
+        shutil.rmtree(homedir, ignore_errors=True)
+        raise
+    return homedir
+
+
+class HomedirPool:
+    """
+    A supply of home directories, replenished in a background thread.
+    """
+    def __init__(self, root=None, size=10, capacity=None):
+        """
+        Keep `size` home directories ready in the directory `root`.
+
+        By default the directories are made in the temp directory, each a
+        "codejail-*" directory of its own, as without a pool.  Otherwise
+        `root` is created if it doesn't exist, and its mode is set to 0o711,
+        so the sandbox user can reach the directories in it, but not list
+        them.
+
+        `capacity` is the most bytes an execution is expected to write in its
+        directory.  If it's given, the number of directories in use at once
+        is limited to the space free in the filesystem of `root` when the pool
+        starts, divided by `capacity`.  Beyond that, directories are made in the temp directory
+        instead, so a full tmpfs doesn't fail executions.
+
+        """
+        if root is None:
+            self.root = os.path.abspath(tempfile.gettempdir())
+        else:
+            self.root = os.path.abspath(root)
+            os.makedirs(self.root, mode=0o711, exist_ok=True)
+            os.chmod(self.root, 0o711)
+        self.size = size
+        self.capacity = capacity
+        self.max_in_use = None
+        if capacity:
+            stat = os.statvfs(self.root)
+            # Only the space that's free can be used, not what's already
+            # taken by other files or reserved for root.
+            self.max_in_use = stat.f_bavail * stat.f_frsize // capacity
+        # The number of directories made when one was needed, because none
+        # were ready.
+        self.misses = 0
+        # The number of directories made in the temp directory, because
+        # `root` had no capacity left.
+        self.overflows = 0
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+        self._start()
+
+    def _reset(self):
+        """Start with no thread and no directories."""
+        self._lock = threading.Lock()
+        self._wanted = threading.Event()
+        self._ready = collections.deque()
+        self._in_use = 0
+        # The directories taken from `root`, which may also be where the
+        # overflowing ones are made.
+        self._in_root = set()
+        self._thread = None
+
+    def _start(self):
+        """Start the thread making directories, if it isn't running."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="codejail-homedirs", daemon=True)
+                self._thread.start()
+        self._wanted.set()
+
+    @property
+    def in_use(self):
+        """The number of directories in `root` taken and not yet released."""
+        return self._in_use
+
+    def take(self):
+        """
+        Get a home directory for an execution.
+
+        The directory must be given to `release` when the execution is done.
+
+        """
+        self._start()
+        homedir = None
+        with self._lock:
+            in_root = self.max_in_use is None or self._in_use < self.max_in_use
+            if not in_root:
+                self.overflows += 1
+            elif self._ready:
+                homedir = self._ready.popleft()
+                self._in_root.add(homedir)
+            else:
+                self.misses += 1
+            if in_root:
+                self._in_use += 1
+
+        if homedir is None:
+            try:
+                homedir = make_homedir(self.root if in_root else None)
+            except BaseException:
+                if in_root:
+                    with self._lock:
+                        self._in_use -= 1
+                raise
+            if in_root:
+                with self._lock:
+                    self._in_root.add(homedir)
+        return homedir
+
+    def release(self, homedir):
+        """
+        Remove `homedir`, a directory from `take`.
+
+        The sandbox user's files must already have been removed from its
+        "tmp" directory.
+
+        """
+        try:
+            # If this errors, something is genuinely wrong, so don't ignore errors.
+            shutil.rmtree(homedir)
+        finally:
+            with self._lock:
+                if homedir in self._in_root:
+                    self._in_root.remove(homedir)
+                    self._in_use -= 1
+
+    def close(self):
+        """Stop making directories, and remove the ones that are ready."""
+        with self._lock:
+            self.size = 0
+            ready, self._ready = self._ready, collections.deque()
+        for homedir in ready:
+            shutil.rmtree(homedir, ignore_errors=True)
+
+    def _run(self):
+        """The thread making directories."""
+        while True:
+            self._wanted.wait()
+            self._wanted.clear()
+            while True:
+                with self._lock:
+                    if len(self._ready) >= self.size:
+                        break
+                try:
+                    homedir = make_homedir(self.root)
+                except OSError:
+                    # Try again when another directory is taken.
+                    log.exception("Couldn't make a CodeJail home directory in %s", self.root)
+                    break
+                with self._lock:
+                    keep = len(self._ready) < self.size
+                    if keep:
+                        self._ready.append(homedir)
+                if not keep:
+                    # The pool was closed while the directory was made.
+                    shutil.rmtree(homedir, ignore_errors=True)
@@ -0,0 +1,171 @@
+"""
+Timings of the phases of executions, and hooks to report them.
+
+Every `jail_code` and `safe_exec` execution records when each of its phases
+started and ended, with `time.monotonic`, in a `Timings` object.  For
+`jail_code`, the phases are:
+
+* "admission": waiting for a slot, if `jail_code.configure_scheduler` or
+  `jail_code.configure_admission` was used.
+* "stage": making the execution's directory and copying the files into it.
+* "execute": running the process, including any time spent talking to a proxy
+  process or a zygote.
+* "spawn": starting the process, including `sudo`.
+* "run": running the code and collecting its output, until it ends.
+* "cleanup": removing the execution's directory, or handing it to the
+  background cleanup.
+* "jail_code": all of the above.
+
+`safe_exec` records the phases of its `jail_code` execution, and:
+
+* "encode": preparing the globals and the program to run.
+* "cache": looking up the result in the result cache, if one is used.
+* "decode": updating the globals from the result.
+* "safe_exec": all of the above.
+
+The timings of a `jail_code` execution are its result's `timings` attribute.
+To collect the timings of all executions, register hooks, which are called
+before and after each execution with an `ExecutionInfo`::
+
+    def report(info):
+        for phase, seconds in info.timings.durations().items():
+            metrics.timing("codejail." + phase, seconds)
+
+    instrumentation.add_post_execution_hook(report)
+
+Hooks are called in the thread (or coroutine) running the execution, so they
+should be quick.  Exceptions they raise are logged, and otherwise ignored.
+
+"""
+
+import contextlib
+import logging
+import time
+
+log = logging.getLogger("codejail")
+
+
+class Timings:
+    """
+    The start and end times of the phases of an execution.
+    """
+    def __init__(self):
+        # A map from phase names to (start, end) pairs of `time.monotonic` times.
+        self.phases = {}
+
+    def __repr__(self):
+        return "<Timings %s>" % ", ".join(
+            "%s=%.6f" % (name, seconds) for name, seconds in self.durations().items()
+        )
+
+    def add(self, phase, start, end):
+        """
+        Record that `phase` ran from `start` to `end`.
+
+        If `phase` was already recorded, it's extended to cover both times.
+
+        """
+        if phase in self.phases:
+            old_start, old_end = self.phases[phase]
+            start, end = min(start, old_start), max(end, old_end)
+        self.phases[phase] = (start, end)
+
+    def add_all(self, phases):
+        """Record all of `phases`, a map from phase names to (start, end) pairs."""
+        for phase, (start, end) in phases.items():
+            self.add(phase, start, end)
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        """A context manager to record the time its body takes as `phase`."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(phase, start, time.monotonic())
+
+    def durations(self):
+        """A map from phase names to how many seconds they took."""
+        return {phase: end - start for phase, (start, end) in self.phases.items()}
+
+
+class ExecutionInfo:
+    """
+    What execution hooks are told about an execution.
+
+    `kind` is "jail_code" or "safe_exec".  `command`, `slug`, and
+    `limit_overrides_context` are as given to `jail_code` or `safe_exec`.
+    `timings` is a `Timings`.  After the execution, `result` is the
+    `jail_code` result, if there is one, and `error` is the exception that
+    ended the execution, if any.
+
+    For a profiled `safe_exec` execution, `profile` is the profile of the
+    code, or None if it couldn't be collected: a list of dicts, one for each
+    of the functions that took the most time, in order, with "function",
+    "calls", "primitive_calls", "total_time" (seconds in the function
+    itself), and "cumulative_time" (seconds including what it called).
+
+    """
+    def __init__(self, kind, command, slug, limit_overrides_context):
+        self.kind = kind
+        self.command = command
+        self.slug = slug
+        self.limit_overrides_context = limit_overrides_context
+        self.timings = Timings()
+        self.result = None
+        self.error = None
+        self.profile = None
+
+
+# The functions to call with an `ExecutionInfo` before and after each
+# execution.
+PRE_EXECUTION_HOOKS = []
+POST_EXECUTION_HOOKS = []
+
+
+def add_pre_execution_hook(hook):
+    """Call `hook` with an `ExecutionInfo` before each execution."""
+    PRE_EXECUTION_HOOKS.append(hook)
+
+
+def add_post_execution_hook(hook):
+    """Call `hook` with an `ExecutionInfo` after each execution."""
+    POST_EXECUTION_HOOKS.append(hook)
+
+
+def remove_execution_hook(hook):
+    """Stop calling `hook`, whether before or after executions."""
+    for hooks in (PRE_EXECUTION_HOOKS, POST_EXECUTION_HOOKS):
+        while hook in hooks:
+            hooks.remove(hook)
+
+
+def _call_hooks(hooks, info):
+    """Call each of `hooks` with `info`, logging any exceptions."""
+    for hook in list(hooks):
+        try:
+            hook(info)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("CodeJail execution hook %r failed", hook)
+
+
+@contextlib.contextmanager
+def instrument(kind, command, slug=None, limit_overrides_context=None):
+    """
+    A context manager to time an execution and call the hooks around it.
+
+    The arguments are as for `ExecutionInfo`.  Yields the `ExecutionInfo`,
+    whose `result` the body should set.  The whole body is timed as the phase
+    named `kind`.
+
+    """
+    info = ExecutionInfo(kind, command, slug, limit_overrides_context)
+    _call_hooks(PRE_EXECUTION_HOOKS, info)
+    try:
+        with info.timings.phase(kind):
+            yield info
+    except BaseException as exc:
+        info.error = exc
+        raise
+    finally:
+        _call_hooks(POST_EXECUTION_HOOKS, info)
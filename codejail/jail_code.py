@@ -1,20 +1,33 @@
 """Run code in a jail."""
 
+import asyncio
+import atexit
+import contextlib
+import functools
 import logging
 import os
 import os.path
 import resource
 import shutil
 import sys
-
-from .proxy import run_subprocess_through_proxy
-from .subproc import run_subprocess
-from .util import temp_directory
+import tempfile
+import time
+
+from . import subproc
+from .admission import Admission
+from .cgroups import CgroupRoot
+from .cleanup import CleanupReaper
+from .homedirs import HomedirPool, make_homedir
+from .instrumentation import Timings, instrument
+from .proxy import PROXY_POOL, run_subprocess_through_proxy
+from .quotas import Quotas
+from .scheduler import Scheduler
+from .staging import StagingCache
+from .subproc import Cancellation, async_run_subprocess, run_subprocess
+from .zygote import run_subprocess_through_zygote, zygote_cleaner
 
 log = logging.getLogger("codejail")
 
-# TODO: limit too much stdout data?  # pylint: disable=fixme
-
 # Configure the commands
 
 # COMMANDS is a map from an abstract command name to a list of command-line
@@ -47,6 +60,234 @@ def configure(command, bin_path, user=None):
     }
 
 
+# PRELOAD_MODULES is a map from an abstract command name to the list of modules
+# its zygote imports, for the commands that run through a zygote.
+PRELOAD_MODULES = {}
+
+
+def configure_zygote(command, preload_modules=()):
+    """
+    Configure `jail_code` to run `command` through a zygote.
+
+    A zygote is a long-lived "fork server" process, running the command as its
+    configured user, that imports `preload_modules` (a list of module names)
+    once.  Each execution is then forked from the zygote instead of starting a
+    new interpreter, though it still gets its own resource limits, home
+    directory, and process group, and is confined just as an ordinary
+    execution would be.
+
+    Only Python commands can run through a zygote, and `command` must already
+    have been configured with `configure`.
+
+    Modules that start threads or open files when imported might not work
+    correctly in the forked processes.  For example, set OPENBLAS_NUM_THREADS
+    to 1 before preloading numpy.
+
+    """
+    PRELOAD_MODULES[command] = list(preload_modules)
+
+
+# The cache of files to copy into the sandbox, if there is one.
+STAGING_CACHE = None
+
+
+def configure_staging_cache(max_size, cache_dir=None):
+    """
+    Configure `jail_code` to use a cache of the `files` it copies.
+
+    Each distinct file or directory in `files` is then copied once into the
+    cache, made read-only, and hard-linked into the directory of each
+    execution that uses it, instead of being copied every time.  Entries are
+    keyed by the `stat` details of the source, so changed files are copied
+    again.
+
+    `max_size` is the most bytes to keep in the cache: the least recently used
+    entries are removed to stay under it.  `cache_dir` is the directory to use,
+    by default "codejail-staging" in the temp directory.  It must be on the
+    same filesystem as the temp directory, and if it exists, it must be owned
+    by this user with mode 0o700, or files are copied without the cache.
+
+    """
+    global STAGING_CACHE  # pylint: disable=global-statement
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), "codejail-staging")
+    STAGING_CACHE = StagingCache(cache_dir, max_size)
+
+
+# The background cleanup of execution directories, if there is one.
+CLEANUP_REAPER = None
+
+
+def configure_background_cleanup(max_backlog=1000, batch_size=50):
+    """
+    Configure `jail_code` to clean up after executions in the background.
+
+    Normally `jail_code` removes an execution's directory before it returns,
+    which takes another process run as the sandbox user.  With background
+    cleanup, the directories are handed to a thread that removes them in
+    batches of up to `batch_size`, with one sandbox-user process for each
+    batch.  If `max_backlog` directories are already waiting, the caller
+    cleans up its own directory instead.
+
+    """
+    global CLEANUP_REAPER  # pylint: disable=global-statement
+    CLEANUP_REAPER = CleanupReaper(max_backlog=max_backlog, batch_size=batch_size)
+    atexit.register(CLEANUP_REAPER.flush)
+
+
+def configure_prlimit(path=None):
+    """
+    Configure `jail_code` to start processes with `prlimit`.
+
+    Normally the resource limits of a jailed process are set by Python code
+    run in the forked child before it runs the command, which makes starting
+    a process slow when this process is large, and unsafe when it has
+    threads.  That's why the proxy process exists.  With `prlimit`, the child
+    runs no Python code, so processes can be started quickly and safely
+    directly from this process.
+
+    `path` is the path of the `prlimit` program, by default found on the
+    PATH.  This affects every process started with `subproc.run_subprocess`
+    in this process, but not those started by proxy processes or zygotes.
+
+    """
+    if path is None:
+        path = shutil.which("prlimit")
+        if path is None:
+            raise RuntimeError("Couldn't find prlimit to start processes with")
+    subproc.PRLIMIT = path
+
+
+# The cgroup in which each execution gets a cgroup of its own, if any.
+CGROUP_ROOT = None
+
+
+def configure_cgroups(root):
+    """
+    Configure `jail_code` to run each execution in a cgroup of its own.
+
+    `root` is the path of a cgroup v2 directory this process can write to,
+    such as one delegated to it by systemd.  This process must be in the
+    subtree of `root`, but not in `root` itself.  Each execution gets a
+    cgroup in `root` which limits its processes and threads to `"NPROC"`
+    (instead of the sandbox user's `RLIMIT_NPROC` across the whole host), its
+    memory to `"MEMORY"`, and its CPU time to `"CPUS"`, and which is killed
+    as a whole when the execution ends.
+
+    Executions forked from a zygote don't get cgroups.
+
+    """
+    global CGROUP_ROOT  # pylint: disable=global-statement
+    CGROUP_ROOT = CgroupRoot(root)
+
+
+# The limit on executions running at once on this host, if there is one.
+ADMISSION = None
+
+
+def configure_admission(slots, timeout=10, directory=None):
+    """
+    Configure `jail_code` to run at most `slots` executions at once on this host.
+
+    The limit is shared by all the processes using the same lock file
+    `directory`, by default "codejail-admission" in the temp directory, which
+    must be owned by this user with mode 0o700.  An execution that finds all
+    the slots in use waits for one, up to `timeout` seconds, and then raises
+    `admission.Overloaded` instead of running.
+
+    """
+    global ADMISSION  # pylint: disable=global-statement
+    ADMISSION = Admission(slots, timeout=timeout, directory=directory)
+
+
+# The scheduler of executions in this process, if there is one.
+SCHEDULER = None
+
+
+def configure_scheduler(slots, timeout=None):
+    """
+    Configure `jail_code` to run at most `slots` executions at once in this process.
+
+    Executions beyond that wait, and run in order of the `"PRIORITY"` limit of
+    their `limit_overrides_context`, and then in proportion to the `"WEIGHT"`
+    limits of the contexts.  See `scheduler.py`.  An execution that waits
+    longer than `timeout` seconds raises `admission.Overloaded`.
+
+    The scheduler comes before `configure_admission`'s limit for the host, so
+    this process chooses which of its executions takes the next slot there.
+
+    """
+    global SCHEDULER  # pylint: disable=global-statement
+    SCHEDULER = Scheduler(slots, timeout=timeout)
+
+
+# The quotas of the limit overrides contexts, if they're counted.
+QUOTAS = None
+
+
+def configure_quotas(window=60, directory=None):
+    """
+    Configure `jail_code` to enforce the quotas of limit overrides contexts.
+
+    The quotas are the `"CPU_QUOTA"` (CPU seconds in `window` seconds),
+    `"RATE_QUOTA"`, and `"CONCURRENCY_QUOTA"` limits.  An execution in a
+    context that is over one of them raises `quotas.QuotaExceeded` at once,
+    without running.  The quotas are shared by the processes on the host that
+    use the same `directory`, by default "codejail-quotas" in the temp
+    directory, which must be owned by this user with mode 0o700.  See
+    `quotas.py`.
+
+    """
+    global QUOTAS  # pylint: disable=global-statement
+    QUOTAS = Quotas(window=window, directory=directory)
+
+
+# The backend running executions, or None to run them on this host.
+BACKEND = None
+
+
+def configure_backend(backend):
+    """
+    Configure `jail_code` to run executions with `backend`, or on this host if None.
+
+    A backend, such as a `backends.RemoteBackend`, runs the executions
+    somewhere else.  The quotas, scheduler, and admission control of this
+    process still apply before an execution is handed to the backend.
+
+    """
+    global BACKEND  # pylint: disable=global-statement
+    BACKEND = backend
+
+
+# The pool of home directories for executions, if there is one.
+HOMEDIR_POOL = None
+
+
+def configure_homedir_pool(root=None, size=10, capacity=None):
+    """
+    Configure `jail_code` to take home directories from a pool.
+
+    Normally each execution makes its home directory in the temp directory.
+    With a pool, `size` of them are made ahead of time in a background
+    thread, in `root`, which could be a tmpfs mount.  By default they're made
+    in the temp directory, as without a pool.  A `root` is made unlistable
+    (mode 0o711), so executions can't find each other's directories.
+    `capacity` is the most bytes an execution is expected to write; if it's
+    given, only as many executions as fit in the free space of the filesystem
+    of `root` use it at once, and others use the temp directory.
+
+    The sandbox user must be allowed to use `root`, for instance by the
+    AppArmor profile.  The staging cache, if there is one, should be on the
+    same filesystem as `root`, so its files can be hard-linked.
+
+    """
+    global HOMEDIR_POOL  # pylint: disable=global-statement
+    if HOMEDIR_POOL is not None:
+        HOMEDIR_POOL.close()
+    HOMEDIR_POOL = HomedirPool(root=root, size=size, capacity=capacity)
+    atexit.register(HOMEDIR_POOL.close)
+
+
 def is_configured(command):
     """
     Has `jail_code` been configured for `command`?
@@ -88,13 +329,30 @@ DEFAULT_LIMITS = {
     "VMEM": 0,
     # Size of files creatable, in bytes, defaulting to nothing can be written.
     "FSIZE": 0,
+    # Bytes of stdout and stderr to collect, defaulting to unlimited.
+    "STDOUT": 0,
+    "STDERR": 0,
     # The number of processes and threads to allow for the sandbox user (total
-    # across entire host).
+    # across entire host, or for the execution with cgroups).
     "NPROC": 15,
-    # Whether to use a proxy process or not.  None means use an environment
-    # variable to decide. NOTE: using a proxy process is NOT THREAD-SAFE, only
-    # one thread can use CodeJail at a time if you are using a proxy process.
+    # Memory used by an execution with cgroups, in bytes, defaulting to
+    # unlimited.
+    "MEMORY": 0,
+    # CPUs an execution with cgroups can use, defaulting to unlimited.
+    "CPUS": 0,
+    # Whether to use proxy processes or not, and how many.  None means use an
+    # environment variable to decide.
     "PROXY": None,
+    # Whether safe_exec profiles the code, defaulting to not.
+    "PROFILE": False,
+    # The priority and fair share of executions with the scheduler.
+    "PRIORITY": 0,
+    "WEIGHT": 1,
+    # Quotas with configure_quotas, defaulting to none: CPU seconds in the
+    # window, executions a second, and executions at once.
+    "CPU_QUOTA": 0,
+    "RATE_QUOTA": 0,
+    "CONCURRENCY_QUOTA": 0,
 }
 
 # Configured resource limits.
@@ -128,14 +386,56 @@ def set_limit(limit_name, value):
         * `"FSIZE"`: the maximum size of files creatable by the jailed code,
             in bytes.  The default is 0 (no files may be created).
 
+        * `"STDOUT"`, `"STDERR"`: the maximum number of bytes of output the
+            jailed code can write to stdout or stderr.  Output beyond the
+            limit is discarded, the process is killed, and the result is
+            marked as truncated.  The default is 0 (no limit).
+
         * `"NPROC"`: the maximum number of process or threads allowed for
             jailed code across the entire host (combined across all instances
             in all containers). This includes processes owned by the same UID
             in containers where that UID is mapped to a different username.
-            The default is 15.
+            The default is 15.  With `configure_cgroups`, the limit is for
+            each execution instead.
+
+        * `"MEMORY"`: with `configure_cgroups`, the most memory an execution
+            can use, in bytes.  Unlike `"VMEM"`, this counts memory actually
+            used, by all of the execution's processes.  The default is 0 (no
+            memory limit).
+
+        * `"CPUS"`: with `configure_cgroups`, how many CPUs' worth of time an
+            execution can use at once, which can be a fraction.  The default
+            is 0 (no limit).
+
+        * `"PROXY"`: 0 to not use a proxy process, or the number of proxy
+            processes to use.  Each proxy process runs one execution at a
+            time, so use more than one to run code from several threads at
+            once.  This isn't really a limit, sorry about that.
+
+        * `"PROFILE"`: whether `safe_exec` runs the code under a profiler,
+            and reports the profile.  The default is False.  This isn't a
+            limit either, but it can be overridden for a context.
+
+        * `"PRIORITY"`: with `configure_scheduler`, executions with a higher
+            priority run before any waiting executions with a lower one.  The
+            default is 0.
+
+        * `"WEIGHT"`: with `configure_scheduler`, the share of executions a
+            context gets among the contexts of the same priority, relative to
+            their weights.  It must be more than 0, and the default is 1.
 
-        * `"PROXY"`: 1 to use a proxy process, 0 to not use one. This isn't
-            really a limit, sorry about that.
+        * `"CPU_QUOTA"`: with `configure_quotas`, the CPU seconds that
+            executions can use in the quota window.  The default is 0 (no
+            quota).
+
+        * `"RATE_QUOTA"`: with `configure_quotas`, the executions that can
+            start each second.  The default is 0 (no quota).
+
+        * `"CONCURRENCY_QUOTA"`: with `configure_quotas`, the executions that
+            can run at once.  The default is 0 (no quota).
+
+        The scheduling and quota limits are most useful overridden for a
+        context.
 
     Limits are process-wide, and will affect all future calls to jail_code.
     Providing a limit of 0 will disable that limit, unless otherwise specified.
@@ -144,16 +444,31 @@ def set_limit(limit_name, value):
     LIMITS[limit_name] = value
 
 
-def get_effective_limits(overrides_context=None):
+def get_effective_limits(overrides_context=None, limits=None):
     """
     Calculate the effective limits dictionary.
 
     Arguments:
         overrides_context (str|None): Identifies which set of overrides to use.
             If None or missing from `LIMIT_OVERRIDES`, then just return `LIMITS` as-is.
+        limits (dict|None): Limits that take precedence over both.
     """
     overrides = LIMIT_OVERRIDES.get(overrides_context, {}) if overrides_context else {}
-    return {**LIMITS, **overrides}
+    return {**LIMITS, **overrides, **(limits or {})}
+
+
+def get_proxy_count(effective_limits):
+    """
+    How many proxy processes should be used with `effective_limits`?
+
+    Uses the PROXY limit, or if that is None, the CODEJAIL_PROXY environment
+    variable.  Returns 0 if proxy processes shouldn't be used.
+
+    """
+    proxy_count = effective_limits["PROXY"]
+    if proxy_count is None:
+        proxy_count = os.environ.get("CODEJAIL_PROXY", "0")
+    return int(proxy_count)
 
 
 def override_limit(limit_name, value, limit_overrides_context):
@@ -186,11 +501,14 @@ class JailResult:
     """
     def __init__(self):
         self.stdout = self.stderr = self.status = None
+        self.stdout_truncated = self.stderr_truncated = False
+        self.timings = Timings()
+        self.rusage = None
 
 
 # pylint: disable=too-many-positional-arguments
 def jail_code(command, code=None, files=None, extra_files=None, argv=None,
-              stdin=None, limit_overrides_context=None, slug=None):
+              stdin=None, limit_overrides_context=None, slug=None, limits=None):
     """
     Run code in a jailed subprocess.
 
@@ -215,7 +533,8 @@ def jail_code(command, code=None, files=None, extra_files=None, argv=None,
 
     `argv` is the command-line arguments to supply.
 
-    `stdin` is a string, the data to provide as the stdin for the process.
+    `stdin` is a string or bytestring, the data to provide as the stdin for the
+    process.
 
     `limit_overrides_context` is an optional string to use as a key against the
     configured limit overrides contexts. If omitted or if no such limit override context
@@ -224,34 +543,329 @@ def jail_code(command, code=None, files=None, extra_files=None, argv=None,
     `slug` is an arbitrary string, a description that's meaningful to the
     caller, that will be used in log messages.
 
+    `limits` is an optional dict of limits for this execution, which take
+    precedence over the configured limits and those of
+    `limit_overrides_context`.  The quotas and scheduling still use the
+    limits of `limit_overrides_context`.  The execution server uses this to
+    apply the limits its clients send.
+
+    If `configure_scheduler` or `configure_admission` was used and too many
+    executions are running, this waits for one to finish, and raises
+    `admission.Overloaded` if none does in time.  If `configure_quotas` was
+    used and the context is over a quota, this raises `quotas.QuotaExceeded`.
+
     Return an object with:
 
         .stdout: stdout of the program, a string
         .stderr: stderr of the program, a string
         .status: exit status of the process: an int, 0 for success
+        .stdout_truncated, .stderr_truncated: whether the output was cut off
+            by the STDOUT or STDERR limit
+        .timings: an `instrumentation.Timings`, the times of the phases of
+            the execution
+        .rusage: the resources the process used, or None if they aren't
+            known: a dict of "user_time" and "system_time" (seconds of CPU),
+            "max_rss" (bytes of peak resident memory), and
+            "voluntary_switches" and "involuntary_switches" (context switches)
 
     """
-    # pylint: disable=too-many-statements
+    with instrument("jail_code", command, slug, limit_overrides_context) as info, \
+            _within_quota(info), _admitted(limit_overrides_context, slug, info.timings):
+        backend = BACKEND
+        if backend is not None:
+            with info.timings.phase("execute"):
+                info.result = backend.run(
+                    command, code, files, extra_files, argv, stdin, limit_overrides_context,
+                    get_effective_limits(limit_overrides_context, limits), slug, info.timings,
+                )
+            return info.result
+
+        with _jailed_execution(
+            command, code, files, extra_files, argv, limit_overrides_context, limits, slug, info.timings,
+        ) as execution:
+            with info.timings.phase("execute"):
+                if execution.preload_modules is not None:
+                    status, stdout, stderr, details = run_subprocess_through_zygote(
+                        cmd=execution.zygote_cmd, argv=execution.argv,
+                        preload_modules=execution.preload_modules,
+                        **execution.subprocess_kwargs(stdin)
+                    )
+                else:
+                    status, stdout, stderr, details = execution.run_subprocess_fn(
+                        cmd=execution.cmd, env={}, **execution.subprocess_kwargs(stdin)
+                    )
+            info.result = execution.make_result(status, stdout, stderr, details)
+
+            # Clean up the temp directory, unless the cleanup is in the
+            # background.
+            if execution.rm_cmd:
+                with info.timings.phase("cleanup"):
+                    execution.clean_tmp()
+
+    return info.result
 
-    if not is_configured(command):
-        # pylint: disable=broad-exception-raised
-        raise Exception("jail_code needs to be configured for %r" % command)
 
-    # We make a temp directory to serve as the home of the sandboxed code.
-    # It has a writable "tmp" directory within it for temp files.
+# pylint: disable=too-many-positional-arguments
+async def async_jail_code(command, code=None, files=None, extra_files=None, argv=None,
+                          stdin=None, limit_overrides_context=None, slug=None, limits=None):
+    """
+    Run code in a jailed subprocess, as a coroutine.
+
+    The arguments and the result are the same as for `jail_code`.
+
+    The jailed process is run with asyncio's subprocess support, and the
+    REALTIME limit is enforced by the event loop, so no threads are needed.
+    If the coroutine is cancelled, the jailed process is killed.
+
+    Proxy processes, zygotes, and backends communicate with blocking calls, so
+    when they are in use, the execution is run in the event loop's default
+    executor instead.  Cancelling the coroutine kills a process run by a proxy
+    or a zygote too, but doesn't end an execution on a backend early.
+    Staging the files and removing the home directory are also done in the
+    executor, so they don't block the event loop.
+
+    """
+    loop = asyncio.get_running_loop()
+    with instrument("jail_code", command, slug, limit_overrides_context) as info, _within_quota(info):
+        async with _async_admitted(limit_overrides_context, slug, info.timings):
+            backend = BACKEND
+            if backend is not None:
+                with info.timings.phase("execute"):
+                    info.result = await loop.run_in_executor(None, functools.partial(
+                        backend.run,
+                        command, code, files, extra_files, argv, stdin, limit_overrides_context,
+                        get_effective_limits(limit_overrides_context, limits), slug, info.timings,
+                    ))
+                return info.result
+
+            async with _async_jailed_execution(
+                command, code, files, extra_files, argv, limit_overrides_context, limits, slug, info.timings,
+            ) as execution:
+                try:
+                    with info.timings.phase("execute"):
+                        if execution.preload_modules is not None:
+                            status, stdout, stderr, details = await _run_cancellably(
+                                run_subprocess_through_zygote,
+                                cmd=execution.zygote_cmd, argv=execution.argv,
+                                preload_modules=execution.preload_modules,
+                                **execution.subprocess_kwargs(stdin)
+                            )
+                        elif execution.run_subprocess_fn is not run_subprocess:
+                            status, stdout, stderr, details = await _run_cancellably(
+                                execution.run_subprocess_fn,
+                                cmd=execution.cmd, env={}, **execution.subprocess_kwargs(stdin)
+                            )
+                        else:
+                            status, stdout, stderr, details = await async_run_subprocess(
+                                cmd=execution.cmd, env={}, **execution.subprocess_kwargs(stdin)
+                            )
+                    info.result = execution.make_result(status, stdout, stderr, details)
+                finally:
+                    # Clean up the temp directory, unless the cleanup is in the
+                    # background.  Even if we are cancelled, during the
+                    # execution or now, this must finish before the home
+                    # directory is removed.
+                    with info.timings.phase("cleanup"):
+                        if not execution.rm_cmd:
+                            pass
+                        elif execution.clean_fn is None and execution.run_subprocess_fn is run_subprocess:
+                            await asyncio.shield(async_run_subprocess(execution.rm_cmd, cwd=execution.homedir))
+                        else:
+                            await asyncio.shield(loop.run_in_executor(None, execution.clean_tmp))
+
+    return info.result
+
+
+async def _run_cancellably(func, **kwargs):
+    """
+    Run the subprocess function `func` with `kwargs` in the default executor.
+
+    If the coroutine is cancelled, the process is killed, and the
+    cancellation is propagated once `func` has returned.
+
+    """
+    loop = asyncio.get_running_loop()
+    cancellation = Cancellation()
+
+    def run():
+        try:
+            return func(on_start=cancellation.started, **kwargs)
+        finally:
+            cancellation.ended()
+
+    running = loop.run_in_executor(None, run)
+    try:
+        return await asyncio.shield(running)
+    except asyncio.CancelledError:
+        await loop.run_in_executor(None, cancellation.cancel)
+        await asyncio.gather(running, return_exceptions=True)
+        raise
+
+
+@contextlib.contextmanager
+def _within_quota(info):
+    """
+    Count the execution of `info`, an `ExecutionInfo`, against `QUOTAS`.
+
+    Raises `quotas.QuotaExceeded` if its context is over a quota.  After the
+    body, the CPU time of `info.result` is counted, or the time it spent
+    executing if its CPU time isn't known.
+
+    """
+    quotas = QUOTAS
+    context = info.limit_overrides_context
+    running = quotas.start(context, get_effective_limits(context), info.slug) if quotas is not None else None
+    if running is None:
+        yield
+        return
+    try:
+        yield
+    finally:
+        cpu_seconds = 0
+        if info.result is not None and info.result.rusage is not None:
+            cpu_seconds = info.result.rusage["user_time"] + info.result.rusage["system_time"]
+        elif info.result is not None:
+            cpu_seconds = info.timings.durations().get("execute", 0)
+        quotas.finish(running, cpu_seconds)
+
+
+@contextlib.contextmanager
+def _admitted(limit_overrides_context, slug, timings):
+    """
+    Hold a slot of `SCHEDULER` and of `ADMISSION`, if there are any, while the body runs.
 
-    with temp_directory() as homedir:
+    The time spent waiting for the slots is recorded as the "admission" phase
+    in `timings`.
 
-        # Make directory readable by other users ('sandbox' user needs to be
-        # able to read it).
-        os.chmod(homedir, 0o775)
+    """
+    scheduler, admission = SCHEDULER, ADMISSION
+    if scheduler is None and admission is None:
+        yield
+        return
+    with contextlib.ExitStack() as stack:
+        with timings.phase("admission"):
+            if scheduler is not None:
+                limits = get_effective_limits(limit_overrides_context)
+                scheduler.acquire(limit_overrides_context, limits["PRIORITY"], limits["WEIGHT"], slug)
+                stack.callback(scheduler.release)
+            if admission is not None:
+                stack.callback(admission.release, admission.acquire(slug))
+        yield
+
+
+@contextlib.asynccontextmanager
+async def _async_admitted(limit_overrides_context, slug, timings):
+    """Like `_admitted`, but waits for the slots without blocking the event loop."""
+    scheduler, admission = SCHEDULER, ADMISSION
+    if scheduler is None and admission is None:
+        yield
+        return
+    with contextlib.ExitStack() as stack:
+        with timings.phase("admission"):
+            if scheduler is not None:
+                limits = get_effective_limits(limit_overrides_context)
+                await scheduler.async_acquire(limit_overrides_context, limits["PRIORITY"], limits["WEIGHT"], slug)
+                stack.callback(scheduler.release)
+            if admission is not None:
+                stack.callback(admission.release, await admission.async_acquire(slug))
+        yield
+
+
+class _JailedExecution:
+    """
+    Everything `jail_code` needs to run one execution, once it is staged.
+    """
+    def __init__(self, homedir, cmd, zygote_cmd, argv, rm_cmd, clean_fn, effective_limits,
+                 preload_modules, run_subprocess_fn, slug, timings, cgroup=None):
+        self.homedir = homedir
+        self.cmd = cmd
+        self.zygote_cmd = zygote_cmd
+        self.argv = argv
+        self.rm_cmd = rm_cmd
+        self.clean_fn = clean_fn
+        self.effective_limits = effective_limits
+        self.preload_modules = preload_modules
+        self.run_subprocess_fn = run_subprocess_fn
+        self.slug = slug
+        self.timings = timings
+        self.cgroup = cgroup
+
+    def subprocess_kwargs(self, stdin):
+        """The keyword arguments for running the jailed process with `stdin`."""
+        if isinstance(stdin, str):
+            stdin = stdin.encode('utf-8')
+        rlimits = create_rlimits(self.effective_limits)
+        kwargs = {
+            "cwd": self.homedir,
+            "slug": self.slug,
+            "stdin": stdin,
+            "realtime": self.effective_limits["REALTIME"],
+            "rlimits": rlimits,
+            "stdout_limit": self.effective_limits["STDOUT"],
+            "stderr_limit": self.effective_limits["STDERR"],
+        }
+        if self.cgroup is not None:
+            kwargs["cgroup"] = self.cgroup.path
+            if "pids" in self.cgroup.controllers:
+                # The cgroup limits the execution's processes instead.
+                kwargs["rlimits"] = [rlimit for rlimit in rlimits if rlimit[0] != resource.RLIMIT_NPROC]
+        return kwargs
+
+    def clean_tmp(self):
+        """
+        Remove what the sandboxed code wrote in its temp directory.
+
+        It's done with `clean_fn` if there is one, which avoids running `sudo`,
+        or else by running `rm_cmd`.
+
+        """
+        if self.clean_fn is None or not self.clean_fn([os.path.join(self.homedir, "tmp")]):
+            self.run_subprocess_fn(self.rm_cmd, cwd=self.homedir)
+
+    def make_result(self, status, stdout, stderr, details):
+        """Make the `JailResult` from what the subprocess function returned."""
+        result = JailResult()
+        result.status = status
+        result.stdout = stdout
+        result.stderr = stderr
+        result.stdout_truncated = details["stdout_truncated"]
+        result.stderr_truncated = details["stderr_truncated"]
+        result.rusage = details["rusage"]
+        self.timings.add_all(details["timings"])
+        result.timings = self.timings
+        return result
 
-        # Make a subdir to use for temp files, world-writable so that the
-        # sandbox user can write to it.
-        tmptmp = os.path.join(homedir, "tmp")
-        os.mkdir(tmptmp)
-        os.chmod(tmptmp, 0o777)
 
+# pylint: disable=too-many-statements
+@contextlib.contextmanager
+def _jailed_execution(command, code, files, extra_files, argv, limit_overrides_context, limits, slug, timings):
+    """
+    Stage an execution for `jail_code`, and clean up after it.
+
+    The arguments are as for `jail_code`, and `timings` is the `Timings` to
+    record the "stage" and "cleanup" phases in.  Yields a `_JailedExecution`.
+    The caller must call its `clean_tmp` if it has an `rm_cmd`, before the
+    context ends.
+
+    """
+    stage_start = time.monotonic()
+    if not is_configured(command):
+        # pylint: disable=broad-exception-raised
+        raise Exception("jail_code needs to be configured for %r" % command)
+
+    # We use a temp directory to serve as the home of the sandboxed code.
+    # It has a writable "tmp" directory within it for temp files.
+    pool = HOMEDIR_POOL
+    if pool is not None:
+        homedir = pool.take()
+        remove_homedir = pool.release
+    else:
+        homedir = make_homedir()
+        remove_homedir = shutil.rmtree
+    tmptmp = os.path.join(homedir, "tmp")
+    reaper = None
+    cgroup = None
+    try:
         argv = argv or []
 
         # All the supporting files are copied into our directory.
@@ -259,6 +873,8 @@ def jail_code(command, code=None, files=None, extra_files=None, argv=None,
             dest = os.path.join(homedir, os.path.basename(filename))
             if os.path.islink(filename):
                 os.symlink(os.readlink(filename), dest)
+            elif STAGING_CACHE is not None:
+                STAGING_CACHE.stage(filename, dest)
             elif os.path.isfile(filename):
                 shutil.copy(filename, homedir)
             else:
@@ -277,28 +893,51 @@ def jail_code(command, code=None, files=None, extra_files=None, argv=None,
             with open(os.path.join(homedir, name), "wb") as extra:
                 extra.write(content)
 
-        cmd = []
-        rm_cmd = []
-
         # Build the command to run.
         user = COMMANDS[command]['user']
         if user:
             # Run as the specified user
-            cmd.extend(['sudo', '-u', user])
-            rm_cmd.extend(['sudo', '-u', user])
+            user_cmd = ['sudo', '-u', user]
+        else:
+            user_cmd = []
+        cmd = list(user_cmd)
 
-        # Point TMPDIR at our temp directory.
-        # FIXME: This breaks command execution unless user param has been set.
-        #   Issue: https://github.com/openedx/codejail/issues/162
+        # Point TMPDIR at our temp directory.  sudo sets environment variables
+        # given before the command; without it, env does.
+        if not user:
+            cmd.append('env')
         cmd.extend(['TMPDIR=tmp'])
         # Start with the command line dictated by "python" or whatever.
         cmd.extend(COMMANDS[command]['cmdline_start'])
 
+        # A zygote runs the same command line, but with its own program.
+        zygote_cmd = list(cmd)
+
+        # A zygote runs as the sandbox user, so it can clean up without sudo.
+        preload_modules = PRELOAD_MODULES.get(command)
+        if preload_modules is not None:
+            clean_fn = zygote_cleaner(tuple(zygote_cmd), tuple(preload_modules))
+        else:
+            clean_fn = None
+
         # Add the code-specific command line pieces.
         cmd.extend(argv)
 
+        # Remove the tmptmp directory as the sandbox user since the sandbox
+        # user may have written files that the application user can't delete.
+        # A background reaper does this itself.
+        reaper = CLEANUP_REAPER
+        if reaper is None:
+            rm_cmd = user_cmd + [
+                '/usr/bin/find', tmptmp,
+                '-mindepth', '1', '-maxdepth', '1',
+                '-exec', 'rm', '-rf', '{}', ';'
+            ]
+        else:
+            rm_cmd = None
+
         # Determine effective resource limits.
-        effective_limits = get_effective_limits(limit_overrides_context)
+        effective_limits = get_effective_limits(limit_overrides_context, limits)
         if slug:
             log.info(
                 "Preparing to execute jailed code %r "
@@ -308,44 +947,77 @@ def jail_code(command, code=None, files=None, extra_files=None, argv=None,
                 effective_limits,
             )
 
-        # Use the configuration and maybe an environment variable to determine
-        # whether to use a proxy process.
-        use_proxy = effective_limits["PROXY"]
-        if use_proxy is None:
-            use_proxy = int(os.environ.get("CODEJAIL_PROXY", "0"))
+        use_proxy = get_proxy_count(effective_limits)
         if use_proxy:
+            PROXY_POOL.set_size(use_proxy)
             run_subprocess_fn = run_subprocess_through_proxy
         else:
             run_subprocess_fn = run_subprocess
 
-        if stdin:
-            stdin = bytes(stdin, 'utf-8')
-
-        # Run the subprocess.
-        status, stdout, stderr = run_subprocess_fn(
-            cmd=cmd, cwd=homedir, env={}, slug=slug,
-            stdin=stdin,
-            realtime=effective_limits["REALTIME"],
-            rlimits=create_rlimits(effective_limits),
+        # Processes forked from a zygote can't be moved into a cgroup.
+        if CGROUP_ROOT is not None and preload_modules is None:
+            cgroup = CGROUP_ROOT.create(
+                pids=effective_limits["NPROC"],
+                memory=effective_limits["MEMORY"],
+                cpus=effective_limits["CPUS"],
             )
 
-        result = JailResult()
-        result.status = status
-        result.stdout = stdout
-        result.stderr = stderr
+        timings.add("stage", stage_start, time.monotonic())
+        yield _JailedExecution(
+            homedir=homedir,
+            cmd=cmd,
+            zygote_cmd=zygote_cmd,
+            argv=argv,
+            rm_cmd=rm_cmd,
+            clean_fn=clean_fn,
+            effective_limits=effective_limits,
+            preload_modules=preload_modules,
+            run_subprocess_fn=run_subprocess_fn,
+            slug=slug,
+            timings=timings,
+            cgroup=cgroup,
+        )
+    finally:
+        with timings.phase("cleanup"):
+            if cgroup is not None:
+                try:
+                    cgroup.remove()
+                except OSError:
+                    log.exception("Couldn't remove cgroup %s", cgroup.path)
+            if reaper is not None:
+                reaper.submit(homedir, tmptmp, user_cmd, run_subprocess_fn, remove_homedir, clean_fn)
+            else:
+                # If this errors, something is genuinely wrong, so don't ignore errors.
+                remove_homedir(homedir)
 
-        # Remove the tmptmp directory as the sandbox user since the sandbox
-        # user may have written files that the application user can't delete.
-        rm_cmd.extend([
-            '/usr/bin/find', tmptmp,
-            '-mindepth', '1', '-maxdepth', '1',
-            '-exec', 'rm', '-rf', '{}', ';'
-        ])
 
-        # Run the rm command subprocess.
-        run_subprocess_fn(rm_cmd, cwd=homedir)
+@contextlib.asynccontextmanager
+async def _async_jailed_execution(*args):
+    """
+    Like `_jailed_execution`, but staging and cleaning up in the default executor.
 
-    return result
+    Once the staging has started, the cleanup is done even if the coroutine
+    is cancelled.
+
+    """
+    loop = asyncio.get_running_loop()
+    manager = _jailed_execution(*args)
+    entering = loop.run_in_executor(None, manager.__enter__)
+    try:
+        execution = await asyncio.shield(entering)
+    except asyncio.CancelledError:
+        # The staging goes on in its thread, so clean up after it.
+        (execution,) = await asyncio.gather(entering, return_exceptions=True)
+        if not isinstance(execution, BaseException):
+            await loop.run_in_executor(None, manager.__exit__, None, None, None)
+        raise
+
+    try:
+        yield execution
+    finally:
+        # `_jailed_execution` cleans up the same way whether or not the body
+        # raised, so the exception isn't passed to another thread.
+        await asyncio.shield(loop.run_in_executor(None, manager.__exit__, None, None, None))
 
 
 def create_rlimits(effective_limits):
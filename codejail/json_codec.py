@@ -0,0 +1,106 @@
+"""
+The JSON codecs `safe_exec` can use to pass globals into and out of the sandbox.
+
+The globals always cross the sandbox boundary as JSON, whichever codec is
+used, so the data the sandbox can send back is still only what JSON can
+represent.  The codecs differ only in speed:
+
+* "json": the standard library's `json` module.
+* "simplejson": the `simplejson` package, if it's installed.
+* "orjson": the `orjson` package, if it's installed, which is several times
+  faster than either.  It can't write NaN or infinite floats, and writes them
+  as null.
+
+Each codec is defined by a function that imports what it needs and returns a
+pair of functions: `loads`, which decodes a bytestring, and `dumps`, which
+encodes to a bytestring.  These functions are also run in the sandbox, so they
+must not use anything outside of themselves.  If a codec's package can't be
+imported, the function raises ImportError, and the "json" codec is used
+instead.
+
+"""
+
+import functools
+
+
+def load_json():
+    """The codec using the standard library's `json` module."""
+    import json  # pylint: disable=import-outside-toplevel
+
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+    return loads, dumps
+
+
+def load_simplejson():
+    """The codec using `simplejson`."""
+    import simplejson  # pylint: disable=import-outside-toplevel,import-error
+
+    def loads(data):
+        return simplejson.loads(data)
+
+    def dumps(obj):
+        return simplejson.dumps(obj).encode("utf-8")
+
+    return loads, dumps
+
+
+def load_orjson():
+    """The codec using `orjson`, with `json` for what `orjson` can't handle."""
+    # pylint: disable=import-outside-toplevel,no-member
+    import json
+    import re
+
+    import orjson
+
+    # orjson reads integers too large for 64 bits as floats.  Data with 20 or
+    # more digits in a row might have such an integer, so it's read with json.
+    long_digits = re.compile(b"[0-9]{20}")
+
+    def loads(data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if long_digits.search(data):
+            return json.loads(data)
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # NaN and infinities are only understood by json.
+            return json.loads(data)
+
+    def dumps(obj):
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # Integers too large for 64 bits are only written by json.
+            return json.dumps(obj).encode("utf-8")
+
+    return loads, dumps
+
+
+CODECS = {
+    "json": load_json,
+    "simplejson": load_simplejson,
+    "orjson": load_orjson,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_codec(name):
+    """
+    Get the codec called `name`.
+
+    Returns a triple: the name of the codec actually used, which is "json" if
+    `name` can't be imported, and its `loads` and `dumps` functions.
+
+    """
+    try:
+        loads, dumps = CODECS[name]()
+    except ImportError:
+        name = "json"
+        loads, dumps = load_json()
+    return name, loads, dumps
@@ -11,53 +11,115 @@ small, it will be able to spawn subprocesses even when the parent
 process grows large.
 
 The use of the proxy process is controlled by a "PROXY" limit, which
-should be 0 or 1.  If neither is set, then the CODEJAIL_PROXY
-environment variable determines whether the proxy is used.
+should be 0, or the number of proxy processes to use.  If it isn't set, then
+the CODEJAIL_PROXY environment variable determines whether the proxy is used.
+Each proxy process runs one subprocess at a time, so several of them let
+several threads run code concurrently.
 """
 
-import ast
+import functools
+import inspect
+import json
 import logging
 import os
 import os.path
+import struct
 import subprocess
 import sys
+import threading
 import time
 
 import six
 
-from .subproc import run_subprocess
+from .subproc import kill_cgroup, run_subprocess
 
 log = logging.getLogger("codejail")
 
-# We use .readline to get data from the pipes between the processes, so we need
-# to ensure that a newline does not appear in the data.  We also need a way to
-# communicate a few values, and unpack them.  Lastly, we need to be sure we can
-# handle binary data.  Serializing with repr() and deserializing the literals
-# that result give us all the properties we need.
-# Python 3: the outside of subprocess talks in bytes (the pipes from
-# subprocess.* are all about bytes). The inside of the Python code it runs
-# talks in text (reading from sys.stdin is text, writing to sys.stdout
-# expects text).
+# The parent and the proxy process exchange messages over the proxy's stdin
+# and stdout.  Each message is a 4-byte big-endian length, a JSON header of that
+# length, and then the raw bytes of any blobs, whose lengths are listed in the
+# header's "blobs" entry.  Large data (the stdin, stdout, and stderr of the
+# jailed process) travels as blobs, so it is never escaped or parsed.
+#
+# When it starts, the proxy sends a hello message with its PROTOCOL_VERSION,
+# and the parent checks that it matches its own.  If a request asks for it,
+# the proxy sends a message with the pid of the process it started, before
+# the response.
+PROTOCOL_VERSION = 1
 
+# The largest JSON header we'll accept.
+MAX_HEADER = 16 * 1024 * 1024
 
-def serialize_out(val):
-    """Send data out of the proxy process. Needs to make unicode."""
-    return repr(val)
+# How much of what a proxy process that failed to start wrote to include in
+# the error, and how many seconds to wait for it to finish writing.
+MAX_STARTUP_OUTPUT = 10000
+STARTUP_OUTPUT_TIMEOUT = 5
 
+_LENGTH = struct.Struct("!I")
 
-def serialize_in(val):
-    """Send data into the proxy process. Needs to make bytes."""
-    return serialize_out(val).encode('utf8')
 
+class ProxyProtocolError(Exception):
+    """The other end of a proxy pipe sent something we don't understand."""
 
-def deserialize_in(ustr):
-    """Get data into the proxy process. Needs to take unicode."""
-    return ast.literal_eval(ustr)
+
+def write_message(stream, header, blobs=()):
+    """
+    Write a message to the binary file `stream`.
+
+    `header` is a JSON-serializable dict, and `blobs` is a list of bytes.
+    Values in the header that JSON can't represent are sent as their repr.
+
+    """
+    header = dict(header, blobs=[len(blob) for blob in blobs])
+    header_bytes = json.dumps(header, default=repr).encode("utf-8")
+    stream.write(_LENGTH.pack(len(header_bytes)) + header_bytes)
+    for blob in blobs:
+        stream.write(blob)
+    stream.flush()
 
 
-def deserialize_out(bstr):
-    """Get data from the proxy process. Needs to take bytes."""
-    return deserialize_in(bstr.decode('utf8'))
+def read_message(stream):
+    """
+    Read a message written by `write_message` from the binary file `stream`.
+
+    Returns the header and the list of blobs, or None if the stream is at EOF.
+
+    """
+    length_bytes = _read_exactly(stream, _LENGTH.size, eof_ok=True)
+    if length_bytes is None:
+        return None
+    (length,) = _LENGTH.unpack(length_bytes)
+    if length > MAX_HEADER:
+        # The bytes are more likely the start of something that isn't a
+        # message at all, such as a traceback.
+        raise ProxyProtocolError("Message header too long: %d bytes (%r)" % (length, length_bytes))
+    try:
+        header = json.loads(_read_exactly(stream, length).decode("utf-8"))
+    except ValueError as exc:
+        raise ProxyProtocolError("Bad message header: %s" % exc) from exc
+    blobs = [_read_exactly(stream, blob_length) for blob_length in header.pop("blobs")]
+    return header, blobs
+
+
+def _read_exactly(stream, length, eof_ok=False):
+    """
+    Read exactly `length` bytes from `stream`.
+
+    If the stream is at EOF before any bytes are read, returns None if
+    `eof_ok`, and otherwise raises `EOFError`.
+
+    """
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    pos = 0
+    while pos < length:
+        count = stream.readinto(view[pos:])
+        if not count:
+            if pos == 0 and eof_ok:
+                return None
+            raise EOFError("Proxy pipe ended after %d of %d bytes" % (pos, length))
+        pos += count
+    return bytes(buffer)
 
 
 ##
@@ -66,82 +128,233 @@ def deserialize_out(bstr):
 
 def run_subprocess_through_proxy(*args, **kwargs):  # pylint: disable=inconsistent-return-statements
     """
-    Works just like :ref:`run_subprocess`, but through the proxy process.
+    Works just like :ref:`run_subprocess`, but through a proxy process.
 
-    This will retry a few times if need be.
+    A proxy process is checked out of `PROXY_POOL` for the duration of the
+    call, so this can be called from many threads at once.  This will retry a
+    few times if need be.  The process given to `on_start` is a
+    `ProxiedProcess`.
 
     """
     last_exception = None
     for _tries in range(3):
+        proxy = PROXY_POOL.checkout()
         try:
-            proxy = get_proxy()
-
-            # Write the args and kwargs to the proxy process.
-            proxy_stdin = serialize_in((args, kwargs))
-            proxy.stdin.write(proxy_stdin+b"\n")
-            proxy.stdin.flush()
-
-            # Read the result from the proxy.  This blocks until the process
-            # is done.
-            proxy_stdout = proxy.stdout.readline()
-            if not proxy_stdout:
-                # EOF: the proxy must have died.
-                raise Exception("Proxy process died unexpectedly!")  # pylint: disable=broad-exception-raised
-            status, stdout, stderr, log_calls = deserialize_out(proxy_stdout.rstrip())
-
-            # Write all the log messages to the log, and return.
-            for level, msg, args in log_calls:
-                log.log(level, msg, *args)
-            return status, stdout, stderr
+            status, stdout, stderr, details, log_calls = proxy.run_subprocess(args, kwargs)
         except Exception:  # pylint: disable=broad-except
             log.exception("Proxy process failed")
+            PROXY_POOL.checkin(proxy, healthy=False)
             # Give the proxy process a chance to die completely if it is dying.
             time.sleep(.001)
             last_exception = sys.exc_info()
             continue
+        PROXY_POOL.checkin(proxy)
+
+        # Write all the log messages to the log, and return.
+        for level, msg, args in log_calls:
+            if isinstance(args, dict):
+                # A single mapping argument, which logging keeps as the args.
+                args = [args]
+            log.log(level, msg, *args)
+        return status, stdout, stderr, details
 
     # If we finished all the tries, then raise the last exception we got.
     if last_exception:
         six.reraise(*last_exception)
 
 
-# There is one global proxy process.
-PROXY_PROCESS = None
-
-
-def get_proxy():
-    # pylint: disable=missing-function-docstring
-    global PROXY_PROCESS  # pylint: disable=global-statement
+class ProxiedProcess:
+    """
+    A process started by a proxy process, with what's needed to kill it.
+    """
+    def __init__(self, pid, cgroup=None):
+        self.pid = pid
+        if cgroup:
+            self.kill_group = functools.partial(kill_cgroup, cgroup)
 
-    # If we had a proxy process, but it died, clean up.
-    if PROXY_PROCESS is not None:
-        status = PROXY_PROCESS.poll()
-        if status is not None:
-            log.info(
-                "CodeJail proxy process (pid %d) ended with status code %d",
-                PROXY_PROCESS.pid,
-                status
-            )
-            PROXY_PROCESS = None
 
-    # If we need a proxy, make a proxy.
-    if PROXY_PROCESS is None:
+class ProxyProcess:
+    """
+    One proxy process, and the pipes to communicate with it.
+    """
+    def __init__(self):
         # Run proxy_main.py with the same Python that is running us. "-u" makes
         # the stdin and stdout unbuffered. We pass the log level of the
         # "codejail" log so that the proxy can send back an appropriate level
-        # of detail in the log messages.
+        # of detail in the log messages.  The proxy's stderr is our own, so
+        # that nothing but messages is ever written to its stdout.
         log_level = log.getEffectiveLevel()
         cmd = [sys.executable, '-u', '-m', "codejail.proxy_main", str(log_level)]
 
-        PROXY_PROCESS = subprocess.Popen(
+        self.process = subprocess.Popen(
             args=cmd,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
         )
-        log.info("Started CodeJail proxy process (pid %d)", PROXY_PROCESS.pid)
+        self.pid = self.process.pid
+        # Only one request at a time can use the pipes.
+        self.lock = threading.Lock()
+
+        try:
+            hello = read_message(self.process.stdout)
+            if hello is None:
+                raise ProxyProtocolError("Proxy process died while starting")
+            version = hello[0].get("protocol")
+            if version != PROTOCOL_VERSION:
+                raise ProxyProtocolError(
+                    "Proxy process speaks protocol %r, not %r" % (version, PROTOCOL_VERSION)
+                )
+        except (ProxyProtocolError, EOFError) as exc:
+            # Whatever else the proxy wrote, such as the output of code run
+            # before it started speaking the protocol, says what went wrong.
+            # The proxy ends when its stdin is closed.
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=STARTUP_OUTPUT_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            output = self.process.stdout.read(MAX_STARTUP_OUTPUT)
+            self.close()
+            raise ProxyProtocolError(
+                "%s (status %d), then wrote %r" % (exc, self.process.returncode, output)
+            ) from exc
+        except Exception:
+            self.close()
+            raise
+        log.info("Started CodeJail proxy process (pid %d)", self.pid)
+
+    def is_alive(self):
+        """Is the proxy process still running?"""
+        status = self.process.poll()
+        if status is None:
+            return True
+        log.info("CodeJail proxy process (pid %d) ended with status code %d", self.pid, status)
+        return False
+
+    def run_subprocess(self, args, kwargs):
+        """
+        Have the proxy process call `run_subprocess(*args, **kwargs)`.
+
+        Returns the result of `run_subprocess`, with the list of log calls made
+        in the proxy process appended.
+
+        """
+        kwargs = inspect.signature(run_subprocess).bind(*args, **kwargs).arguments
+        stdin = kwargs.pop("stdin", None)
+        on_start = kwargs.pop("on_start", None)
+        request = {"kwargs": kwargs, "stdin": stdin is not None, "report_start": on_start is not None}
+        with self.lock:
+            write_message(self.process.stdin, request, [stdin] if stdin is not None else [])
+            # Read the result from the proxy.  This blocks until the process
+            # is done.
+            response = read_message(self.process.stdout)
+            if on_start is not None and response is not None:
+                on_start(ProxiedProcess(response[0]["pid"], kwargs.get("cgroup")))
+                response = read_message(self.process.stdout)
+        if response is None:
+            # EOF: the proxy must have died.
+            raise Exception("Proxy process died unexpectedly!")  # pylint: disable=broad-exception-raised
+        header, (stdout, stderr) = response
+        return header["status"], stdout, stderr, header["details"], header["log_calls"]
+
+    def close(self):
+        """End the proxy process."""
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+class ProxyPool:
+    """
+    A pool of proxy processes, so that threads can use proxies concurrently.
+
+    Proxies are started as they are needed, up to `size` of them.  A thread
+    calls `checkout` to get a proxy for its exclusive use, waiting if all of
+    them are in use, and `checkin` to return it.  Proxies that have died, or
+    that failed while in use, are replaced.
+
+    """
+    def __init__(self, size=1):
+        self.size = size
+        # All the proxies, and those that aren't checked out.
+        self.proxies = set()
+        self.idle = []
+        # The number of proxies being started.
+        self.starting = 0
+        self.condition = threading.Condition()
+
+    def set_size(self, size):
+        """Change the maximum number of proxy processes."""
+        with self.condition:
+            if size != self.size:
+                self.size = size
+                while self.idle and len(self.proxies) > self.size:
+                    self._discard(self.idle.pop())
+                self.condition.notify_all()
+
+    def checkout(self):
+        """Get a proxy, starting one or waiting for one if needed."""
+        with self.condition:
+            while True:
+                while self.idle:
+                    proxy = self.idle.pop()
+                    if proxy.is_alive():
+                        return proxy
+                    self._discard(proxy)
+                if len(self.proxies) + self.starting < self.size:
+                    self.starting += 1
+                    break
+                self.condition.wait()
+
+        # Start a new proxy, without holding the lock, since it takes a while.
+        try:
+            proxy = ProxyProcess()
+        except Exception:
+            with self.condition:
+                self.starting -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.starting -= 1
+            self.proxies.add(proxy)
+        return proxy
+
+    def checkin(self, proxy, healthy=True):
+        """
+        Return a proxy to the pool.
+
+        If `healthy` is false, the proxy failed while in use, so it is ended,
+        and will be replaced when needed.
+
+        """
+        with self.condition:
+            if healthy and len(self.proxies) <= self.size:
+                self.idle.append(proxy)
+            else:
+                self._discard(proxy)
+            self.condition.notify()
+
+    def _discard(self, proxy):
+        """End `proxy` and remove it from the pool.  Call with the lock held."""
+        self.proxies.discard(proxy)
+        proxy.close()
+
+    def close(self):
+        """End all the idle proxies."""
+        with self.condition:
+            while self.idle:
+                self._discard(self.idle.pop())
+
+
+# The pool of proxy processes used by `run_subprocess_through_proxy`.  Its
+# size is set from the "PROXY" limit.
+PROXY_POOL = ProxyPool()
 
-    return PROXY_PROCESS
 
 ##
 # Proxy process code
@@ -183,11 +396,15 @@ def proxy_main(argv):
 
     It does this:
 
-        * Reads a line from stdin with the repr of a tuple: (args, kwargs)
-        * Calls :ref:`run_subprocess` with *args, **kwargs
-        * Writes one line to stdout: the repr of the return value from
-          `run_subprocess` and the log calls made:
-          (status, stdout, stderr, log_calls) .
+        * Sends a hello message with its protocol version.
+        * Reads a request message from stdin: the keyword arguments for
+          :ref:`run_subprocess`, and the stdin for the subprocess as a blob.
+        * Calls :ref:`run_subprocess` with those arguments, and if the
+          request asks for it, writes a message with the pid of the process
+          once it has started.
+        * Writes a response message to stdout: the status, the details, and
+          the log calls made, with the stdout and stderr of the subprocess as
+          blobs.
 
     The process ends when its stdin is closed.
 
@@ -207,22 +424,35 @@ def proxy_main(argv):
 
     log.debug("Starting proxy process")
 
+    # A buffered writer, since an unbuffered one can write only part of a blob.
+    proxy_stdin = sys.stdin.buffer
+    proxy_stdout = open(sys.stdout.fileno(), "wb", closefd=False)  # pylint: disable=consider-using-with
     try:
+        write_message(proxy_stdout, {"protocol": PROTOCOL_VERSION})
         while True:
-            stdin = sys.stdin.readline()
-            log.debug("proxy stdin: %r", stdin)
-            if not stdin:
+            request = read_message(proxy_stdin)
+            if request is None:
                 break
-            args, kwargs = deserialize_in(stdin.rstrip())
-            status, stdout, stderr = run_subprocess(*args, **kwargs)
+            header, blobs = request
+            kwargs = header["kwargs"]
+            log.debug("proxy request: %r", kwargs)
+            if header["stdin"]:
+                kwargs["stdin"] = blobs[0]
+            if kwargs.get("rlimits"):
+                kwargs["rlimits"] = [(limit, tuple(value)) for limit, value in kwargs["rlimits"]]
+            if header.get("report_start"):
+                kwargs["on_start"] = lambda proc: write_message(proxy_stdout, {"pid": proc.pid})
+            status, stdout, stderr, details = run_subprocess(**kwargs)
             log.debug(
-                "run_subprocess result: status=%r\nstdout=%r\nstderr=%r",
-                status, stdout, stderr,
+                "run_subprocess result: status=%r, %d bytes of stdout, %d bytes of stderr",
+                status, len(stdout), len(stderr),
             )
             log_calls = capture_log.get_log_calls()
-            stdout = serialize_out((status, stdout, stderr, log_calls))
-            sys.stdout.write(stdout+"\n")
-            sys.stdout.flush()
+            write_message(
+                proxy_stdout,
+                {"status": status, "details": details, "log_calls": log_calls},
+                [stdout, stderr],
+            )
     except Exception:  # pylint: disable=broad-except
         # Note that this log message will not get back to the parent, because
         # we are dying and not communicating back to the parent. This will be
@@ -0,0 +1,278 @@
+"""
+Quotas on the executions of each limit overrides context.
+
+One context that runs too much code can use up the capacity that every other
+context shares.  A context's quotas are limits, set with `override_limit`:
+
+* `"CPU_QUOTA"`: the CPU seconds its executions can use in a window of time
+  (by default a minute).
+* `"RATE_QUOTA"`: the executions it can start each second.
+* `"CONCURRENCY_QUOTA"`: the executions it can run at once.
+
+The first two are token buckets, which fill at a steady rate up to a full
+window's worth (or a second's worth of executions), so short bursts are
+allowed.  CPU time is counted from what the executions actually used, once
+they're done, so a bucket can go below empty, and the context waits for it to
+fill again.  An execution beyond a quota fails at once with `QuotaExceeded`,
+before anything is staged or started.
+
+Quotas are counted for the whole host, as for admission control (see
+`admission.py`): each context has a state file with its buckets, and a lock
+file for each execution it can run at once, in a directory that all of the
+worker processes on the host share.  The files are locked with `flock`, so an
+execution of a process that dies stops counting as running.  Once a window
+has passed, the files of contexts whose buckets are full and that have
+nothing running are removed.
+
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+from .util import make_private_directory
+
+log = logging.getLogger("codejail")
+
+
+class QuotaExceeded(Exception):
+    """
+    An execution didn't run because its context was over one of its quotas.
+    """
+
+
+class TokenBucket:
+    """
+    Tokens that fill at `rate` a second, up to `capacity`, full at `now`.
+    """
+    def __init__(self, capacity, rate, now):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = now
+
+    def level(self, now):
+        """The number of tokens at `now`, a `time.monotonic` time."""
+        # The state may be from before the host restarted its clock.
+        self.tokens = min(self.capacity, self.tokens + max(now - self.updated, 0) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self, amount, now):
+        """Take `amount` tokens at `now`, even if that's more than there are."""
+        self.tokens = self.level(now) - amount
+
+    def state(self):
+        """The state of the bucket, for `from_state`."""
+        return [self.capacity, self.rate, self.tokens, self.updated]
+
+    @classmethod
+    def from_state(cls, state):
+        """Make a bucket from its `state`."""
+        capacity, rate, tokens, updated = state
+        bucket = cls(capacity, rate, updated)
+        bucket.tokens = tokens
+        return bucket
+
+
+class _Running:
+    """An execution counted by `Quotas.start`, to give to `Quotas.finish`."""
+    def __init__(self, key, slot):
+        self.key = key
+        # The file descriptor of the lock file held for the concurrency
+        # quota, or None.
+        self.slot = slot
+
+
+def _read_buckets(fd):
+    """Read the buckets in the state file `fd`, a dict of "cpu" and "executions"."""
+    data = os.pread(fd, 65536, 0)
+    if not data:
+        return {}
+    return {name: TokenBucket.from_state(state) for name, state in json.loads(data).items()}
+
+
+def _write_buckets(fd, buckets):
+    """Write `buckets` to the state file `fd`, leaving out the ones that are None."""
+    data = json.dumps({name: bucket.state() for name, bucket in buckets.items() if bucket is not None})
+    os.ftruncate(fd, 0)
+    os.pwrite(fd, data.encode("ascii"), 0)
+
+
+class Quotas:
+    """
+    The quotas of all the limit overrides contexts, shared by the processes on a host.
+    """
+    def __init__(self, window=60, directory=None):
+        """
+        `window` is the number of seconds the `"CPU_QUOTA"` limit is for.
+
+        The files are in `directory`, which is created if it doesn't exist,
+        and is by default "codejail-quotas" in the temp directory.  Every
+        process sharing the quotas must use the same directory and window.
+        Raises `PermissionError` unless the directory is owned by this user
+        with mode 0o700, so no one else can change the buckets or hold the
+        executions of a context.
+
+        """
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(), "codejail-quotas")
+        make_private_directory(directory)
+        self.directory = directory
+        self.window = window
+        # The number of executions rejected with `QuotaExceeded`.
+        self.rejections = 0
+        self._swept = time.monotonic()
+
+    @staticmethod
+    def _key(context):
+        """The name of the files of `context`."""
+        return hashlib.sha256(repr(context).encode("utf-8")).hexdigest()[:32]
+
+    @contextlib.contextmanager
+    def _locked_state(self, key):
+        """Lock the state file of `key`, and yield its file descriptor."""
+        path = os.path.join(self.directory, key + ".quota")
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if os.fstat(fd).st_nlink:
+                    break
+            except BaseException:
+                os.close(fd)
+                raise
+            # The file was removed while we waited for the lock.
+            os.close(fd)
+        try:
+            yield fd
+        finally:
+            os.close(fd)
+
+    def _take_slot(self, key, concurrency):
+        """Lock one of the `concurrency` lock files of `key`, and return its fd, or None if they're all locked."""
+        for i in range(concurrency):
+            path = os.path.join(self.directory, "%s.run-%d" % (key, i))
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            except BaseException:
+                os.close(fd)
+                raise
+            return fd
+        return None
+
+    def _buckets(self, fd, cpu, rate, now):
+        """The buckets in the state file `fd`, for the current limits."""
+        buckets = _read_buckets(fd)
+        bucket = buckets.get("cpu")
+        if not cpu:
+            buckets["cpu"] = None
+        elif bucket is None or bucket.capacity != cpu:
+            buckets["cpu"] = TokenBucket(cpu, cpu / self.window, now)
+        bucket = buckets.get("executions")
+        if not rate:
+            buckets["executions"] = None
+        elif bucket is None or bucket.rate != rate:
+            buckets["executions"] = TokenBucket(max(rate, 1), rate, now)
+        return buckets
+
+    def start(self, context, limits, slug=None):
+        """
+        Count the start of an execution in `context`, whose effective limits are `limits`.
+
+        Raises `QuotaExceeded` if the context is over one of its quotas.
+        Returns None if the context has no quotas, or else an object to give
+        to `finish` when the execution is done.  `slug` is used in log
+        messages.
+
+        """
+        cpu = limits["CPU_QUOTA"]
+        rate = limits["RATE_QUOTA"]
+        concurrency = limits["CONCURRENCY_QUOTA"]
+        if not (cpu or rate or concurrency):
+            return None
+
+        now = time.monotonic()
+        if now - self._swept >= self.window:
+            self._swept = now
+            self.sweep()
+
+        key = self._key(context)
+        slot = None
+        with self._locked_state(key) as fd:
+            buckets = self._buckets(fd, cpu, rate, now)
+            executions = buckets["executions"]
+            if concurrency:
+                slot = self._take_slot(key, concurrency)
+            if concurrency and slot is None:
+                reason = "%d executions are already running" % concurrency
+            elif executions is not None and executions.level(now) < 1:
+                reason = "it can start %s executions a second" % rate
+            elif buckets["cpu"] is not None and buckets["cpu"].level(now) <= 0:
+                reason = "it can use %s CPU seconds in %s seconds" % (cpu, self.window)
+            else:
+                reason = None
+                if executions is not None:
+                    executions.take(1, now)
+            if reason is not None and slot is not None:
+                os.close(slot)
+            _write_buckets(fd, buckets)
+
+        if reason is not None:
+            self.rejections += 1
+            log.warning("Quota exceeded for %r in context %r: %s", slug, context, reason)
+            raise QuotaExceeded("Quota exceeded for context %r: %s" % (context, reason))
+        return _Running(key, slot)
+
+    def finish(self, running, cpu_seconds):
+        """Count the end of an execution, `running` from `start`, which used `cpu_seconds`."""
+        if running.slot is not None:
+            os.close(running.slot)
+        if not cpu_seconds:
+            return
+        with self._locked_state(running.key) as fd:
+            buckets = _read_buckets(fd)
+            if "cpu" in buckets:
+                buckets["cpu"].take(cpu_seconds, time.monotonic())
+                _write_buckets(fd, buckets)
+
+    def sweep(self):
+        """Remove the files of contexts whose buckets are full and that have nothing running."""
+        names = os.listdir(self.directory)
+        for name in names:
+            key, dot, suffix = name.partition(".")
+            if not dot or suffix != "quota":
+                continue
+            runs = [os.path.join(self.directory, run) for run in names if run.startswith(key + ".run-")]
+            with self._locked_state(key) as fd:
+                now = time.monotonic()
+                if any(bucket.level(now) < bucket.capacity for bucket in _read_buckets(fd).values()):
+                    continue
+                with contextlib.ExitStack() as stack:
+                    if all(self._lock_idle(run, stack) for run in runs):
+                        for path in runs + [os.path.join(self.directory, name)]:
+                            os.remove(path)
+
+    @staticmethod
+    def _lock_idle(path, stack):
+        """Lock the lock file at `path` until `stack` closes, and return whether no execution held it."""
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CLOEXEC)
+        except FileNotFoundError:
+            return False
+        stack.callback(os.close, fd)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
@@ -0,0 +1,213 @@
+"""
+Caches of `safe_exec` results, for code that always gives the same results.
+
+Pass a cache to `safe_exec` as its `cache` argument.  The result is then
+looked up by a key computed from everything that determines it: the code, the
+globals, the contents of the files and the Python path, the extra files, the
+effective limits, and the Python command.  On a hit, the stored globals are
+used, and no code is run.  Only successful executions are stored.
+
+Only use a cache for code that gives the same results whenever it's run with
+the same inputs.  For example, code that uses `random` is fine if it seeds the
+generator from its globals, but not otherwise.
+
+Two caches are provided: `MemoryResultCache` for one process, and
+`SQLiteResultCache`, which can be shared by processes on one machine.  Any
+object with the same `get` and `set` methods will work.
+
+"""
+
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import os.path
+import sqlite3
+import stat
+import threading
+import time
+
+
+def result_key(jail_code_kwargs, effective_limits, command_config):
+    """
+    Compute the cache key for a `safe_exec` execution.
+
+    `jail_code_kwargs` are the arguments that `safe_exec` passes to
+    `jail_code`: the program, its arguments and stdin (the code and globals),
+    the files, and the extra files.  `effective_limits` is the limits the code would run
+    with, and `command_config` is the configuration of the Python command.
+
+    """
+    digest = hashlib.sha256()
+    for part in (jail_code_kwargs["code"], jail_code_kwargs["stdin"]):
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(b"%d:" % len(part) + part)
+    digest.update(json.dumps(jail_code_kwargs["argv"]).encode("utf-8"))
+    for filename in jail_code_kwargs["files"]:
+        digest.update(os.path.basename(filename).encode("utf-8") + b"\0")
+        digest.update(_file_digest(filename))
+    for name, content in jail_code_kwargs["extra_files"]:
+        digest.update(b"%d:" % len(content) + name.encode("utf-8") + b"\0" + content)
+    digest.update(json.dumps([effective_limits, command_config], sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+# The digests of files and directories, keyed by their path and stat details,
+# so that each is only read again when it changes.
+_FILE_DIGESTS = {}
+_FILE_DIGESTS_LOCK = threading.Lock()
+_MAX_FILE_DIGESTS = 1000
+
+
+def _file_digest(path):
+    """The digest of the contents of the file or directory tree `path`."""
+    paths = [path]
+    if os.path.isdir(path) and not os.path.islink(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            paths.extend(os.path.join(dirpath, name) for name in sorted(dirnames + filenames))
+
+    signature = []
+    for one_path in paths:
+        st = os.lstat(one_path)
+        signature.append((one_path, st.st_mode, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns))
+    signature = tuple(signature)
+
+    with _FILE_DIGESTS_LOCK:
+        digest = _FILE_DIGESTS.get(signature)
+    if digest is not None:
+        return digest
+
+    hasher = hashlib.sha256()
+    for one_path, mode, *_ in signature:
+        hasher.update(os.path.relpath(one_path, path).encode("utf-8") + b"\0")
+        if stat.S_ISLNK(mode):
+            hasher.update(b"L" + os.readlink(one_path).encode("utf-8") + b"\0")
+        elif stat.S_ISREG(mode):
+            hasher.update(b"F")
+            with open(one_path, "rb") as f:
+                while chunk := f.read(1024 * 1024):
+                    hasher.update(chunk)
+        else:
+            hasher.update(b"D")
+    digest = hasher.digest()
+
+    with _FILE_DIGESTS_LOCK:
+        if len(_FILE_DIGESTS) >= _MAX_FILE_DIGESTS:
+            _FILE_DIGESTS.clear()
+        _FILE_DIGESTS[signature] = digest
+    return digest
+
+
+class MemoryResultCache:
+    """
+    A least-recently-used cache of results in this process's memory.
+    """
+    def __init__(self, max_entries=1000, ttl=300, max_bytes=64 * 1024 * 1024):
+        """
+        Keep at most `max_entries` results, each for at most `ttl` seconds.
+
+        The results together are at most `max_bytes` long, and a result
+        longer than that isn't stored at all.
+
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        # The total length of the results in `_entries`.
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get the result stored for `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store the result `value`, a bytestring, for `key`."""
+        with self._lock:
+            self._remove(key)
+            if len(value) > self.max_bytes:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._bytes += len(value)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        """Remove the result for `key`, if there is one.  The lock must be held."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[1])
+
+
+class SQLiteResultCache:
+    """
+    A least-recently-used cache of results in an SQLite database.
+
+    Several processes can use the same database file at once.
+
+    """
+    def __init__(self, path, max_entries=10000, ttl=3600):
+        """
+        Keep at most `max_entries` results in the database at `path`, each for
+        at most `ttl` seconds.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        with self._transaction() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, value BLOB, expires REAL, used REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Connect to the database, for one transaction."""
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        """Get the result stored for `key`, or None."""
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT value FROM results WHERE key = ? AND expires >= ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE results SET used = ? WHERE key = ?", (now, key))
+        return bytes(row[0])
+
+    def set(self, key, value):
+        """Store the result `value`, a bytestring, for `key`."""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, expires, used) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl, now),
+            )
+            conn.execute("DELETE FROM results WHERE expires < ?", (now,))
+            conn.execute(
+                "DELETE FROM results WHERE key IN "
+                "(SELECT key FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
@@ -1,5 +1,6 @@
 """Safe execution of untrusted Python code."""
 
+import functools
 import inspect
 import logging
 import os.path
@@ -7,15 +8,10 @@ import shutil
 import sys
 import textwrap
 
-from codejail import jail_code
+from codejail import jail_code, json_codec, result_cache
+from codejail.instrumentation import instrument
 from codejail.util import change_directory, temp_directory
 
-try:
-    import simplejson as json
-except ImportError:
-    import json
-
-
 log = logging.getLogger("codejail")
 
 
@@ -33,6 +29,26 @@ LOG_ALL_CODE = False
 ALWAYS_BE_UNSAFE = False
 
 
+# The name of the codec in `json_codec` used to pass the globals into and out
+# of the sandbox.
+JSON_CODEC = "simplejson"
+
+
+def configure_json_codec(name):
+    """
+    Configure `safe_exec` to pass globals with the `json_codec` codec `name`.
+
+    The codec is used both here and in the sandbox, but each side falls back to
+    "json" if the codec's package isn't installed there.  The globals are
+    JSON either way.
+
+    """
+    global JSON_CODEC  # pylint: disable=global-statement
+    if name not in json_codec.CODECS:
+        raise ValueError("Unknown JSON codec %r" % name)
+    JSON_CODEC = name
+
+
 class SafeExecException(Exception):
     """
     Python code running in the sandbox has failed.
@@ -40,7 +56,18 @@ class SafeExecException(Exception):
     The message will be the stdout of the sandboxed process, which will usually
     contain the original exception message.
 
+    If the code was profiled, `profile` is its profile, as for
+    `ExecutionInfo.profile`.
+
     """
+    profile = None
+
+
+# The most functions to report in a profile.
+PROFILE_ENTRIES = 50
+
+# What comes before the profile at the end of the stderr of profiled code.
+PROFILE_MARKER = b"\ncodejail-profile: "
 
 
 # pylint: disable=too-many-positional-arguments
@@ -52,6 +79,8 @@ def safe_exec(
         limit_overrides_context=None,
         slug=None,
         extra_files=None,
+        cache=None,
+        profile=False,
 ):
     """
     Execute code as "exec" does, but safely.
@@ -82,6 +111,19 @@ def safe_exec(
     temp directory and cleaned up automatically.  No subdirectories are
     supported in the filename.
 
+    `cache` is an optional cache of results, such as a
+    `result_cache.MemoryResultCache`.  If the same code has already been run
+    with the same globals, files, and limits, the stored result is used
+    instead of running the code again.  Only use a cache for code whose
+    results depend only on those inputs.
+
+    `profile` is whether to run the code under a profiler.  Code is also
+    profiled if the "PROFILE" limit is set for `limit_overrides_context`.  The
+    profile is logged, given to the post-execution hooks in
+    `instrumentation`, and attached to the `SafeExecException` if the code
+    fails, including when it reaches the CPU limit.  Profiled code doesn't use
+    the `cache`.
+
     Returns None.  Changes made by `code` are visible in `globals_dict`.  If
     the code raises an exception, this function will raise `SafeExecException`
     with the stderr of the sandbox process, which usually includes the original
@@ -102,23 +144,168 @@ def safe_exec(
     if not jail_code.is_configured('python'):
         raise RuntimeError("safe_exec has not been configured for Python")
 
-    the_code = []
+    profile = profile or jail_code.get_effective_limits(limit_overrides_context)["PROFILE"]
+    if profile:
+        # A stored result has no profile.
+        cache = None
+
+    with instrument("safe_exec", "python", slug, limit_overrides_context) as info:
+        with info.timings.phase("encode"):
+            kwargs = _jail_code_kwargs(code, globals_dict, files, python_path, extra_files, profile)
+        with info.timings.phase("cache"):
+            key = _cache_key(cache, kwargs, limit_overrides_context)
+            if _use_cached_result(cache, key, globals_dict, slug):
+                return
+
+        info.result = jail_code.jail_code(
+            "python",
+            limit_overrides_context=limit_overrides_context,
+            slug=slug,
+            **kwargs
+        )
+        _finish(info, globals_dict, cache, key, profile)
+
+
+# pylint: disable=too-many-positional-arguments
+async def async_safe_exec(
+        code,
+        globals_dict,
+        files=None,
+        python_path=None,
+        limit_overrides_context=None,
+        slug=None,
+        extra_files=None,
+        cache=None,
+        profile=False,
+):
+    """
+    Execute code as "exec" does, but safely, as a coroutine.
+
+    The arguments, results, and exceptions are the same as for `safe_exec`.
+    The code is run with `jail_code.async_jail_code`, so cancelling the
+    coroutine kills the sandboxed process.
 
+    """
+    if ALWAYS_BE_UNSAFE:
+        not_safe_exec(
+            code,
+            globals_dict,
+            files=files,
+            python_path=python_path,
+            limit_overrides_context=limit_overrides_context,
+            slug=slug,
+            extra_files=extra_files,
+        )
+        return
+
+    if not jail_code.is_configured('python'):
+        raise RuntimeError("safe_exec has not been configured for Python")
+
+    profile = profile or jail_code.get_effective_limits(limit_overrides_context)["PROFILE"]
+    if profile:
+        # A stored result has no profile.
+        cache = None
+
+    with instrument("safe_exec", "python", slug, limit_overrides_context) as info:
+        with info.timings.phase("encode"):
+            kwargs = _jail_code_kwargs(code, globals_dict, files, python_path, extra_files, profile)
+        with info.timings.phase("cache"):
+            key = _cache_key(cache, kwargs, limit_overrides_context)
+            if _use_cached_result(cache, key, globals_dict, slug):
+                return
+
+        info.result = await jail_code.async_jail_code(
+            "python",
+            limit_overrides_context=limit_overrides_context,
+            slug=slug,
+            **kwargs
+        )
+        _finish(info, globals_dict, cache, key, profile)
+
+
+# pylint: disable=too-many-positional-arguments
+def _jail_code_kwargs(code, globals_dict, files, python_path, extra_files, profile):
+    """
+    Make the `jail_code` arguments to run `code` with `globals_dict`.
+
+    The arguments are as for `safe_exec`.  Returns a dict of keyword
+    arguments for `jail_code`: the program that runs the code, its arguments
+    and stdin, and the files it needs.
+
+    """
     files = list(files or ())
     extra_files = extra_files or ()
     python_path = python_path or ()
 
     extra_names = {name for name, contents in extra_files}
 
+    # The Python path entries are given to the program as arguments.
+    argv = []
+    for pydir in python_path:
+        pybase = os.path.basename(pydir)
+        argv.append(pybase)
+        if pybase not in extra_names:
+            files.append(pydir)
+
+    _, _, dumps = json_codec.get_codec(JSON_CODEC)
+    stdin = dumps([code, json_safe(globals_dict)])
+    jailed_code = _bootstrap_code(JSON_CODEC, bool(profile))
+
+    # Turn this on to see what's being executed.
+    if LOG_ALL_CODE:        # pragma: no cover
+        log.debug("Jailed code: %s", jailed_code)
+        log.debug("Exec: %s", code)
+        log.debug("Stdin: %s", stdin)
+
+    return {
+        "code": jailed_code,
+        "argv": argv,
+        "stdin": stdin,
+        "files": files,
+        "extra_files": extra_files,
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _bootstrap_code(codec_name, profile):
+    """
+    The program that runs code in the sandbox for `safe_exec`.
+
+    It's the same for every execution with the same codec, so it's only built
+    once for each.  It reads the code and the globals from its stdin, adds its
+    arguments to `sys.path`, and writes the resulting globals to its stdout,
+    using the `json_codec` codec `codec_name` if it's installed in the
+    sandbox, or "json" if not.
+
+    If `profile` is true, the code is run under cProfile, and the profile is
+    written at the end of the stderr, after `PROFILE_MARKER`, when the program
+    exits or reaches its CPU limit.
+
+    """
+    the_code = []
+
     the_code.append(textwrap.dedent(
         """
         import sys
         import six
-        try:
-            import simplejson as json
-        except ImportError:
-            import json
-        """
+        """))
+
+    the_code.append(inspect.getsource(json_codec.load_json))
+    if codec_name != "json":
+        loader = json_codec.CODECS[codec_name]
+        the_code.append(inspect.getsource(loader))
+        the_code.append(textwrap.dedent(
+            """
+            try:
+                loads, dumps = {loader}()
+            except ImportError:
+                loads, dumps = load_json()
+            """.format(loader=loader.__name__)))
+    else:
+        the_code.append("loads, dumps = load_json()\n")
+
+    the_code.append(textwrap.dedent(
+        ""
         # We need to prevent the sandboxed code from printing to stdout,
         # or it will pollute the json we print there.  This isn't a
         # security concern (they can put any values in the json output
@@ -135,20 +322,65 @@ def safe_exec(
         """
         # Read the code and the globals from the stdin.
         """
-        code, g_dict = json.load(sys.stdin)
-        """))
-
-    for pydir in python_path:
-        pybase = os.path.basename(pydir)
-        the_code.append("sys.path.append(%r)\n" % pybase)
-        if pybase not in extra_names:
-            files.append(pydir)
-
-    the_code.append(textwrap.dedent(
-        # Execute the sandboxed code.
+        code, g_dict = loads(sys.stdin.buffer.read())
         """
-        exec(code, g_dict)
-        """))
+        # The Python path entries are our arguments.
+        """
+        sys.path.extend(sys.argv[1:])
+        """
+        ))
+
+    if profile:
+        the_code.append(textwrap.dedent(
+            """
+            import atexit
+            import cProfile
+            import os
+            import signal
+
+            profiler = cProfile.Profile()
+
+            def write_profile():
+                profiler.disable()
+                profiler.create_stats()
+                rows = []
+                for (filename, line, name), stats in profiler.stats.items():
+                    primitive_calls, calls, total_time, cumulative_time, _ = stats
+                    rows.append({{
+                        "function": "%s:%d(%s)" % (filename, line, name),
+                        "calls": calls,
+                        "primitive_calls": primitive_calls,
+                        "total_time": total_time,
+                        "cumulative_time": cumulative_time,
+                    }})
+                rows.sort(key=lambda row: row["total_time"], reverse=True)
+                sys.__stderr__.flush()
+                sys.__stderr__.buffer.write({marker!r} + dumps(rows[:{entries}]))
+                sys.__stderr__.flush()
+
+            def write_profile_at_cpu_limit(signum, frame):
+                write_profile()
+                signal.signal(signal.SIGXCPU, signal.SIG_DFL)
+                os.kill(os.getpid(), signal.SIGXCPU)
+
+            atexit.register(write_profile)
+            signal.signal(signal.SIGXCPU, write_profile_at_cpu_limit)
+            """.format(marker=PROFILE_MARKER, entries=PROFILE_ENTRIES)))
+        the_code.append(textwrap.dedent(
+            # Execute the sandboxed code, with the profiler running.
+            """
+            profiler.enable()
+            try:
+                exec(code, g_dict)
+            finally:
+                profiler.disable()
+            """))
+    else:
+        the_code.append(textwrap.dedent(
+            # Execute the sandboxed code.
+            """
+            exec(code, g_dict)
+            """))
 
     the_code.append(inspect.getsource(json_safe))
 
@@ -158,35 +390,131 @@ def safe_exec(
         """
         # Write the globals back to the calling process.
         """
-        json.dump(g_dict, sys.__stdout__)
+        sys.__stdout__.flush()
+        sys.__stdout__.buffer.write(dumps(g_dict))
         """))
 
-    stdin = json.dumps([code, json_safe(globals_dict)])
-    jailed_code = "".join(the_code)
+    return "".join(the_code)
 
-    # Turn this on to see what's being executed.
-    if LOG_ALL_CODE:        # pragma: no cover
-        log.debug("Jailed code: %s", jailed_code)
-        log.debug("Exec: %s", code)
-        log.debug("Stdin: %s", stdin)
 
-    res = jail_code.jail_code(
-        "python", code=jailed_code, stdin=stdin, files=files,
-        limit_overrides_context=limit_overrides_context,
-        slug=slug, extra_files=extra_files,
+def _cache_key(cache, jail_code_kwargs, limit_overrides_context):
+    """The key for an execution in `cache`, or None if there's no cache."""
+    if cache is None:
+        return None
+    return result_cache.result_key(
+        jail_code_kwargs,
+        jail_code.get_effective_limits(limit_overrides_context),
+        jail_code.COMMANDS["python"],
     )
 
+
+def _use_cached_result(cache, key, globals_dict, slug):
+    """
+    Update `globals_dict` from the result stored in `cache` for `key`, if any.
+
+    Returns whether there was a stored result.
+
+    """
+    if cache is None:
+        return False
+    stdout = cache.get(key)
+    if stdout is None:
+        return False
+    if slug:
+        log.info("Using cached result for jailed code %s", slug)
+    _, loads, _ = json_codec.get_codec(JSON_CODEC)
+    globals_dict.update(loads(stdout))
+    return True
+
+
+# pylint: disable=too-many-positional-arguments
+def _finish(info, globals_dict, cache, key, profile):
+    """
+    Finish a `safe_exec` execution, whose `jail_code` result is `info.result`.
+
+    Updates `globals_dict` from the result, stores the result in `cache` as
+    `key`, and records the timings of the `jail_code` execution in `info`.
+    If the code was profiled (`profile` is true), its profile is taken from
+    the result, and recorded in `info`.
+
+    """
+    info.timings.add_all(info.result.timings.phases)
+    with info.timings.phase("decode"):
+        if profile:
+            info.profile = _take_profile(info.result)
+            _log_profile(info.profile, info.slug)
+        _update_globals(info.result, globals_dict, info.profile)
+    if cache is not None:
+        with info.timings.phase("cache"):
+            cache.set(key, info.result.stdout)
+
+
+def _take_profile(res):
+    """
+    Remove the profile from the end of the stderr of `res`, and return it.
+
+    Returns None if there is no profile, for example if the process was
+    killed, or its stderr was cut off.
+
+    """
+    stderr, marker, profile = res.stderr.rpartition(PROFILE_MARKER)
+    if not marker:
+        return None
+    _, loads, _ = json_codec.get_codec(JSON_CODEC)
+    try:
+        profile = loads(profile)
+    except ValueError:
+        return None
+    res.stderr = stderr
+    return profile
+
+
+def _log_profile(profile, slug):
+    """Log the functions that took the most time in `profile`."""
+    if profile is None:
+        log.info("No profile for jailed code %s", slug)
+        return
+    log.info(
+        "Profile of jailed code %s: %s",
+        slug,
+        "; ".join(
+            "{function}: {total_time:.3f}s in {calls} calls".format(**row)
+            for row in profile[:10]
+        ),
+    )
+
+
+def _update_globals(res, globals_dict, profile=None):
+    """
+    Update `globals_dict` from `res`, the result of a `safe_exec` execution.
+
+    Raises `SafeExecException` if the execution failed, with `profile` as its
+    profile.
+
+    """
     if LOG_ALL_CODE:
         log.debug("Status: %s", res.status)
         log.debug("Stdout: %s", res.stdout)
         log.debug("Stderr: %s", res.stderr)
 
+    if res.stdout_truncated:
+        # Whether or not the process was killed for it, the globals can't be
+        # read from the part of the output that was kept.
+        exc = SafeExecException((
+            "Couldn't execute jailed code: stdout was cut off at the STDOUT limit of "
+            "{size} bytes, stderr: {res.stderr!r} with status code: {res.status}"
+        ).format(size=len(res.stdout), res=res))
+        exc.profile = profile
+        raise exc
     if res.status != 0:
-        raise SafeExecException((
+        exc = SafeExecException((
             "Couldn't execute jailed code: stdout: {res.stdout!r}, "
             "stderr: {res.stderr!r} with status code: {res.status}"
         ).format(res=res))
-    globals_dict.update(json.loads(res.stdout.decode('utf-8')))
+        exc.profile = profile
+        raise exc
+    _, loads, _ = json_codec.get_codec(JSON_CODEC)
+    globals_dict.update(loads(res.stdout))
 
 
 def json_safe(d):
@@ -195,42 +523,93 @@ def json_safe(d):
 
     Used to emulate reading data through a serialization straw.
 
+    The dict is walked once, and the result has only the types JSON can
+    represent, converted as a JSON round trip would convert them: tuples
+    become lists, dict keys become strings, and byte strings are decoded as
+    UTF-8.  Pairs of surrogate characters in strings are joined into one
+    character, as JSON would decode them.  Entries that JSON couldn't
+    represent are dropped: those with other types, byte strings that aren't
+    UTF-8, strings with unpaired surrogates (which can't be encoded as UTF-8),
+    and circular references.
+
+    This function is also run in the sandbox, so it must not use anything
+    outside of itself.
+
     """
     # pylint: disable=invalid-name
+    import re  # pylint: disable=import-outside-toplevel
 
-    # six.binary_type is here because bytes are sometimes ok if they represent valid utf8
-    # so we consider them valid for now and try to decode them with decode_object.  If that
-    # doesn't work they'll get dropped later in the process.
+    # bytes are here because bytes are sometimes ok if they represent valid utf8
+    # so we consider them valid for now and try to decode them.  If that
+    # doesn't work they'll get dropped.
     ok_types = (type(None), int, float, bytes, str, list, tuple, dict)
 
-    def decode_object(obj):
+    surrogates = re.compile("[\ud800-\udfff]")
+
+    def check_str(s):
+        """Return `s` as a plain str, if it can be encoded as UTF-8."""
+        s = str.__str__(s)
+        if surrogates.search(s):
+            # Join the pairs of surrogates.  An unpaired one raises
+            # UnicodeDecodeError.
+            s = s.encode("utf-16-le", "surrogatepass").decode("utf-16-le")
+        return s
+
+    def float_key(f):
+        """The string JSON uses for the float `f` as a key."""
+        if f != f:  # pylint: disable=comparison-with-itself
+            return "NaN"
+        if f in (float("inf"), float("-inf")):
+            return "Infinity" if f > 0 else "-Infinity"
+        return float.__repr__(f)
+
+    def convert_key(k):
+        """Convert a dict key as JSON would, or raise an exception."""
+        if isinstance(k, str):
+            return check_str(k)
+        if isinstance(k, bytes):
+            return check_str(k.decode('utf-8'))
+        if k is True:
+            return "true"
+        if k is False:
+            return "false"
+        if k is None:
+            return "null"
+        if isinstance(k, int):
+            return int.__repr__(k)
+        if isinstance(k, float):
+            return float_key(k)
+        raise TypeError("Can't use %r as a key" % type(k))
+
+    def convert(obj, active):
         """
-        Convert an object to a JSON serializable form by decoding all byte strings.
-
-        In particular if we find any byte strings try to convert them to
-        utf-8 strings.  If we run into byte strings that can't be decoded as utf8 strings
-        throw an exception.
+        Convert a value as a JSON round trip would, or raise an exception.
 
-        For other non-serializable objects we return them as is.
+        `active` is the set of ids of the containers being converted, to
+        detect circular references.
 
-        raises: Exception
         """
+        if isinstance(obj, str):
+            return check_str(obj)
+        if obj is None or obj is True or obj is False:
+            return obj
+        if isinstance(obj, int):
+            return int(obj)
+        if isinstance(obj, float):
+            return float(obj)
         if isinstance(obj, bytes):
-            return obj.decode('utf-8')
-        if isinstance(obj, (list, tuple)):
-            new_list = []
-            for i in obj:
-                new_obj = decode_object(i)
-                new_list.append(new_obj)
-            return new_list
-        if isinstance(obj, dict):
-            new_dict = {}
-            for k, v in obj.items():
-                new_key = decode_object(k)
-                new_value = decode_object(v)
-                new_dict[new_key] = new_value
-            return new_dict
-        return obj
+            return check_str(obj.decode('utf-8'))
+        if isinstance(obj, (list, tuple, dict)):
+            if id(obj) in active:
+                raise ValueError("Circular reference")
+            active.add(id(obj))
+            if isinstance(obj, dict):
+                new_obj = {convert_key(k): convert(v, active) for k, v in obj.items()}
+            else:
+                new_obj = [convert(v, active) for v in obj]
+            active.discard(id(obj))
+            return new_obj
+        raise TypeError("Can't convert %r" % type(obj))
 
     bad_keys = ("__builtins__",)
     jd = {}
@@ -240,20 +619,12 @@ def json_safe(d):
         if k in bad_keys:
             continue
         try:
-            # Python's JSON encoder will produce output that
-            # the JSON decoder cannot parse if the input string
-            # contains unicode "unpaired surrogates" (only on Linux)
-            # To test for this, we try decoding the output and check
-            # for a ValueError
-            v = json.loads(json.dumps(decode_object(v)))
-
-            # Also ensure that the keys encode/decode correctly
-            k = json.loads(json.dumps(decode_object(k)))
+            v = convert(v, set())
+            k = convert_key(k)
         except Exception:  # pylint: disable=broad-except
             continue
-        else:
-            jd[k] = v
-    return json.loads(json.dumps(jd))
+        jd[k] = v
+    return jd
 
 
 # pylint: disable=too-many-positional-arguments
@@ -0,0 +1,197 @@
+"""
+Scheduling of executions by priority and fair share, across limit contexts.
+
+A `Scheduler` runs at most a number of executions at once in this process.
+When they're all in use, executions wait, and the next one to run is chosen:
+
+* First by priority: an execution whose context has a higher `"PRIORITY"`
+  limit always runs before one with a lower priority.
+
+* Then by fair share among the contexts of the same priority, in proportion
+  to their `"WEIGHT"` limits, with start-time fair queuing.  Each context has
+  a virtual time that advances by 1 / weight for each of its executions, and
+  the waiting execution with the earliest virtual start time runs first.  So
+  a context with a weight of 2 starts twice as many executions as one with a
+  weight of 1 when both are busy, and a context that has been idle doesn't
+  get to catch up on the time it didn't use.
+
+For instance, with a low priority or weight for the context of bulk regrades,
+interactive submissions don't wait behind a long queue of regrades, but the
+regrades still use whatever capacity is spare.
+
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+
+from .admission import Overloaded
+
+log = logging.getLogger("codejail")
+
+
+class _Waiter:
+    """An execution waiting for a slot."""
+    def __init__(self, priority, start, seq, wake):
+        self.priority = priority
+        self.start = start
+        self.seq = seq
+        self.wake = wake
+        self.granted = False
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (-self.priority, self.start, self.seq) < (-other.priority, other.start, other.seq)
+
+
+class Scheduler:
+    """
+    Runs `slots` executions at once, choosing which waits by priority and fair share.
+    """
+    def __init__(self, slots, timeout=None):
+        """
+        `timeout` is how many seconds an execution can wait for a slot before
+        `admission.Overloaded` is raised, or None to wait as long as it takes.
+        """
+        self.slots = slots
+        self.timeout = timeout
+        # The number of executions that had to wait for a slot.
+        self.waits = 0
+        # The number of executions that failed with `Overloaded`.
+        self.rejections = 0
+        self._lock = threading.Lock()
+        self._running = 0
+        self._waiting = []
+        self._seq = itertools.count()
+        # The virtual time: the latest start time of the executions that have
+        # run, or when none are running or waiting, the latest finish time.
+        self._vtime = 0.0
+        self._max_finish = 0.0
+        # A map from contexts to the virtual time their next execution starts,
+        # for those whose next execution wouldn't start at the virtual time.
+        self._finish = {}
+        # The entries made in `_finish`, as a heap of (finish, seq, context).
+        self._finish_heap = []
+
+    @property
+    def running(self):
+        """The number of executions holding slots."""
+        return self._running
+
+    @property
+    def waiting(self):
+        """The number of executions waiting for slots."""
+        return sum(1 for waiter in self._waiting if not waiter.cancelled)
+
+    def _enqueue(self, context, priority, weight, wake):
+        """
+        Take a slot, or queue a `_Waiter` for one.
+
+        Returns None if a slot was taken, or the waiter, on which `wake` is
+        called once it has a slot.  Raises `ValueError` if `weight` isn't
+        more than 0.
+
+        """
+        if not weight > 0:
+            raise ValueError("WEIGHT must be more than 0, not %r" % (weight,))
+        with self._lock:
+            start = max(self._vtime, self._finish.get(context, 0.0))
+            finish = start + 1.0 / weight
+            self._finish[context] = finish
+            self._max_finish = max(self._max_finish, finish)
+            heapq.heappush(self._finish_heap, (finish, next(self._seq), context))
+            waiter = _Waiter(priority, start, next(self._seq), wake)
+            heapq.heappush(self._waiting, waiter)
+            self._grant()
+            if waiter.granted:
+                return None
+            self.waits += 1
+            return waiter
+
+    def _grant(self):
+        """Give free slots to waiters, in order.  The lock must be held."""
+        while self._running < self.slots and self._waiting:
+            waiter = heapq.heappop(self._waiting)
+            if waiter.cancelled:
+                continue
+            self._running += 1
+            self._vtime = max(self._vtime, waiter.start)
+            waiter.granted = True
+            waiter.wake()
+        if not self._running and not self._waiting:
+            # Idle, so every context starts afresh.
+            self._vtime = self._max_finish
+        self._forget_finished()
+
+    def _forget_finished(self):
+        """
+        Remove the `_finish` entries at or before the virtual time.  The lock must be held.
+
+        The next execution of those contexts starts at the virtual time anyway,
+        and the virtual time doesn't go back, so they're no longer needed.
+
+        """
+        heap = self._finish_heap
+        while heap and heap[0][0] <= self._vtime:
+            finish, _, context = heapq.heappop(heap)
+            if self._finish.get(context) == finish:
+                del self._finish[context]
+
+    def _give_up(self, waiter):
+        """Stop `waiter` waiting, because it timed out or was cancelled."""
+        with self._lock:
+            if waiter.granted:
+                # The slot came just too late, so pass it on.
+                self._running -= 1
+            else:
+                waiter.cancelled = True
+            self._grant()
+
+    def _overloaded(self, waiter, slug):
+        """Give up on `waiter`, and return the `Overloaded` error for it."""
+        self._give_up(waiter)
+        self.rejections += 1
+        log.warning("CodeJail scheduler: no slot free for %r after %s seconds", slug, self.timeout)
+        return Overloaded("Too many executions are waiting: no slot was free for %s seconds" % self.timeout)
+
+    def acquire(self, context=None, priority=0, weight=1, slug=None):
+        """
+        Take a slot for an execution in `context`, waiting for one if needed.
+
+        `priority` and `weight` are the context's `"PRIORITY"` and `"WEIGHT"`
+        limits; `weight` must be more than 0.  The slot must be given back
+        with `release`.  Raises `admission.Overloaded` if the timeout passes
+        first.  `slug` is used in log messages.
+
+        """
+        event = threading.Event()
+        waiter = self._enqueue(context, priority, weight, event.set)
+        if waiter is not None and not event.wait(self.timeout):
+            raise self._overloaded(waiter, slug)
+
+    async def async_acquire(self, context=None, priority=0, weight=1, slug=None):
+        """Like `acquire`, but waits without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = self._enqueue(context, priority, weight, wake)
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(granted, self.timeout)
+        except asyncio.TimeoutError:
+            raise self._overloaded(waiter, slug) from None
+        except asyncio.CancelledError:
+            self._give_up(waiter)
+            raise
+
+    def release(self):
+        """Give back a slot from `acquire`, to the next waiter if there is one."""
+        with self._lock:
+            self._running -= 1
+            self._grant()
@@ -0,0 +1,143 @@
+"""
+A CodeJail execution server, for `backends.RemoteBackend` clients.
+
+The server accepts TCP connections, and runs each execution it's sent with
+`jail_code.jail_code` on this host, with this process's configuration: its
+commands, limits, admission control, cgroups, and so on.  Each connection is
+handled in a thread of its own, and can carry any number of executions, one
+after another.
+
+The messages are framed as for the proxy process (see `proxy.py`).  When a
+client connects, the server sends a hello message with
+`backends.PROTOCOL_VERSION`.  Then each request's header has the arguments
+for `jail_code`, including the limits of the execution, and its blobs are a
+tar archive of the files, the stdin, and the contents of the extra files.  The response's header has the status, the
+truncation flags, and the rusage of the execution, with the stdout and stderr
+as blobs, or an "error" ("overloaded", "quota", or "error") and a "message".
+
+Run a server with::
+
+    python -m codejail.server --host 10.0.0.5 --port 7870 --python /sandbox/bin/python --user sandbox
+
+The server runs whatever code it's sent, in the sandbox, so it must only be
+reachable from the hosts that are allowed to run code.
+
+"""
+
+import argparse
+import logging
+import socket
+import socketserver
+import sys
+import tempfile
+
+from . import jail_code
+from .admission import Overloaded
+from .backends import PROTOCOL_VERSION, unpack_files
+from .proxy import read_message, write_message
+from .quotas import QuotaExceeded
+
+log = logging.getLogger("codejail")
+
+
+def execute(header, blobs):
+    """
+    Run the execution requested by the message `header` and `blobs`.
+
+    Returns the response's header and blobs.
+
+    """
+    files_tar, stdin, *extra_contents = blobs
+    with tempfile.TemporaryDirectory(prefix="codejail-files-") as files_dir:
+        try:
+            files = unpack_files(files_tar, files_dir) if header["files"] else None
+            result = jail_code.jail_code(
+                header["command"],
+                code=header["code"],
+                files=files,
+                extra_files=list(zip(header["extra_files"], extra_contents)),
+                argv=header["argv"],
+                stdin=stdin if header["stdin"] else None,
+                limit_overrides_context=header["limit_overrides_context"],
+                slug=header["slug"],
+                limits=header["limits"],
+            )
+        except Overloaded as exc:
+            return {"error": "overloaded", "message": str(exc)}, []
+        except QuotaExceeded as exc:
+            return {"error": "quota", "message": str(exc)}, []
+        except Exception as exc:  # pylint: disable=broad-except
+            log.exception("Execution server couldn't run %r", header.get("slug"))
+            return {"error": "error", "message": "%s: %s" % (type(exc).__name__, exc)}, []
+
+    response = {
+        "status": result.status,
+        "stdout_truncated": result.stdout_truncated,
+        "stderr_truncated": result.stderr_truncated,
+        "rusage": result.rusage,
+    }
+    return response, [result.stdout, result.stderr]
+
+
+class _ExecutionHandler(socketserver.StreamRequestHandler):
+    """Handles the requests on one connection."""
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        write_message(self.wfile, {"protocol": PROTOCOL_VERSION})
+        while True:
+            request = read_message(self.rfile)
+            if request is None:
+                return
+            header, blobs = request
+            write_message(self.wfile, *execute(header, blobs))
+
+
+class ExecutionServer(socketserver.ThreadingTCPServer):
+    """
+    An execution server listening on `address`, a (host, port) pair.
+
+    Use `serve_forever` to run it.  Executions run on this host, so the
+    process mustn't have a backend configured with `jail_code.configure_backend`.
+
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, _ExecutionHandler)
+
+
+def main(argv=None):
+    """
+    The main program for an execution server.
+    """
+    parser = argparse.ArgumentParser(prog="python -m codejail.server", description="Run a CodeJail execution server.")
+    parser.add_argument("--host", default="127.0.0.1", help="the address to listen on")
+    parser.add_argument("--port", type=int, default=0, help="the port to listen on, by default any free one")
+    parser.add_argument("--python", help="the sandbox's Python, if it isn't configured otherwise")
+    parser.add_argument("--user", help="the user to run the sandbox's Python as")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.python:
+        jail_code.configure("python", args.python, user=args.user)
+    if not jail_code.is_configured("python"):
+        log.warning("Python isn't configured for this execution server")
+
+    with ExecutionServer((args.host, args.port)) as server:
+        host, port = server.server_address[:2]
+        # Print where we're listening, for whoever started us.
+        print("Listening on %s:%d" % (host, port), flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""
+A cache of the files that `jail_code` copies into each execution's directory.
+
+Without a cache, every file and directory in `files` is copied for every
+execution.  With one, each distinct file or tree is copied once into the
+cache, made read-only, and then hard-linked into each execution's directory,
+which takes a fraction of the time and no extra space.
+
+Cache entries are keyed by the path of the source and the `stat` details of
+everything in it, so a source that changes gets a new entry.  The cache is
+limited in size, and the least recently used entries are removed to stay under
+the limit.  Several processes can share one cache directory.
+
+"""
+
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import stat
+import tempfile
+import time
+
+from .util import make_private_directory
+
+log = logging.getLogger("codejail")
+
+# Partially-populated entries older than this (in seconds) were abandoned.
+STALE_TEMP_AGE = 60 * 60
+
+
+class StagingCache:
+    """
+    A directory of read-only copies of files and directory trees.
+    """
+    def __init__(self, cache_dir, max_size):
+        """
+        Use `cache_dir` as a cache of no more than `max_size` bytes.
+
+        `cache_dir` is created if it doesn't exist.  It must be on the same
+        filesystem as the temp directory, so that files can be hard-linked from
+        it; if not, files are copied as if there were no cache.  It must be
+        owned by this user, with mode 0o700, so no one else can put files in
+        it: if not, the cache isn't used, and files are always copied.
+
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        try:
+            make_private_directory(cache_dir)
+        except PermissionError:
+            log.exception("Can't use %s as the staging cache, copying files instead", cache_dir)
+            self.cache_dir = None
+
+    def stage(self, source, dest):
+        """
+        Put a copy of the file or directory `source` at `dest`.
+
+        The copy is made of hard links to files in the cache, so it must not
+        be changed.
+
+        """
+        if self.cache_dir is None:
+            _copy_tree(source, dest)
+            return
+        key, size = self._signature(source)
+        entry = os.path.join(self.cache_dir, "%s-%d" % (key, size))
+        if os.path.isdir(entry):
+            # Mark the entry as recently used.
+            os.utime(entry)
+        else:
+            self._populate(source, entry)
+            self._evict(keep=entry)
+
+        try:
+            _link_tree(os.path.join(entry, "content"), dest)
+        except OSError:
+            # The entry was evicted while we were using it, or the cache is on
+            # a different filesystem.
+            log.exception("Couldn't link %s from the staging cache, copying instead", source)
+            _remove(dest)
+            _copy_tree(source, dest)
+
+    def _signature(self, source):
+        """
+        Compute a key for the current contents of `source`.
+
+        Returns the key, a string, and the total size of the files in `source`.
+
+        """
+        digest = hashlib.sha256(os.path.abspath(source).encode("utf-8"))
+        size = 0
+        for path in _walk(source):
+            st = os.lstat(path)
+            details = [
+                os.path.relpath(path, source),
+                st.st_mode, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns,
+            ]
+            if stat.S_ISLNK(st.st_mode):
+                details.append(os.readlink(path))
+            elif stat.S_ISREG(st.st_mode):
+                size += st.st_size
+            digest.update(repr(details).encode("utf-8"))
+        return digest.hexdigest()[:32], size
+
+    def _populate(self, source, entry):
+        """
+        Copy `source` into the cache as `entry`.
+
+        The copy is made in a temporary directory, and renamed into place, so
+        that other processes never see a partial entry.
+
+        """
+        temp_dir = tempfile.mkdtemp(prefix="tmp-", dir=self.cache_dir)
+        try:
+            content = os.path.join(temp_dir, "content")
+            _copy_tree(source, content)
+            for path in _walk(content):
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode):
+                    # Read-only for everyone, keeping any execute permission.
+                    os.chmod(path, (stat.S_IMODE(st.st_mode) & 0o555) | 0o444)
+                elif stat.S_ISDIR(st.st_mode):
+                    os.chmod(path, 0o755)
+            os.chmod(temp_dir, 0o755)
+            try:
+                os.rename(temp_dir, entry)
+            except OSError:
+                # Another process populated the entry first.
+                if not os.path.isdir(entry):
+                    raise
+        finally:
+            _remove(temp_dir)
+
+    def _evict(self, keep):
+        """
+        Remove the least recently used entries until the cache fits its size.
+
+        The entry `keep` is never removed.
+
+        """
+        entries = []
+        total = 0
+        now = time.time()
+        with os.scandir(self.cache_dir) as scan:
+            for dir_entry in scan:
+                try:
+                    mtime = dir_entry.stat(follow_symlinks=False).st_mtime
+                except FileNotFoundError:
+                    continue
+                if dir_entry.name.startswith("tmp-"):
+                    if now - mtime > STALE_TEMP_AGE:
+                        _remove(dir_entry.path)
+                    continue
+                size = int(dir_entry.name.rpartition("-")[2])
+                total += size
+                if dir_entry.path != keep:
+                    entries.append((mtime, size, dir_entry.path))
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            # Rename it first, so no one else starts using it.
+            temp_dir = tempfile.mkdtemp(prefix="tmp-", dir=self.cache_dir)
+            try:
+                os.rename(path, os.path.join(temp_dir, "evicted"))
+            except OSError:
+                # Another process evicted it.
+                continue
+            finally:
+                _remove(temp_dir)
+            total -= size
+
+
+def _walk(source):
+    """Yield the paths of `source` and everything under it, not following symlinks."""
+    yield source
+    if os.path.isdir(source) and not os.path.islink(source):
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            for name in sorted(dirnames + filenames):
+                yield os.path.join(dirpath, name)
+
+
+def _copy_tree(source, dest):
+    """Copy the file or directory `source` to `dest`, as `jail_code` always has."""
+    if os.path.isdir(source):
+        shutil.copytree(source, dest, symlinks=True)
+    else:
+        shutil.copy(source, dest)
+
+
+def _link_tree(source, dest):
+    """Make `dest` a copy of `source` made of hard links to its files."""
+    if os.path.isdir(source):
+        shutil.copytree(source, dest, symlinks=True, copy_function=os.link)
+    else:
+        os.link(source, dest)
+
+
+def _remove(path):
+    """Remove the file or directory `path`, if it exists."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
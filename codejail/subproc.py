@@ -1,20 +1,42 @@
 """Subprocess helpers for CodeJail."""
 
+import asyncio
 import functools
+import heapq
+import itertools
 import logging
 import os
 import resource
+import select
+import selectors
 import subprocess
+import sys
 import threading
 import time
 
 log = logging.getLogger("codejail")
 
+# The path of the `prlimit` program, to start processes with instead of
+# running `set_process_limits` in the forked child, or None.
+PRLIMIT = None
+
+# The `prlimit` options for the resource limits it can set.
+PRLIMIT_OPTIONS = {
+    resource.RLIMIT_AS: "--as",
+    resource.RLIMIT_CORE: "--core",
+    resource.RLIMIT_CPU: "--cpu",
+    resource.RLIMIT_DATA: "--data",
+    resource.RLIMIT_FSIZE: "--fsize",
+    resource.RLIMIT_NOFILE: "--nofile",
+    resource.RLIMIT_NPROC: "--nproc",
+    resource.RLIMIT_STACK: "--stack",
+}
+
 
 # pylint: disable=too-many-positional-arguments
 def run_subprocess(
         cmd, stdin=None, cwd=None, env=None, rlimits=None, realtime=None,
-        slug=None,
+        slug=None, stdout_limit=None, stderr_limit=None, cgroup=None, on_start=None,
 ):
     """
     A helper to make a limited subprocess.
@@ -30,65 +52,649 @@ def run_subprocess(
 
     `slug` is a short identifier for use in log messages.
 
+    `stdout_limit` and `stderr_limit` are the most bytes of output to collect.
+    If the process writes more than that, it is killed.  None or 0 means no
+    limit.
+
+    `cgroup` is the path of a cgroup (see `cgroups.py`) to start the process
+    in, or None.  If it's given, the process is killed by killing the cgroup.
+
+    `on_start`, if given, is called with the process once it has started, so
+    that another thread can kill it, for instance with a `Cancellation`.
+
     This function waits until the process has finished executing before
     returning.
 
-    Returns a tuple of three values: the exit status code of the process, and
-    the stdout and stderr of the process, as strings.
+    Returns a tuple of four values: the exit status code of the process, the
+    stdout and stderr of the process, as bytes, and a dict of details about
+    the execution.  The details are:
+
+        * "stdout_truncated", "stderr_truncated": whether the output was cut
+          off at its limit.
+        * "timings": the `time.monotonic` times of the phases of the
+          execution, as (start, end) pairs: "spawn", starting the process, and
+          "run", until it ended.
+        * "rusage": the resources used by the process and the processes it
+          waited for, or None if that isn't known: a dict with "user_time"
+          and "system_time" (seconds of CPU), "max_rss" (bytes of peak
+          resident memory), and "voluntary_switches" and
+          "involuntary_switches" (context switches).
 
     """
-    subproc = subprocess.Popen(  # pylint: disable=subprocess-popen-preexec-fn
+    start = time.monotonic()
+    cmd, spawn_kwargs = spawn_args(cmd, rlimits, cgroup)
+    subproc = subprocess.Popen(
         cmd, cwd=cwd, env=env,
-        preexec_fn=functools.partial(set_process_limits, rlimits or ()),
         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        **spawn_kwargs
     )
+    if cgroup:
+        subproc.kill_group = functools.partial(kill_cgroup, cgroup)
+
+    started = time.monotonic()
 
     if slug:
         log.info("Executed jailed code %s in %s, with PID %s", slug, cwd, subproc.pid)
+    if on_start is not None:
+        on_start(subproc)
+
+    watch = SUPERVISOR.watch(subproc, realtime) if realtime else None
+    # The supervisor is done with the process before it's reaped, so that
+    # it can't kill the process group of another process with the same pid.
+    before_reap = functools.partial(SUPERVISOR.unwatch, watch) if watch else None
+    try:
+        stdout, stderr, details = communicate(subproc, stdin, stdout_limit, stderr_limit, before_reap)
+    finally:
+        if watch:
+            SUPERVISOR.unwatch(watch)
+    details["timings"] = {"spawn": (start, started), "run": (started, time.monotonic())}
+    return subproc.returncode, stdout, stderr, details
+
+
+# pylint: disable=too-many-positional-arguments
+async def async_run_subprocess(
+        cmd, stdin=None, cwd=None, env=None, rlimits=None, realtime=None,
+        slug=None, stdout_limit=None, stderr_limit=None, cgroup=None, on_start=None,
+):
+    """
+    Like `run_subprocess`, but as a coroutine.
+
+    The arguments and the return value are the same as for `run_subprocess`.
+    The `realtime` limit is enforced by the event loop rather than by a thread.
+    If the coroutine is cancelled, the process is killed before the
+    cancellation is propagated.
+
+    """
+    spawn_start = time.monotonic()
+    cmd, spawn_kwargs = spawn_args(cmd, rlimits, cgroup)
+    subproc = await asyncio.create_subprocess_exec(
+        *cmd, cwd=cwd, env=env,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        **spawn_kwargs
+    )
+    if cgroup:
+        subproc.kill_group = functools.partial(kill_cgroup, cgroup)
+    started = time.monotonic()
+
+    if slug:
+        log.info("Executed jailed code %s in %s, with PID %s", slug, cwd, subproc.pid)
+    if on_start is not None:
+        on_start(subproc)
+
+    async def feed_stdin():
+        try:
+            if stdin:
+                subproc.stdin.write(stdin)
+                await subproc.stdin.drain()
+            subproc.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    async def read_output(stream, name, limit):
+        output = _OutputBuffer(limit)
+        while True:
+            data = await stream.read(OUTPUT_CHUNK)
+            if not data:
+                return output
+            if output.add(data):
+                await async_kill_process_group(subproc, "too much output on %s" % name)
+
+    # Collect the output as it is produced, so that we have whatever was
+    # written even if the process has to be killed.
+    io_tasks = asyncio.gather(
+        feed_stdin(),
+        read_output(subproc.stdout, "stdout", stdout_limit),
+        read_output(subproc.stderr, "stderr", stderr_limit),
+    )
+    try:
+        await asyncio.wait_for(subproc.wait(), timeout=realtime or None)
+    except asyncio.TimeoutError:
+        await async_kill_process_group(
+            subproc, "ran too long: %.1fs" % (time.monotonic() - started),
+        )
+        await subproc.wait()
+    except asyncio.CancelledError:
+        await asyncio.shield(async_kill_process_group(subproc, "execution was cancelled"))
+        io_tasks.cancel()
+        # Wait for the readers to stop, which also retrieves their
+        # cancellation, so it isn't reported as never retrieved.
+        await asyncio.gather(io_tasks, return_exceptions=True)
+        raise
+
+    _, stdout, stderr = await io_tasks
+    # asyncio reaps the process itself, so its resource usage is unknown.
+    details = _output_details(stdout, stderr, None)
+    details["timings"] = {"spawn": (spawn_start, started), "run": (started, time.monotonic())}
+    return subproc.returncode, stdout.value(), stderr.value(), details
+
+
+async def async_kill_process_group(subproc, reason):
+    """
+    Kill the process group of the asyncio process `subproc`, if it's running.
+
+    `reason` is a description of why, for the log.
+
+    """
+    if subproc.returncode is not None:
+        return
+    try:
+        pgid = os.getpgid(subproc.pid)
+    except ProcessLookupError:
+        # It ended in the meantime.
+        return
+    log.warning("Killing process %r (group %r), %s", subproc.pid, pgid, reason)
+    kill_group = getattr(subproc, "kill_group", None)
+    if kill_group is not None:
+        try:
+            kill_group()
+            return
+        except OSError:
+            log.exception("Couldn't kill process group %r without sudo", pgid)
+    # Can't use subproc.kill because we launched the subproc with sudo.
+    killer = await asyncio.create_subprocess_exec("sudo", "pkill", "-9", "-g", str(pgid))
+    await killer.wait()
 
-    # Start the time killer thread.
-    if realtime:
-        killer = ProcessKillerThread(subproc, limit=realtime)
-        killer.start()
 
-    stdout, stderr = subproc.communicate(stdin)
-    return subproc.returncode, stdout, stderr
+# How much output to read at a time.
+OUTPUT_CHUNK = 32768
 
 
-def set_process_limits(rlimits):       # pragma: no cover
+class _OutputBuffer:
+    """
+    The output of a process, up to a limit.
+    """
+    def __init__(self, limit):
+        self.limit = limit or None
+        self.chunks = []
+        self.size = 0
+        self.truncated = False
+
+    def add(self, data):
+        """
+        Add `data` to the output.
+
+        Returns True if this is when the output first goes over its limit.
+        Output beyond the limit is discarded.
+
+        """
+        if self.truncated:
+            return False
+        if self.limit is not None and self.size + len(data) > self.limit:
+            data = data[:self.limit - self.size]
+            self.truncated = True
+        self.chunks.append(data)
+        self.size += len(data)
+        return self.truncated
+
+    def value(self):
+        """The output, as bytes."""
+        return b"".join(self.chunks)
+
+
+def _output_details(stdout, stderr, rusage):
+    """The details for `run_subprocess` about two `_OutputBuffer`s and the "rusage" details."""
+    return {
+        "stdout_truncated": stdout.truncated,
+        "stderr_truncated": stderr.truncated,
+        "rusage": rusage,
+    }
+
+
+# The fields of a `resource.struct_rusage` that are reported, in the order
+# `rusage_details` takes them.
+RUSAGE_FIELDS = ("ru_utime", "ru_stime", "ru_maxrss", "ru_nvcsw", "ru_nivcsw")
+
+# ru_maxrss is in kilobytes, except on macOS, where it's in bytes.
+MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def rusage_details(values):
+    """
+    The "rusage" details for `run_subprocess`.
+
+    `values` are the `RUSAGE_FIELDS` of a `resource.struct_rusage`.
+
+    """
+    user_time, system_time, max_rss, voluntary_switches, involuntary_switches = values
+    return {
+        "user_time": user_time,
+        "system_time": system_time,
+        "max_rss": max_rss * MAXRSS_UNIT,
+        "voluntary_switches": voluntary_switches,
+        "involuntary_switches": involuntary_switches,
+    }
+
+
+def wait_for_rusage(proc, before_reap=None):
+    """
+    Wait for `proc` to end, and get its resource usage.
+
+    A `subprocess.Popen` is reaped with `os.wait4`, and its `returncode` set.
+    Other process-like objects are waited for with `wait`, and their usage is
+    their `rusage` attribute, if they have one.  Returns the "rusage" details
+    for `run_subprocess`, or None if the usage isn't known.
+
+    If `before_reap` is given, it's called once the process has ended, but
+    before a `subprocess.Popen` is reaped, while its pid can't be reused.
+
+    """
+    if not isinstance(proc, subprocess.Popen):
+        proc.wait()
+        if before_reap is not None:
+            before_reap()
+        return getattr(proc, "rusage", None)
+    if proc.returncode is not None:
+        if before_reap is not None:
+            before_reap()
+        return None
+    if before_reap is not None:
+        try:
+            os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        except ChildProcessError:
+            pass
+        before_reap()
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        # Something else reaped it.
+        proc.wait()
+        return None
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return rusage_details([getattr(usage, field) for field in RUSAGE_FIELDS])
+
+
+def communicate(proc, stdin=None, stdout_limit=None, stderr_limit=None, before_reap=None):
+    """
+    Like `subprocess.Popen.communicate`, but for any process-like object.
+
+    `proc` must have `stdin`, `stdout`, and `stderr` file objects, and `pid`
+    and `wait` as `subprocess.Popen` does.  `stdin` is the data to write to the
+    process.  `stdout_limit` and `stderr_limit` are as for `run_subprocess`:
+    once an output reaches its limit, the rest of it is discarded, and the
+    process is killed.  The process is waited for with `wait_for_rusage`,
+    which calls `before_reap`.
+
+    Returns the stdout and stderr of the process, as bytes, and the details
+    dict for `run_subprocess`.
+
+    """
+    stdout_fd, stderr_fd = proc.stdout.fileno(), proc.stderr.fileno()
+    output = {
+        stdout_fd: ("stdout", _OutputBuffer(stdout_limit)),
+        stderr_fd: ("stderr", _OutputBuffer(stderr_limit)),
+    }
+    stdin_view = memoryview(stdin or b"")
+    stdin_offset = 0
+
+    with selectors.DefaultSelector() as selector:
+        if stdin_view:
+            selector.register(proc.stdin, selectors.EVENT_WRITE)
+        else:
+            proc.stdin.close()
+        selector.register(proc.stdout, selectors.EVENT_READ)
+        selector.register(proc.stderr, selectors.EVENT_READ)
+
+        while selector.get_map():
+            for key, _ in selector.select():
+                if key.fileobj is proc.stdin:
+                    chunk = stdin_view[stdin_offset:stdin_offset + select.PIPE_BUF]
+                    try:
+                        stdin_offset += os.write(key.fd, chunk)
+                    except BrokenPipeError:
+                        stdin_offset = len(stdin_view)
+                    if stdin_offset >= len(stdin_view):
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                else:
+                    data = os.read(key.fd, OUTPUT_CHUNK)
+                    if data:
+                        name, buffer = output[key.fd]
+                        if buffer.add(data):
+                            kill_process_group(proc, "too much output on %s" % name)
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+
+    rusage = wait_for_rusage(proc, before_reap)
+    stdout, stderr = output[stdout_fd][1], output[stderr_fd][1]
+    return stdout.value(), stderr.value(), _output_details(stdout, stderr, rusage)
+
+
+def kill_process_group(proc, reason):
+    """
+    Kill the process group of `proc`.
+
+    `reason` is a description of why, for the log.
+
+    """
+    try:
+        pgid = os.getpgid(proc.pid)
+    except ProcessLookupError:
+        # It ended in the meantime.
+        return
+    log.warning("Killing process %r (group %r), %s", proc.pid, pgid, reason)
+    # A process in a cgroup can be killed with the cgroup, without sudo.
+    kill_group = getattr(proc, "kill_group", None)
+    if kill_group is not None:
+        try:
+            kill_group()
+            return
+        except OSError:
+            log.exception("Couldn't kill process group %r without sudo", pgid)
+    # Can't use subproc.kill because we launched the subproc with sudo.
+    subprocess.call(["sudo", "pkill", "-9", "-g", str(pgid)])
+
+
+class Cancellation:
+    """
+    Kills a process that another thread is running, when it's cancelled.
+
+    Give `started` as the `on_start` argument of the function running the
+    process, and call `ended` once that function has returned.  `cancel`
+    kills the process if it's running, or as soon as it starts.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._proc = None
+        self._cancelled = False
+        self._ended = False
+
+    def started(self, proc):
+        """The process `proc` has started."""
+        with self._lock:
+            self._proc = proc
+            if self._cancelled:
+                kill_process_group(proc, "execution was cancelled")
+
+    def ended(self):
+        """The function running the process has returned."""
+        with self._lock:
+            self._ended = True
+
+    def cancel(self):
+        """Kill the process, now if it's running, or when it starts."""
+        with self._lock:
+            self._cancelled = True
+            if self._proc is not None and not self._ended:
+                kill_process_group(self._proc, "execution was cancelled")
+
+
+def kill_cgroup(cgroup):
+    """Kill every process in the cgroup at the path `cgroup`."""
+    with open(os.path.join(cgroup, "cgroup.kill"), "w", encoding="ascii") as kill:
+        kill.write("1")
+
+
+def spawn_args(cmd, rlimits, cgroup=None):
+    """
+    How to start `cmd` in a new session, with the resource limits `rlimits`.
+
+    If `cgroup` is given, the process is moved into that cgroup before it
+    runs `cmd`.
+
+    Returns the command line to run, and a dict of keyword arguments for
+    `subprocess.Popen`.  Normally, the limits are set by `set_process_limits`,
+    run in the child process before it runs the command.  That needs the
+    whole parent process to be forked, and Python code to run in the child,
+    which is slow for a large parent, and unsafe if it has threads.  If
+    `PRLIMIT` is set, the child starts a new session without running Python
+    code, so `subprocess` can use `vfork`, and runs `cmd` with `prlimit`,
+    which sets the limits on itself before running it.
+
+    """
+    if PRLIMIT is None:
+        return cmd, {"preexec_fn": functools.partial(set_process_limits, rlimits or (), cgroup)}
+    if rlimits:
+        cmd = prlimit_command(PRLIMIT, rlimits) + list(cmd)
+    if cgroup:
+        # A shell writing 0 to cgroup.procs moves itself, and then runs the
+        # command in the same process.
+        procs = os.path.join(cgroup, "cgroup.procs")
+        cmd = ["/bin/sh", "-c", 'echo 0 > "$0" && exec "$@"', procs] + list(cmd)
+    return cmd, {"start_new_session": True}
+
+
+def prlimit_command(prlimit, rlimits):
+    """
+    The start of a command line to run a command with `rlimits`.
+
+    `prlimit` is the path of the `prlimit` program, and `rlimits` is a list of
+    pairs, as for `set_process_limits`.
+
+    """
+    def limit_value(value):
+        return "unlimited" if value == resource.RLIM_INFINITY else str(value)
+
+    cmd = [prlimit]
+    for limit, (soft, hard) in rlimits:
+        try:
+            option = PRLIMIT_OPTIONS[limit]
+        except KeyError:
+            raise ValueError("prlimit can't set resource limit %r" % (limit,)) from None
+        cmd.append("%s=%s:%s" % (option, limit_value(soft), limit_value(hard)))
+    cmd.append("--")
+    return cmd
+
+
+def set_process_limits(rlimits, cgroup=None):       # pragma: no cover
     """
     Set limits on this process, to be used first in a child process.
+
+    If `cgroup` is given, this process is moved into that cgroup.
+
     """
     # Set a new session id so that this process and all its children will be
     # in a new process group, so we can kill them all later if we need to.
     os.setsid()
 
+    if cgroup:
+        with open(os.path.join(cgroup, "cgroup.procs"), "w", encoding="ascii") as procs:
+            procs.write("0")
+
     for limit, value in rlimits:
         resource.setrlimit(limit, value)
 
 
-class ProcessKillerThread(threading.Thread):
+class _Watch:
+    """
+    A process being watched by a `ProcessSupervisor`.
+    """
+    def __init__(self, proc, start, deadline):
+        self.proc = proc
+        self.start = start
+        self.deadline = deadline
+        # A pidfd for the process, while the supervisor is waiting on it.
+        self.pidfd = None
+        # Has the process ended, as far as the supervisor knows?
+        self.ended = False
+        # Has the caller stopped watching?  Changed, and checked before a
+        # kill, with `lock` held.
+        self.done = False
+        self.lock = threading.Lock()
+
+
+class ProcessSupervisor:
     """
-    A thread to kill a process after a given time limit.
+    Kills processes that run past their time limits.
+
+    One supervisor thread watches every process that is running with a time
+    limit.  It keeps a heap of their deadlines, and waits until the next one,
+    or until a process ends, which it learns from the process's pidfd where
+    pidfds are available.  When a deadline passes and its process is still
+    running, the process group is killed.  If the thread ever dies, the next
+    `watch` starts another.
+
     """
-    def __init__(self, subproc, limit):
-        super().__init__()
-        self.subproc = subproc
-        self.limit = limit
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        """Set up with no thread running."""
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pending = []
+        self._wakeup_r = self._wakeup_w = None
+
+    def watch(self, proc, limit):
+        """
+        Kill `proc` if it's still running in `limit` seconds.
+
+        `proc` is a `subprocess.Popen`, or an object with its `pid` and `poll`.
+        Returns an object to pass to `unwatch` when the process has ended.
+
+        """
+        start = time.monotonic()
+        watch = _Watch(proc, start, start + limit)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self._thread is not None:
+                    log.error("CodeJail supervisor thread died, starting another")
+                    os.close(self._wakeup_r)
+                    os.close(self._wakeup_w)
+                self._wakeup_r, self._wakeup_w = os.pipe()
+                os.set_blocking(self._wakeup_r, False)
+                os.set_blocking(self._wakeup_w, False)
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._wakeup_r,),
+                    name="codejail-supervisor", daemon=True,
+                )
+                self._thread.start()
+            self._pending.append(watch)
+            try:
+                os.write(self._wakeup_w, b"x")
+            except BlockingIOError:
+                # The pipe is full, so the thread will wake up anyway.
+                pass
+        return watch
+
+    def unwatch(self, watch):
+        """
+        Stop watching a process, because the caller is done with it.
+
+        Once this returns, the supervisor won't use the process object again,
+        or kill its process group.  A `subprocess.Popen` must not be reaped
+        until then, since its pid could be reused by another process.
 
-    def run(self):
-        start = time.time()
-        while (time.time() - start) < self.limit:
-            time.sleep(.25)
-            if self.subproc.poll() is not None:
-                # Process ended, no need for us any more.
+        """
+        with watch.lock:
+            watch.done = True
+
+    def _run(self, wakeup_r):
+        """The supervisor thread."""
+        heap = []
+        counter = itertools.count()
+        with selectors.DefaultSelector() as selector:
+            selector.register(wakeup_r, selectors.EVENT_READ)
+            while True:
+                try:
+                    self._step(wakeup_r, selector, heap, counter)
+                except Exception:  # pylint: disable=broad-except
+                    # Keep enforcing the other processes' limits.
+                    log.exception("CodeJail supervisor failed")
+
+    def _step(self, wakeup_r, selector, heap, counter):
+        """Take new watches, wait for the next event, and kill what's overdue."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for watch in pending:
+            if watch.done:
+                continue
+            heapq.heappush(heap, (watch.deadline, next(counter), watch))
+            watch.pidfd = _pidfd_open(watch.proc.pid)
+            if watch.pidfd is not None:
+                selector.register(watch.pidfd, selectors.EVENT_READ, watch)
+
+        timeout = max(heap[0][0] - time.monotonic(), 0) if heap else None
+        for key, _ in selector.select(timeout):
+            if key.fd == wakeup_r:
+                try:
+                    os.read(wakeup_r, 4096)
+                except BlockingIOError:
+                    pass
+            else:
+                # The pidfd is readable: the process has ended.
+                self._forget(selector, key.data)
+
+        now = time.monotonic()
+        while heap and heap[0][0] <= now:
+            _, _, watch = heapq.heappop(heap)
+            try:
+                if not watch.ended:
+                    self._kill_if_running(watch, now)
+            finally:
+                self._forget(selector, watch)
+
+    def _forget(self, selector, watch):
+        """Stop waiting on `watch`'s pidfd, and consider it ended."""
+        watch.ended = True
+        if watch.pidfd is not None:
+            selector.unregister(watch.pidfd)
+            os.close(watch.pidfd)
+            watch.pidfd = None
+
+    def _kill_if_running(self, watch, now):
+        """Kill the process group of `watch` if it is still running."""
+        # The kill is sent with the watch's lock held, so `unwatch` can't
+        # return, and the process can't be reaped and its pid reused, until
+        # it's done.  Other watches aren't held up.
+        with watch.lock:
+            if watch.done or _has_ended(watch.proc):
                 return
+            try:
+                kill_process_group(watch.proc, "ran too long: %.1fs" % (now - watch.start))
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Couldn't kill process %s, which ran too long", watch.proc.pid)
+
+
+def _has_ended(proc):
+    """
+    Has `proc` ended?
+
+    A `subprocess.Popen` isn't reaped, so that `wait_for_rusage` can get its
+    resource usage.
+
+    """
+    if not isinstance(proc, subprocess.Popen):
+        return proc.poll() is not None
+    if proc.returncode is not None:
+        return True
+    try:
+        return os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+    except ChildProcessError:
+        return True
+
+
+def _pidfd_open(pid):
+    """Get a pidfd for `pid`, or None if that isn't possible."""
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+# The one supervisor for all of the processes we start.
+SUPERVISOR = ProcessSupervisor()
 
-        if self.subproc.poll() is None:
-            # Can't use subproc.kill because we launched the subproc with sudo.
-            pgid = os.getpgid(self.subproc.pid)
-            log.warning(
-                "Killing process %r (group %r), ran too long: %.1fs",
-                self.subproc.pid, pgid, time.time() - start
-            )
-            subprocess.call(["sudo", "pkill", "-9", "-g", str(pgid)])
+# A forked child doesn't have the supervisor thread.
+os.register_at_fork(after_in_child=SUPERVISOR._reset)  # pylint: disable=protected-access
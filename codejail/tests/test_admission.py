@@ -0,0 +1,116 @@
+"""Test admission.py"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from codejail import jail_code
+from codejail.admission import Admission, Overloaded
+
+from .test_jail_code import JailCodeHelpersMixin, jailpy
+
+
+class TestAdmission(TestCase):
+    """Tests of `Admission`."""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp(prefix="codejail-test-")
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def make_admission(self, slots, timeout=0.2):
+        """Make an `Admission` using the test's directory."""
+        return Admission(slots, timeout=timeout, directory=self.directory)
+
+    def test_slots(self):
+        admission = self.make_admission(2)
+        slots = [admission.acquire(), admission.acquire()]
+        start = time.monotonic()
+        with self.assertRaisesRegex(Overloaded, "none of the 2 slots"):
+            admission.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(admission.waits, 1)
+        self.assertEqual(admission.rejections, 1)
+
+        # Once a slot is released, it can be taken again.
+        admission.release(slots.pop())
+        slots.append(admission.acquire())
+        for slot in slots:
+            admission.release(slot)
+
+    def test_waits_for_a_slot(self):
+        admission = self.make_admission(1, timeout=5)
+        slot = admission.acquire()
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        loop.call_later(0.1, admission.release, slot)
+        start = time.monotonic()
+        slot = loop.run_until_complete(admission.async_acquire())
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(admission.waits, 1)
+        self.assertEqual(admission.rejections, 0)
+        admission.release(slot)
+
+    def test_slots_are_shared_between_processes(self):
+        admission = self.make_admission(1)
+        pid = os.fork()
+        if pid == 0:                            # pragma: no cover
+            admission.acquire()
+            time.sleep(0.5)
+            os._exit(0)                         # pylint: disable=protected-access
+        try:
+            # Wait for the child to take the only slot.
+            time.sleep(0.1)
+            with self.assertRaises(Overloaded):
+                admission.acquire()
+        finally:
+            os.waitpid(pid, 0)
+        # The slot was released when the child exited.
+        admission.release(admission.acquire())
+
+    def test_others_directory_is_refused(self):
+        # Anyone could hold or remove the slots in a directory they can write to.
+        os.chmod(self.directory, 0o777)
+        with self.assertRaises(PermissionError):
+            self.make_admission(1)
+        # Nor can the directory be a symlink to one of ours.
+        os.chmod(self.directory, 0o700)
+        link = self.directory + "-link"
+        os.symlink(self.directory, link)
+        self.addCleanup(os.remove, link)
+        with self.assertRaises(PermissionError):
+            Admission(1, directory=link)
+        # A directory that doesn't exist yet is made private.
+        made = os.path.join(self.directory, "made")
+        Admission(1, directory=made)
+        self.assertEqual(os.stat(made).st_mode & 0o777, 0o700)
+
+
+class TestJailCodeWithAdmission(JailCodeHelpersMixin, TestCase):
+    """Tests of `jail_code` with admission control."""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp(prefix="codejail-test-")
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(setattr, jail_code, "ADMISSION", jail_code.ADMISSION)
+        jail_code.configure_admission(1, timeout=0.1, directory=directory)
+
+    def test_admitted(self):
+        res = jailpy(code="print('hello')")
+        self.assertResultOk(res)
+        self.assertIn("admission", res.timings.phases)
+
+    def test_overloaded(self):
+        slot = jail_code.ADMISSION.acquire()
+        try:
+            with self.assertRaises(Overloaded):
+                jailpy(code="print('hello')")
+            with self.assertRaises(Overloaded):
+                asyncio.run(jail_code.async_jail_code("python", "print('hello')"))
+        finally:
+            jail_code.ADMISSION.release(slot)
+        self.assertEqual(jail_code.ADMISSION.rejections, 2)
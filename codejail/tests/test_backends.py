@@ -0,0 +1,228 @@
+"""Test backends.py and server.py"""
+
+import asyncio
+import os
+import os.path
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from unittest import TestCase
+
+from codejail import jail_code
+from codejail.admission import Overloaded
+from codejail.backends import PROTOCOL_VERSION, Backend, RemoteBackend, RemoteExecutionError, pack_files, unpack_files
+from codejail.proxy import read_message, write_message
+
+from .test_jail_code import JailCodeHelpersMixin, file_here, jailpy
+
+
+def start_server(test):
+    """Start an execution server on loopback, stopped at the end of `test`, and return its "host:port"."""
+    server = subprocess.Popen(
+        [sys.executable, "-m", "codejail.server", "--host", "127.0.0.1"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    )
+    test.addCleanup(server.wait)
+    test.addCleanup(server.kill)
+    line = server.stdout.readline().decode("utf-8")
+    test.assertTrue(line.startswith("Listening on "), line)
+    return line.split()[-1]
+
+
+def unused_endpoint():
+    """A "host:port" on loopback that nothing is listening on."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return "127.0.0.1:%d" % sock.getsockname()[1]
+
+
+def start_hanging_server(test):
+    """
+    Start a server that takes a request and never answers it.
+
+    Returns its "host:port", and a list the requests it reads are added to.
+    """
+    listener = socket.create_server(("127.0.0.1", 0))
+    test.addCleanup(listener.close)
+    requests = []
+
+    def serve():
+        conn, _ = listener.accept()
+        test.addCleanup(conn.close)
+        stream = conn.makefile("rwb")
+        write_message(stream, {"protocol": PROTOCOL_VERSION})
+        request = read_message(stream)
+        if request is not None:
+            requests.append(request)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    return "127.0.0.1:%d" % listener.getsockname()[1], requests
+
+
+class TestPackFiles(TestCase):
+    """Tests of `pack_files` and `unpack_files`."""
+
+    def test_round_trip(self):
+        directory = tempfile.mkdtemp(prefix="codejail-test-")
+        self.addCleanup(shutil.rmtree, directory)
+        link = os.path.join(directory, "link")
+        os.symlink("/etc/passwd", link)
+        destination = os.path.join(directory, "unpacked")
+        os.mkdir(destination)
+        files = unpack_files(pack_files([file_here("hello.txt"), file_here("pylib"), link]), destination)
+        self.assertEqual([os.path.basename(path) for path in files], ["hello.txt", "pylib", "link"])
+        with open(files[0], encoding="utf-8") as hello:
+            self.assertEqual(hello.read(), "Hello there.\n")
+        self.assertEqual(os.listdir(files[1]), ["module.py"])
+        self.assertEqual(os.readlink(files[2]), "/etc/passwd")
+
+
+class TestBackend(TestCase):
+    """Tests of the `Backend` interface."""
+
+    def test_run_is_abstract(self):
+        class NoRun(Backend):  # pylint: disable=abstract-method
+            pass
+
+        with self.assertRaises(TypeError):
+            NoRun()  # pylint: disable=abstract-class-instantiated
+
+
+class TestRemoteBackend(JailCodeHelpersMixin, TestCase):
+    """Tests of `jail_code` with a `RemoteBackend` and execution servers on loopback."""
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, jail_code, "BACKEND", jail_code.BACKEND)
+
+    def use_backend(self, endpoints, **kwargs):
+        """Run executions on the servers at `endpoints`, and return the backend."""
+        backend = RemoteBackend(endpoints, **kwargs)
+        self.addCleanup(backend.close)
+        jail_code.configure_backend(backend)
+        return backend
+
+    def test_runs_remotely(self):
+        self.use_backend([start_server(self)])
+        res = jailpy(
+            code="""
+                import sys
+                print(sys.argv[1:], open('hello.txt').read().strip(), open('extra.txt').read())
+                print(sys.stdin.read().upper())
+            """,
+            files=[file_here("hello.txt")],
+            extra_files=[("extra.txt", b"more")],
+            argv=["-x"],
+            stdin="quiet",
+        )
+        self.assertResultOk(res)
+        self.assertEqual(res.stdout, b"['-x'] Hello there. more\nQUIET\n")
+        self.assertIsNotNone(res.rusage)
+        self.assertIn("execute", res.timings.phases)
+
+    def test_async(self):
+        self.use_backend([start_server(self)])
+        res = asyncio.run(jail_code.async_jail_code("python", "print('hello')"))
+        self.assertResultOk(res)
+        self.assertEqual(res.stdout, b"hello\n")
+
+    def test_limits_are_sent(self):
+        # The server doesn't know this context: the limits come from here.
+        self.use_backend([start_server(self)])
+        self.addCleanup(jail_code.LIMIT_OVERRIDES.pop, "tight", None)
+        jail_code.override_limit("STDOUT", 10, "tight")
+        res = jailpy(code="print('x' * 100)", limit_overrides_context="tight")
+        self.assertTrue(res.stdout_truncated)
+        self.assertEqual(res.stdout, b"x" * 10)
+
+    def test_connections_are_reused(self):
+        backend = self.use_backend([start_server(self)], pool_size=1)
+        for _ in range(3):
+            self.assertResultOk(jailpy(code="print('hello')"))
+        self.assertEqual(len(backend.endpoints[0]._idle), 1)  # pylint: disable=protected-access
+
+    def test_failover(self):
+        backend = self.use_backend([unused_endpoint(), start_server(self)])
+        dead, alive = backend.endpoints
+        # Make the dead server look the least busy, so it's tried first.
+        alive.outstanding = 1
+        for _ in range(3):
+            self.assertResultOk(jailpy(code="print('hello')"))
+        self.assertGreater(dead.down_until, 0)
+        self.assertEqual(alive.outstanding, 1)
+
+    def test_no_failover_once_sent(self):
+        # An execution the server may have run isn't run again elsewhere.
+        endpoint, requests = start_hanging_server(self)
+        backend = self.use_backend([endpoint, start_server(self)], timeout=0.5)
+        hanging, alive = backend.endpoints
+        alive.outstanding = 1
+        with self.assertRaisesRegex(RemoteExecutionError, "failed once the execution was sent"):
+            jailpy(code="print('hello')")
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(hanging.down_until, 0)
+        self.assertEqual(alive.outstanding, 1)
+
+    def test_dropped_connections_are_replaced(self):
+        backend = self.use_backend([start_server(self)], pool_size=1)
+        self.assertResultOk(jailpy(code="print('hello')"))
+        idle = backend.endpoints[0]._idle[0]  # pylint: disable=protected-access
+        self.assertFalse(idle.dropped())
+        # Make it look as though the server closed the connection.
+        idle.sock.shutdown(socket.SHUT_RD)
+        self.assertTrue(idle.dropped())
+        self.assertResultOk(jailpy(code="print('hello')"))
+        self.assertIsNot(backend.endpoints[0]._idle[0], idle)  # pylint: disable=protected-access
+
+    def test_no_servers(self):
+        self.use_backend([unused_endpoint(), unused_endpoint()])
+        with self.assertRaises(RemoteExecutionError):
+            jailpy(code="print('hello')")
+
+    def test_server_errors(self):
+        self.use_backend([start_server(self)])
+        with self.assertRaisesRegex(RemoteExecutionError, "needs to be configured for 'ruby'"):
+            jail_code.jail_code("ruby", "puts 1")
+
+
+class TestBalancing(TestCase):
+    """Tests of how `RemoteBackend` chooses servers."""
+
+    SUCCESS = ({"status": 0, "stdout_truncated": False, "stderr_truncated": False, "rusage": None}, [b"ok", b""])
+    OVERLOADED = ({"error": "overloaded", "message": "Too busy"}, [])
+
+    def setUp(self):
+        super().setUp()
+        self.backend = RemoteBackend(["10.0.0.1:7870", "10.0.0.2:7870", ("10.0.0.3", 7870)])
+
+    def run_code(self):
+        """Run an execution with the backend."""
+        limits = jail_code.get_effective_limits()
+        return self.backend.run("python", "print('ok')", None, None, None, None, None, limits, None, None)
+
+    def test_least_outstanding(self):
+        first, second, third = self.backend.endpoints
+        first.outstanding, second.outstanding, third.outstanding = 2, 0, 1
+        self.assertIs(self.backend._choose([]), second)  # pylint: disable=protected-access
+        self.assertIs(self.backend._choose([second]), third)  # pylint: disable=protected-access
+
+        # A server that's down is only chosen if no other can be.
+        second.down_until = float("inf")
+        self.assertIs(self.backend._choose([]), third)  # pylint: disable=protected-access
+        self.assertIs(self.backend._choose([first, third]), second)  # pylint: disable=protected-access
+
+    def test_overloaded_servers_are_skipped(self):
+        responses = [self.OVERLOADED, self.OVERLOADED, self.SUCCESS]
+        for endpoint in self.backend.endpoints:
+            endpoint.request = lambda header, blobs: responses.pop(0)
+        self.assertEqual(self.run_code().stdout, b"ok")
+
+    def test_all_overloaded(self):
+        for endpoint in self.backend.endpoints:
+            endpoint.request = lambda header, blobs: self.OVERLOADED
+        with self.assertRaisesRegex(Overloaded, "Too busy"):
+            self.run_code()
@@ -0,0 +1,106 @@
+"""Test cgroups.py"""
+
+import os
+import os.path
+import resource
+import shutil
+import tempfile
+from unittest import SkipTest, TestCase
+
+from codejail import jail_code
+from codejail.cgroups import CgroupRoot
+
+from .test_jail_code import JailCodeHelpersMixin, jailpy
+
+
+def read(path):
+    """The contents of the file at `path`."""
+    with open(path, encoding="ascii") as f:
+        return f.read()
+
+
+class TestCgroupRoot(TestCase):
+    """Tests of `CgroupRoot`, in a directory that looks like a cgroup."""
+
+    def make_root(self, controllers):
+        """Make a fake cgroup with `controllers` available, and return it as a `CgroupRoot`."""
+        path = tempfile.mkdtemp(prefix="codejail-test-")
+        self.addCleanup(shutil.rmtree, path)
+        with open(os.path.join(path, "cgroup.controllers"), "w", encoding="ascii") as f:
+            f.write(" ".join(controllers) + "\n")
+        return CgroupRoot(path)
+
+    def test_controllers_are_enabled(self):
+        root = self.make_root(["cpuset", "cpu", "io", "memory", "pids"])
+        self.assertEqual(root.controllers, {"cpu", "memory", "pids"})
+        self.assertEqual(read(os.path.join(root.path, "cgroup.subtree_control")), "+cpu +memory +pids")
+
+    def test_limits(self):
+        root = self.make_root(["cpu", "memory", "pids"])
+        cgroup = root.create(pids=10, memory=64 * 1024 * 1024, cpus=0.5)
+        self.assertEqual(os.path.dirname(cgroup.path), root.path)
+        self.assertEqual(read(os.path.join(cgroup.path, "pids.max")), "10")
+        self.assertEqual(read(os.path.join(cgroup.path, "memory.max")), "67108864")
+        self.assertEqual(read(os.path.join(cgroup.path, "cpu.max")), "50000 100000")
+
+    def test_no_limits(self):
+        root = self.make_root(["cpu", "memory", "pids"])
+        cgroup = root.create()
+        self.assertEqual(os.listdir(cgroup.path), [])
+
+    def test_missing_controllers(self):
+        root = self.make_root(["pids"])
+        self.assertEqual(root.controllers, {"pids"})
+        cgroup = root.create(pids=10, memory=64 * 1024 * 1024, cpus=0.5)
+        self.assertEqual(os.listdir(cgroup.path), ["pids.max"])
+
+    def test_nproc_rlimit_is_left_to_the_cgroup(self):
+        root = self.make_root(["pids"])
+        execution = jail_code._JailedExecution(  # pylint: disable=protected-access
+            homedir="/tmp", cmd=[], zygote_cmd=[], argv=[], rm_cmd=None, clean_fn=None,
+            effective_limits=jail_code.get_effective_limits(), preload_modules=None,
+            run_subprocess_fn=None, slug=None, timings=None, cgroup=root.create(pids=10),
+        )
+        kwargs = execution.subprocess_kwargs(None)
+        self.assertEqual(kwargs["cgroup"], execution.cgroup.path)
+        self.assertNotIn(resource.RLIMIT_NPROC, [limit for limit, _ in kwargs["rlimits"]])
+
+
+class TestJailCodeWithCgroups(JailCodeHelpersMixin, TestCase):
+    """
+    Tests of `jail_code` with cgroups.
+
+    These need a cgroup v2 directory this process can write to, given by the
+    CODEJAIL_TEST_CGROUP environment variable.
+
+    """
+
+    def setUp(self):
+        super().setUp()
+        root = os.environ.get("CODEJAIL_TEST_CGROUP")
+        if not root:
+            raise SkipTest("CODEJAIL_TEST_CGROUP isn't set")
+        self.addCleanup(setattr, jail_code, "CGROUP_ROOT", jail_code.CGROUP_ROOT)
+        jail_code.configure_cgroups(root)
+
+    def cgroups_in_root(self):
+        """The names of the cgroups made for executions that still exist."""
+        return [name for name in os.listdir(jail_code.CGROUP_ROOT.path) if name.startswith("codejail-")]
+
+    def test_runs_in_a_cgroup(self):
+        res = jailpy(code="print(open('/proc/self/cgroup').read())")
+        self.assertResultOk(res)
+        self.assertRegex(res.stdout.decode("utf-8"), r"(?m)^0::/.*/codejail-[0-9a-f]+$")
+        self.assertEqual(self.cgroups_in_root(), [])
+
+    def test_cgroup_is_removed_after_a_timeout(self):
+        old_realtime = jail_code.LIMITS["REALTIME"]
+        self.addCleanup(jail_code.set_limit, "REALTIME", old_realtime)
+        jail_code.set_limit("REALTIME", 0.5)
+        res = jailpy(code="""
+            import subprocess, time
+            subprocess.Popen(["sleep", "10"])
+            time.sleep(10)
+        """)
+        self.assertEqual(res.status, -9)
+        self.assertEqual(self.cgroups_in_root(), [])
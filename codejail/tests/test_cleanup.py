@@ -0,0 +1,163 @@
+"""Test cleanup.py"""
+
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+from codejail import jail_code
+from codejail.cleanup import CleanupReaper
+
+from .test_jail_code import JailCodeHelpersMixin, jailpy
+
+
+class FakeRunSubprocess:
+    """A stand-in for `run_subprocess` that runs the command directly."""
+
+    def __init__(self, status=0):
+        self.status = status
+        self.cmds = []
+        # The first call waits for this, so that others can pile up.
+        self.proceed = threading.Event()
+
+    def __call__(self, cmd):
+        if not self.cmds:
+            self.proceed.wait()
+        self.cmds.append(cmd)
+        if self.status == 0:
+            for tmpdir in cmd[cmd.index('/usr/bin/find') + 1:cmd.index('-mindepth')]:
+                for name in os.listdir(tmpdir):
+                    os.remove(os.path.join(tmpdir, name))
+        return self.status, b"", b"", {}
+
+
+class TestCleanupReaper(TestCase):
+    """Tests of `CleanupReaper`."""
+
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.mkdtemp(prefix="codejail-test-")
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def make_homedir(self):
+        """Make a home directory like `jail_code` does, with a temp file in it."""
+        homedir = tempfile.mkdtemp(dir=self.root)
+        tmpdir = os.path.join(homedir, "tmp")
+        os.mkdir(tmpdir)
+        with open(os.path.join(tmpdir, "scratch.txt"), "w", encoding="utf-8") as f:
+            f.write("scratch")
+        return homedir, tmpdir
+
+    def wait_until_taken(self, reaper):
+        """Wait for the reaper thread to take everything from its backlog."""
+        while not reaper._queue.empty():  # pylint: disable=protected-access
+            time.sleep(0.001)
+
+    def test_cleans_in_batches(self):
+        reaper = CleanupReaper(batch_size=10)
+        run = FakeRunSubprocess()
+        dirs = [self.make_homedir() for _ in range(5)]
+        reaper.submit(*dirs[0], ["sudo", "-u", "sandbox"], run)
+        self.wait_until_taken(reaper)
+        for homedir, tmpdir in dirs[1:]:
+            reaper.submit(homedir, tmpdir, ["sudo", "-u", "sandbox"], run)
+        run.proceed.set()
+        reaper.flush()
+
+        self.assertEqual(os.listdir(self.root), [])
+        # The first one was taken alone, the other four in one batch.
+        self.assertEqual(len(run.cmds), 2)
+        self.assertEqual(run.cmds[1][:4], ["sudo", "-u", "sandbox", "/usr/bin/find"])
+        self.assertEqual(run.cmds[1][4:8], [tmpdir for _, tmpdir in dirs[1:]])
+        self.assertEqual(reaper.failures, 0)
+
+    def test_full_backlog_cleans_in_caller(self):
+        reaper = CleanupReaper(max_backlog=1)
+        run = FakeRunSubprocess()
+        dirs = [self.make_homedir() for _ in range(3)]
+        reaper.submit(*dirs[0], [], run)
+        self.wait_until_taken(reaper)
+        reaper.submit(*dirs[1], [], run)
+        # The reaper is busy, and the backlog is full, so the caller cleans up.
+        run.cmds.append("reaper's first command")
+        with mock.patch("codejail.cleanup.log") as log:
+            reaper.submit(*dirs[2], [], run)
+        self.assertIn("backlog is full", log.warning.call_args[0][0])
+        self.assertFalse(os.path.exists(dirs[2][0]))
+        run.proceed.set()
+        reaper.flush()
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_clean_fn(self):
+        reaper = CleanupReaper()
+        run = FakeRunSubprocess()
+        run.proceed.set()
+        cleaned = []
+
+        def clean_fn(tmpdirs):
+            cleaned.extend(tmpdirs)
+            for tmpdir in tmpdirs:
+                for name in os.listdir(tmpdir):
+                    os.remove(os.path.join(tmpdir, name))
+            return True
+
+        dirs = [self.make_homedir() for _ in range(2)]
+        for homedir, tmpdir in dirs:
+            reaper.submit(homedir, tmpdir, ["sudo", "-u", "sandbox"], run, clean_fn=clean_fn)
+        reaper.flush()
+        self.assertEqual(os.listdir(self.root), [])
+        self.assertEqual(sorted(cleaned), sorted(tmpdir for _, tmpdir in dirs))
+        self.assertEqual(run.cmds, [])
+
+    def test_clean_fn_failure_runs_find(self):
+        reaper = CleanupReaper()
+        run = FakeRunSubprocess()
+        run.proceed.set()
+        homedir, tmpdir = self.make_homedir()
+        reaper.submit(homedir, tmpdir, ["sudo", "-u", "sandbox"], run, clean_fn=lambda tmpdirs: False)
+        reaper.flush()
+        self.assertEqual(os.listdir(self.root), [])
+        self.assertEqual(len(run.cmds), 1)
+
+    def test_failures_are_reported(self):
+        reaper = CleanupReaper()
+        run = FakeRunSubprocess(status=1)
+        run.proceed.set()
+        with mock.patch("codejail.cleanup.log") as log:
+            reaper.submit("/no/such/codejail/dir", "/no/such/codejail/dir/tmp", [], run)
+            reaper.flush()
+        self.assertIn("Couldn't clean up", log.error.call_args[0][0])
+        self.assertIn("Couldn't remove", log.exception.call_args[0][0])
+        self.assertEqual(reaper.failures, 1)
+
+
+class TestJailCodeWithBackgroundCleanup(JailCodeHelpersMixin, TestCase):
+    """Tests of `jail_code` with background cleanup configured."""
+
+    def setUp(self):
+        super().setUp()
+        old_reaper = jail_code.CLEANUP_REAPER
+        self.addCleanup(setattr, jail_code, "CLEANUP_REAPER", old_reaper)
+        jail_code.configure_background_cleanup()
+        old_fsize = jail_code.LIMITS["FSIZE"]
+        self.addCleanup(jail_code.set_limit, "FSIZE", old_fsize)
+        jail_code.set_limit("FSIZE", 1000)
+
+    def test_directories_are_cleaned_up(self):
+        homedirs = []
+        for _ in range(3):
+            res = jailpy(code="""
+                import os, tempfile
+                with open(os.path.join(tempfile.gettempdir(), "temp.txt"), "w") as f:
+                    f.write("hello")
+                print(os.getcwd())
+            """)
+            self.assertResultOk(res)
+            homedirs.append(res.stdout.decode("utf-8").strip())
+        jail_code.CLEANUP_REAPER.flush()
+        for homedir in homedirs:
+            self.assertFalse(os.path.exists(homedir))
+        self.assertEqual(jail_code.CLEANUP_REAPER.failures, 0)
@@ -1,10 +1,13 @@
 """Test django_integration_utils.py"""
 
+import os.path
+import tempfile
 from unittest import TestCase
 
 from django.conf import settings
 
-from .. import jail_code
+from .. import jail_code, safe_exec, subproc
+from ..backends import RemoteBackend
 from ..django_integration import ConfigureCodeJailMiddleware, MiddlewareNotUsed
 from ..django_integration_utils import apply_django_settings
 from .util import ResetJailCodeStateMixin
@@ -59,6 +62,157 @@ class ApplyDjangoSettingsTest(ResetJailCodeStateMixin, TestCase):
             }
         )
 
+    def test_zygote_config(self):
+        """
+        Test that a zygote can be configured for Python.
+        """
+        apply_django_settings({
+            'python_bin': '/a/b/c/bin/python',
+            'user': 'python_executor',
+            'zygote': {
+                'preload_modules': ['six', 'numpy'],
+            },
+        })
+        assert jail_code.PRELOAD_MODULES == {'python': ['six', 'numpy']}
+
+    def test_staging_cache_config(self):
+        """
+        Test that a staging cache can be configured.
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            apply_django_settings({
+                'staging_cache': {
+                    'max_size': 1000,
+                    'cache_dir': cache_dir,
+                },
+            })
+            assert jail_code.STAGING_CACHE.cache_dir == cache_dir
+            assert jail_code.STAGING_CACHE.max_size == 1000
+
+    def test_background_cleanup_config(self):
+        """
+        Test that background cleanup can be configured.
+        """
+        apply_django_settings({
+            'background_cleanup': {
+                'max_backlog': 10,
+                'batch_size': 5,
+            },
+        })
+        assert jail_code.CLEANUP_REAPER.max_backlog == 10
+        assert jail_code.CLEANUP_REAPER.batch_size == 5
+
+    def test_homedir_pool_config(self):
+        """
+        Test that a pool of home directories can be configured.
+        """
+        with tempfile.TemporaryDirectory() as root:
+            apply_django_settings({
+                'homedir_pool': {
+                    'root': root,
+                    'size': 2,
+                },
+            })
+            assert jail_code.HOMEDIR_POOL.root == root
+            assert jail_code.HOMEDIR_POOL.size == 2
+            jail_code.HOMEDIR_POOL.close()
+
+    def test_prlimit_config(self):
+        """
+        Test that starting processes with prlimit can be configured.
+        """
+        self.addCleanup(setattr, subproc, "PRLIMIT", subproc.PRLIMIT)
+        apply_django_settings({
+            'prlimit': '/usr/local/bin/prlimit',
+        })
+        assert subproc.PRLIMIT == '/usr/local/bin/prlimit'
+
+    def test_admission_config(self):
+        """
+        Test that admission control can be configured.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            apply_django_settings({
+                'admission': {
+                    'slots': 4,
+                    'timeout': 2,
+                    'directory': directory,
+                },
+            })
+            assert jail_code.ADMISSION.slots == 4
+            assert jail_code.ADMISSION.timeout == 2
+            assert jail_code.ADMISSION.directory == directory
+
+    def test_scheduler_config(self):
+        """
+        Test that the scheduler can be configured, with priorities and weights for contexts.
+        """
+        apply_django_settings({
+            'scheduler': {
+                'slots': 3,
+                'timeout': 30,
+            },
+            'limit_overrides': {
+                'course-v1:a+regrade': {'PRIORITY': -1, 'WEIGHT': 0.5},
+            },
+        })
+        assert jail_code.SCHEDULER.slots == 3
+        assert jail_code.SCHEDULER.timeout == 30
+        limits = jail_code.get_effective_limits('course-v1:a+regrade')
+        assert limits['PRIORITY'] == -1
+        assert limits['WEIGHT'] == 0.5
+
+    def test_quotas_config(self):
+        """
+        Test that quotas can be configured.
+        """
+        apply_django_settings({
+            'quotas': {
+                'window': 300,
+            },
+        })
+        assert jail_code.QUOTAS.window == 300
+
+    def test_remote_backend_config(self):
+        """
+        Test that a remote backend can be configured.
+        """
+        apply_django_settings({
+            'remote_backend': {
+                'endpoints': ['10.0.0.1:7870', '10.0.0.2:7870'],
+                'pool_size': 2,
+            },
+        })
+        assert isinstance(jail_code.BACKEND, RemoteBackend)
+        assert [endpoint.address for endpoint in jail_code.BACKEND.endpoints] == [
+            ('10.0.0.1', 7870), ('10.0.0.2', 7870),
+        ]
+
+    def test_cgroups_config(self):
+        """
+        Test that running executions in cgroups can be configured.
+        """
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, 'cgroup.controllers'), 'w', encoding='ascii') as controllers:
+                controllers.write('cpu memory pids\n')
+            apply_django_settings({
+                'cgroups': {
+                    'root': root,
+                },
+            })
+            assert jail_code.CGROUP_ROOT.path == root
+            assert jail_code.CGROUP_ROOT.controllers == {'cpu', 'memory', 'pids'}
+
+    def test_json_codec_config(self):
+        """
+        Test that the JSON codec can be configured.
+        """
+        self.addCleanup(setattr, safe_exec, "JSON_CODEC", safe_exec.JSON_CODEC)
+        apply_django_settings({
+            'json_codec': 'orjson',
+        })
+        assert safe_exec.JSON_CODEC == 'orjson'
+
     def test_limits_config(self):
         """
         Test that limits can be configured.
@@ -78,8 +232,18 @@ class ApplyDjangoSettingsTest(ResetJailCodeStateMixin, TestCase):
                 'REALTIME': 7,
                 'VMEM': 123456789,
                 'FSIZE': 0,
+                'STDOUT': 0,
+                'STDERR': 0,
                 'NPROC': 15,
+                'MEMORY': 0,
+                'CPUS': 0,
                 'PROXY': 1,
+                'PROFILE': False,
+                'PRIORITY': 0,
+                'WEIGHT': 1,
+                'CPU_QUOTA': 0,
+                'RATE_QUOTA': 0,
+                'CONCURRENCY_QUOTA': 0,
             }
         )
 
@@ -98,6 +262,8 @@ class ApplyDjangoSettingsTest(ResetJailCodeStateMixin, TestCase):
                 'course-v1:a+b+c': {
                     'CPU': 50,
                     'FSIZE': 88,
+                    'STDOUT': 0,
+                    'STDERR': 0,
                 },
                 'pathway-v1:x+y+z': {
                     'VMEM': 987654321,
@@ -114,8 +280,18 @@ class ApplyDjangoSettingsTest(ResetJailCodeStateMixin, TestCase):
                 'REALTIME': 7,
                 'VMEM': 123456789,
                 'FSIZE': 0,
+                'STDOUT': 0,
+                'STDERR': 0,
                 'NPROC': 15,
+                'MEMORY': 0,
+                'CPUS': 0,
                 'PROXY': 1,
+                'PROFILE': False,
+                'PRIORITY': 0,
+                'WEIGHT': 1,
+                'CPU_QUOTA': 0,
+                'RATE_QUOTA': 0,
+                'CONCURRENCY_QUOTA': 0,
             }
         )
 
@@ -133,8 +309,18 @@ class ApplyDjangoSettingsTest(ResetJailCodeStateMixin, TestCase):
                 'REALTIME': 7,
                 'VMEM': 123456789,
                 'FSIZE': 88,
+                'STDOUT': 0,
+                'STDERR': 0,
                 'NPROC': 15,
+                'MEMORY': 0,
+                'CPUS': 0,
                 'PROXY': 1,
+                'PROFILE': False,
+                'PRIORITY': 0,
+                'WEIGHT': 1,
+                'CPU_QUOTA': 0,
+                'RATE_QUOTA': 0,
+                'CONCURRENCY_QUOTA': 0,
             }
         )
 
@@ -146,8 +332,18 @@ class ApplyDjangoSettingsTest(ResetJailCodeStateMixin, TestCase):
                 'REALTIME': 7,
                 'VMEM': 987654321,
                 'FSIZE': 0,
+                'STDOUT': 0,
+                'STDERR': 0,
                 'NPROC': 15,
+                'MEMORY': 0,
+                'CPUS': 0,
                 'PROXY': 1,
+                'PROFILE': False,
+                'PRIORITY': 0,
+                'WEIGHT': 1,
+                'CPU_QUOTA': 0,
+                'RATE_QUOTA': 0,
+                'CONCURRENCY_QUOTA': 0,
             }
         )
 
@@ -0,0 +1,85 @@
+"""Test executor.py"""
+
+import os
+from unittest import TestCase, mock
+
+from codejail.executor import JailExecutor, default_max_workers
+from codejail.jail_code import LIMITS, JailResult, override_limit, set_limit
+from codejail.safe_exec import SafeExecException, safe_exec
+
+from .test_jail_code import JailCodeHelpersMixin, jailpy
+from .util import ResetJailCodeStateMixin
+
+
+class TestDefaultMaxWorkers(ResetJailCodeStateMixin, TestCase):
+    """Tests of `default_max_workers`."""
+
+    @mock.patch("os.cpu_count", return_value=8)
+    def test_cpu_count(self, _):
+        set_limit("PROXY", 0)
+        set_limit("NPROC", 0)
+        self.assertEqual(default_max_workers(), 8)
+
+    @mock.patch("os.cpu_count", return_value=8)
+    def test_nproc_limit(self, _):
+        set_limit("PROXY", 0)
+        set_limit("NPROC", 3)
+        self.assertEqual(default_max_workers(), 3)
+        override_limit("NPROC", 5, "course-v1:a+b+c")
+        self.assertEqual(default_max_workers("course-v1:a+b+c"), 5)
+
+    @mock.patch("os.cpu_count", return_value=8)
+    def test_proxy_limit(self, _):
+        set_limit("PROXY", 2)
+        self.assertEqual(default_max_workers(), 2)
+
+    @mock.patch("os.cpu_count", return_value=8)
+    @mock.patch.dict(os.environ, {"CODEJAIL_PROXY": "4"})
+    def test_proxy_from_environment(self, _):
+        self.assertEqual(default_max_workers(), 4)
+
+    @mock.patch("os.cpu_count", return_value=None)
+    def test_unknown_cpu_count(self, _):
+        set_limit("PROXY", 0)
+        self.assertEqual(default_max_workers(), 1)
+
+    def test_explicit_max_workers(self):
+        with JailExecutor(max_workers=3) as executor:
+            self.assertEqual(executor._max_workers, 3)  # pylint: disable=protected-access
+
+
+class TestJailExecutor(JailCodeHelpersMixin, TestCase):
+    """Tests of running code with a `JailExecutor`."""
+
+    def setUp(self):
+        super().setUp()
+        self.old_limits = dict(LIMITS)
+        set_limit("REALTIME", 10)
+
+    def tearDown(self):
+        for name, value in self.old_limits.items():
+            set_limit(name, value)
+        super().tearDown()
+
+    def test_submit_jail_code(self):
+        with JailExecutor(max_workers=2) as executor:
+            future = executor.submit(jailpy, code="print('Hello, world!')")
+            res = future.result()
+        self.assertIsInstance(res, JailResult)
+        self.assertResultOk(res)
+        self.assertEqual(res.stdout, b"Hello, world!\n")
+
+    def test_map_safe_exec(self):
+        def square(n):
+            globs = {"n": n}
+            safe_exec("n = n * n", globs)
+            return globs["n"]
+
+        with JailExecutor(max_workers=2) as executor:
+            self.assertEqual(list(executor.map(square, range(5))), [0, 1, 4, 9, 16])
+
+    def test_safe_exec_exception(self):
+        with JailExecutor(max_workers=2) as executor:
+            future = executor.submit(safe_exec, "1/0", {})
+            with self.assertRaisesRegex(SafeExecException, "ZeroDivisionError"):
+                future.result()
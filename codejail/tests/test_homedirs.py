@@ -0,0 +1,184 @@
+"""Test homedirs.py"""
+
+import os
+import os.path
+import shutil
+import stat
+import tempfile
+import time
+from unittest import TestCase, mock
+
+from codejail import jail_code
+from codejail.homedirs import HomedirPool, make_homedir
+
+from .test_jail_code import JailCodeHelpersMixin, jailpy
+
+
+class TestHomedirPool(TestCase):
+    """Tests of `HomedirPool`."""
+
+    def setUp(self):
+        super().setUp()
+        self.root = tempfile.mkdtemp(prefix="codejail-test-")
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def make_pool(self, **kwargs):
+        """Make a pool in a directory of its own, closed at the end of the test."""
+        pool = HomedirPool(root=os.path.join(self.root, "homes"), **kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def wait_until_ready(self, pool, count):
+        """Wait for the pool to have `count` directories ready."""
+        while len(pool._ready) < count:  # pylint: disable=protected-access
+            time.sleep(0.001)
+
+    def assert_is_homedir(self, homedir):
+        """Check that `homedir` is a home directory ready for an execution."""
+        self.assertEqual(stat.S_IMODE(os.stat(homedir).st_mode), 0o775)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(homedir, "tmp")).st_mode), 0o777)
+        self.assertEqual(os.listdir(homedir), ["tmp"])
+
+    def test_make_homedir(self):
+        homedir = make_homedir(self.root)
+        self.assertEqual(os.path.dirname(homedir), self.root)
+        self.assert_is_homedir(homedir)
+
+    def test_directories_are_made_ahead(self):
+        pool = self.make_pool(size=3)
+        self.wait_until_ready(pool, 3)
+        homedir = pool.take()
+        self.assertEqual(os.path.dirname(homedir), pool.root)
+        self.assert_is_homedir(homedir)
+        self.assertEqual(pool.misses, 0)
+        self.assertEqual(pool.in_use, 1)
+
+        # The pool is replenished.
+        self.wait_until_ready(pool, 3)
+        self.assertEqual(len(os.listdir(pool.root)), 4)
+
+        pool.release(homedir)
+        self.assertFalse(os.path.exists(homedir))
+        self.assertEqual(pool.in_use, 0)
+
+    def test_root_cant_be_listed(self):
+        pool = self.make_pool(size=0)
+        self.assertEqual(stat.S_IMODE(os.stat(pool.root).st_mode), 0o711)
+
+    def test_default_root_is_the_temp_directory(self):
+        pool = HomedirPool(size=0)
+        self.addCleanup(pool.close)
+        homedir = pool.take()
+        self.assertEqual(os.path.dirname(homedir), os.path.abspath(tempfile.gettempdir()))
+        self.assertTrue(os.path.basename(homedir).startswith("codejail-"))
+        self.assertEqual(pool.in_use, 1)
+        pool.release(homedir)
+        self.assertEqual(pool.in_use, 0)
+
+    def test_empty_pool_makes_a_directory(self):
+        pool = self.make_pool(size=0)
+        homedir = pool.take()
+        self.assertEqual(os.path.dirname(homedir), pool.root)
+        self.assert_is_homedir(homedir)
+        self.assertEqual(pool.misses, 1)
+        pool.release(homedir)
+
+    def test_capacity(self):
+        # Only the free space counts, not the whole filesystem.
+        statvfs = mock.Mock(f_blocks=1000, f_bavail=200, f_frsize=4096)
+        with mock.patch("codejail.homedirs.os.statvfs", return_value=statvfs):
+            pool = self.make_pool(size=1, capacity=100 * 4096)
+        self.assertEqual(pool.max_in_use, 2)
+        homedirs = [pool.take() for _ in range(3)]
+        self.assertEqual([os.path.dirname(homedir) == pool.root for homedir in homedirs], [True, True, False])
+        self.assertEqual(pool.overflows, 1)
+        self.assertEqual(pool.in_use, 2)
+
+        # Once a directory is released, there's room in the root again.
+        pool.release(homedirs[0])
+        pool.release(homedirs[2])
+        self.assertEqual(pool.in_use, 1)
+        homedir = pool.take()
+        self.assertEqual(os.path.dirname(homedir), pool.root)
+        pool.release(homedir)
+        pool.release(homedirs[1])
+
+    def test_close_removes_ready_directories(self):
+        pool = self.make_pool(size=2)
+        self.wait_until_ready(pool, 2)
+        homedir = pool.take()
+        pool.close()
+        self.assertEqual(os.listdir(pool.root), [os.path.basename(homedir)])
+        pool.release(homedir)
+
+    @mock.patch("codejail.homedirs.make_homedir", side_effect=OSError("No space left on device"))
+    def test_failures_are_logged(self, _):
+        with mock.patch("codejail.homedirs.log") as log:
+            pool = self.make_pool(size=2)
+            with self.assertRaises(OSError):
+                pool.take()
+            while not log.exception.called:
+                time.sleep(0.001)
+        self.assertIn("Couldn't make", log.exception.call_args[0][0])
+        self.assertEqual(pool.in_use, 0)
+
+
+class TestJailCodeWithHomedirPool(JailCodeHelpersMixin, TestCase):
+    """Tests of `jail_code` with a pool of home directories."""
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, jail_code, "HOMEDIR_POOL", jail_code.HOMEDIR_POOL)
+        self.addCleanup(setattr, jail_code, "CLEANUP_REAPER", jail_code.CLEANUP_REAPER)
+        jail_code.configure_homedir_pool(size=2)
+        self.addCleanup(jail_code.HOMEDIR_POOL.close)
+        old_fsize = jail_code.LIMITS["FSIZE"]
+        self.addCleanup(jail_code.set_limit, "FSIZE", old_fsize)
+        jail_code.set_limit("FSIZE", 1000)
+
+    def run_in_homedirs(self, count):
+        """Run code that writes a temp file `count` times, and return the home directories."""
+        homedirs = []
+        for _ in range(count):
+            res = jailpy(code="""
+                import os, tempfile
+                tempfile.NamedTemporaryFile(delete=False).write(b"scratch")
+                print(os.getcwd())
+            """)
+            self.assertResultOk(res)
+            homedirs.append(res.stdout.decode("utf-8").strip())
+        return homedirs
+
+    def test_directories_come_from_the_pool(self):
+        pool = jail_code.HOMEDIR_POOL
+        for homedir in self.run_in_homedirs(3):
+            self.assertEqual(os.path.dirname(homedir), os.path.realpath(pool.root))
+            self.assertFalse(os.path.exists(homedir))
+        self.assertEqual(pool.in_use, 0)
+
+    def test_with_background_cleanup(self):
+        jail_code.configure_background_cleanup()
+        homedirs = self.run_in_homedirs(3)
+        jail_code.CLEANUP_REAPER.flush()
+        for homedir in homedirs:
+            self.assertFalse(os.path.exists(homedir))
+        self.assertEqual(jail_code.HOMEDIR_POOL.in_use, 0)
+        self.assertEqual(jail_code.CLEANUP_REAPER.failures, 0)
+
+    def test_find_other_sandboxes(self):
+        # Like `TestMalware.test_find_other_sandboxes`, with directories
+        # of other executions ready in the pool.
+        pool = jail_code.HOMEDIR_POOL
+        while len(pool._ready) < 2:  # pylint: disable=protected-access
+            time.sleep(0.001)
+        res = jailpy(code="""
+            import os
+            for place in ["..", os.path.dirname(os.getcwd()), %r]:
+                try:
+                    print("Files in %%r: %%r" %% (place, os.listdir(place)))
+                except OSError:
+                    pass
+            print("Done.")
+            """ % pool.root)
+        self.assertResultOk(res)
+        self.assertEqual(res.stdout, b"Done.\n")
@@ -0,0 +1,132 @@
+"""Test instrumentation.py"""
+
+import asyncio
+from unittest import TestCase, mock
+
+from codejail import instrumentation
+from codejail.instrumentation import Timings
+from codejail.jail_code import LIMITS, set_limit
+from codejail.safe_exec import SafeExecException, async_safe_exec, safe_exec
+
+from .test_jail_code import JailCodeHelpersMixin, jailpy
+
+JAIL_CODE_PHASES = {"jail_code", "stage", "execute", "spawn", "run", "cleanup"}
+
+
+class TestTimings(TestCase):
+    """Tests of `Timings`."""
+
+    def test_add(self):
+        timings = Timings()
+        timings.add("a", 1.0, 1.5)
+        timings.add("b", 1.5, 4.0)
+        self.assertEqual(timings.durations(), {"a": 0.5, "b": 2.5})
+
+    def test_add_again_extends_the_phase(self):
+        timings = Timings()
+        timings.add("a", 2.0, 3.0)
+        timings.add_all({"a": [1.0, 1.5], "b": (5.0, 6.0)})
+        self.assertEqual(timings.phases, {"a": (1.0, 3.0), "b": (5.0, 6.0)})
+
+    @mock.patch("time.monotonic", side_effect=[10.0, 12.5])
+    def test_phase(self, _):
+        timings = Timings()
+        with self.assertRaises(ValueError):
+            with timings.phase("oops"):
+                raise ValueError()
+        self.assertEqual(timings.phases, {"oops": (10.0, 12.5)})
+
+
+class TestExecutionHooks(JailCodeHelpersMixin, TestCase):
+    """Tests of the timings of executions, and the hooks that report them."""
+
+    def setUp(self):
+        super().setUp()
+        self.old_limits = dict(LIMITS)
+        set_limit("REALTIME", 10)
+        self.events = []
+        self.add_hooks(
+            lambda info: self.events.append(("pre", info.kind, info.result)),
+            lambda info: self.events.append(("post", info.kind, info)),
+        )
+
+    def tearDown(self):
+        for name, value in self.old_limits.items():
+            set_limit(name, value)
+        super().tearDown()
+
+    def add_hooks(self, pre, post):
+        """Add execution hooks for the duration of the test."""
+        instrumentation.add_pre_execution_hook(pre)
+        instrumentation.add_post_execution_hook(post)
+        self.addCleanup(instrumentation.remove_execution_hook, pre)
+        self.addCleanup(instrumentation.remove_execution_hook, post)
+
+    def assert_phases_are_ordered(self, timings, outer, inner):
+        """Check that each of the phases `inner` is within the phase `outer`."""
+        outer_start, outer_end = timings.phases[outer]
+        for phase in inner:
+            start, end = timings.phases[phase]
+            self.assertTrue(outer_start <= start <= end <= outer_end, phase)
+
+    def test_jail_code_timings(self):
+        res = jailpy(code="print('Hello')", slug="hello")
+        self.assertResultOk(res)
+        self.assertEqual(set(res.timings.phases), JAIL_CODE_PHASES)
+        self.assert_phases_are_ordered(res.timings, "jail_code", JAIL_CODE_PHASES)
+        self.assert_phases_are_ordered(res.timings, "execute", ["spawn", "run"])
+        stage_end = res.timings.phases["stage"][1]
+        run_end = res.timings.phases["run"][1]
+        self.assertLessEqual(stage_end, res.timings.phases["spawn"][0])
+        self.assertLessEqual(run_end, res.timings.phases["cleanup"][0])
+
+    def test_jail_code_hooks(self):
+        res = jailpy(code="print('Hello')", slug="hello")
+        self.assertEqual(len(self.events), 2)
+        self.assertEqual(self.events[0], ("pre", "jail_code", None))
+        self.assertEqual(self.events[1][:2], ("post", "jail_code"))
+        info = self.events[1][2]
+        self.assertEqual((info.command, info.slug, info.limit_overrides_context), ("python", "hello", None))
+        self.assertIs(info.result, res)
+        self.assertIs(info.timings, res.timings)
+        self.assertIsNone(info.error)
+
+    def test_safe_exec_timings(self):
+        globs = {"a": 1}
+        safe_exec("a += 1", globs, slug="add")
+        self.assertEqual(globs["a"], 2)
+        kinds = [(event, kind) for event, kind, _ in self.events]
+        self.assertEqual(kinds, [
+            ("pre", "safe_exec"), ("pre", "jail_code"), ("post", "jail_code"), ("post", "safe_exec"),
+        ])
+        info = self.events[-1][2]
+        self.assertEqual(set(info.timings.phases), JAIL_CODE_PHASES | {"safe_exec", "encode", "cache", "decode"})
+        self.assert_phases_are_ordered(info.timings, "safe_exec", info.timings.phases)
+        self.assertLessEqual(info.timings.phases["encode"][1], info.timings.phases["jail_code"][0])
+        self.assertLessEqual(info.timings.phases["jail_code"][1], info.timings.phases["decode"][0])
+
+    def test_async_safe_exec_timings(self):
+        globs = {"a": 1}
+        asyncio.run(async_safe_exec("a += 1", globs))
+        self.assertEqual(globs["a"], 2)
+        info = self.events[-1][2]
+        self.assertEqual(info.kind, "safe_exec")
+        self.assertEqual(set(info.timings.phases), JAIL_CODE_PHASES | {"safe_exec", "encode", "cache", "decode"})
+
+    def test_error_is_reported(self):
+        with self.assertRaises(SafeExecException):
+            safe_exec("1/0", {})
+        info = self.events[-1][2]
+        self.assertIsInstance(info.error, SafeExecException)
+        self.assertIn("decode", info.timings.phases)
+
+    @mock.patch("codejail.instrumentation.log")
+    def test_failing_hook_is_ignored(self, log):
+        def broken_hook(info):
+            raise ValueError("Broken hook for %s" % info.kind)
+
+        self.add_hooks(broken_hook, broken_hook)
+        res = jailpy(code="print('Hello')")
+        self.assertResultOk(res)
+        self.assertEqual(log.exception.call_count, 2)
+        self.assertEqual(len(self.events), 2)
@@ -1,5 +1,6 @@
 """Test jail_code.py"""
 
+import asyncio
 import logging
 import os
 import os.path
@@ -7,11 +8,21 @@ import shutil
 import signal
 import tempfile
 import textwrap
+import threading
 import time
 from unittest import SkipTest, TestCase, mock
 
-from codejail import proxy
-from codejail.jail_code import LIMITS, is_configured, jail_code, set_limit
+from codejail import homedirs, proxy, subproc
+from codejail.jail_code import (
+    COMMANDS,
+    LIMITS,
+    async_jail_code,
+    configure,
+    configure_prlimit,
+    is_configured,
+    jail_code,
+    set_limit,
+)
 
 
 def jailpy(code=None, *args, **kwargs):  # pylint: disable=keyword-arg-before-vararg
@@ -21,6 +32,27 @@ def jailpy(code=None, *args, **kwargs):  # pylint: disable=keyword-arg-before-va
     return jail_code("python", code, *args, **kwargs)
 
 
+def cancel_async_jailpy(code, after=.5):
+    """
+    Run `async_jail_code` on Python, and cancel it after `after` seconds.
+
+    Returns the seconds it took to be cancelled.
+
+    """
+    async def run_and_cancel():
+        task = asyncio.ensure_future(async_jail_code("python", textwrap.dedent(code)))
+        await asyncio.sleep(after)
+        task.cancel()
+        await task
+
+    start = time.time()
+    try:
+        asyncio.run(run_and_cancel())
+    except asyncio.CancelledError:
+        return time.time() - start
+    raise AssertionError("The execution wasn't cancelled")
+
+
 def file_here(fname):
     """Return the full path to a file alongside this code."""
     return os.path.join(os.path.dirname(__file__), fname)
@@ -248,6 +280,32 @@ class TestFeatures(JailCodeHelpersMixin, TestCase):
         log_text = text_of_logs(log_log.mock_calls)
         self.assertRegex(log_text, r"INFO: Executed jailed code HELLO in .*, with PID .*")
 
+    def test_rusage(self):
+        res = jailpy(code="""
+            import time
+            data = bytearray(50 * 1024 * 1024)
+            start = time.process_time()
+            while time.process_time() - start < 0.2:
+                pass
+        """)
+        self.assertResultOk(res)
+        self.assertGreaterEqual(res.rusage["user_time"] + res.rusage["system_time"], 0.2)
+        self.assertGreaterEqual(res.rusage["max_rss"], 50 * 1024 * 1024)
+        self.assertIsInstance(res.rusage["voluntary_switches"], int)
+        self.assertIsInstance(res.rusage["involuntary_switches"], int)
+
+    def test_no_user(self):
+        # With no user, the code runs as us, and still gets its temp directory.
+        old_command = COMMANDS["python"]
+        self.addCleanup(COMMANDS.__setitem__, "python", old_command)
+        configure("python", old_command["cmdline_start"][0])
+        res = jailpy(code="""
+            import os
+            print(os.getuid(), os.environ["TMPDIR"])
+        """)
+        self.assertResultOk(res)
+        self.assertEqual(res.stdout, b"%d tmp\n" % os.getuid())
+
 
 class TestLimits(JailCodeHelpersMixin, TestCase):
     """Tests of the resource limits, and changing them."""
@@ -329,6 +387,46 @@ class TestLimits(JailCodeHelpersMixin, TestCase):
         log_text = text_of_logs(log_log.mock_calls)
         self.assertRegex(log_text, r"WARNING: Killing process \d+")
 
+    def test_cant_write_too_much_output(self):
+        set_limit('CPU', 100)
+        set_limit('REALTIME', 10)
+        set_limit('STDOUT', 100000)
+        res = jailpy(code="""
+            import sys
+            sys.stderr.write("Starting\\n")
+            while True:
+                print('x' * 999)
+        """)
+        self.assertEqual(res.status, -signal.SIGKILL)
+        self.assertEqual(res.stdout, (b'x' * 999 + b'\n') * 100)
+        self.assertTrue(res.stdout_truncated)
+        self.assertEqual(res.stderr, b"Starting\n")
+        self.assertFalse(res.stderr_truncated)
+
+    def test_cant_write_too_much_stderr(self):
+        set_limit('CPU', 100)
+        set_limit('REALTIME', 10)
+        set_limit('STDERR', 10)
+        res = jailpy(code="""
+            import sys
+            print("Hello")
+            sys.stdout.flush()
+            while True:
+                sys.stderr.write('oops\\n')
+        """)
+        self.assertEqual(res.status, -signal.SIGKILL)
+        self.assertEqual(res.stdout, b"Hello\n")
+        self.assertFalse(res.stdout_truncated)
+        self.assertEqual(res.stderr, b"oops\noops\n")
+        self.assertTrue(res.stderr_truncated)
+
+    def test_output_within_limit_isnt_truncated(self):
+        set_limit('STDOUT', 6)
+        res = jailpy(code="print('Hello')")
+        self.assertResultOk(res)
+        self.assertEqual(res.stdout, b"Hello\n")
+        self.assertFalse(res.stdout_truncated)
+
     def test_changing_realtime_limit(self):
         # Change time limit to 2 seconds, sleeping for 1.5 will be fine.
         set_limit('REALTIME', 2)
@@ -502,6 +600,164 @@ class TestLimits(JailCodeHelpersMixin, TestCase):
         self.assertNotEqual(res.status, 0)
 
 
+class TestLimitsWithPrlimit(TestLimits):
+    """Run TestLimits, with processes started by prlimit instead of a proxy."""
+
+    def setUp(self):
+        super().setUp()
+        if shutil.which("prlimit") is None:
+            raise SkipTest("prlimit isn't installed")
+        self.addCleanup(setattr, subproc, "PRLIMIT", subproc.PRLIMIT)
+        configure_prlimit()
+        set_limit("PROXY", 0)
+
+
+class TestAsyncJailCode(JailCodeHelpersMixin, TestCase):
+    """Tests of `async_jail_code`."""
+
+    def setUp(self):
+        super().setUp()
+        self.old_limits = dict(LIMITS)
+
+    def tearDown(self):
+        for name, value in self.old_limits.items():
+            set_limit(name, value)
+        super().tearDown()
+
+    def async_jailpy(self, code, **kwargs):
+        """Run `async_jail_code` on Python, in a new event loop."""
+        return asyncio.run(async_jail_code("python", textwrap.dedent(code), **kwargs))
+
+    def test_hello_world(self):
+        res = self.async_jailpy(code="""
+            print('Hello, world!')
+        """)
+        self.assertResultOk(res)
+        self.assertEqual(res.stdout, b'Hello, world!\n')
+
+    def test_stdin_and_files(self):
+        res = self.async_jailpy(
+            code="""
+                import sys
+                print(sys.stdin.read(), open('hello.txt').read())
+            """,
+            stdin="Look:",
+            files=[file_here("hello.txt")],
+        )
+        self.assertResultOk(res)
+        self.assertEqual(res.stdout, b'Look: Hello there.\n\n')
+
+    def test_ends_with_exception(self):
+        res = self.async_jailpy(code="""raise Exception('FAIL')""")
+        self.assertEqual(res.status, 1)
+        self.assertIn(b"Exception: FAIL", res.stderr)
+
+    @mock.patch("codejail.subproc.log._log")
+    def test_cant_use_too_much_time(self, log_log):
+        set_limit('CPU', 100)
+        set_limit('REALTIME', 1)
+        res = self.async_jailpy(code="""
+            import sys, time
+            print('Started')
+            sys.stdout.flush()
+            time.sleep(1.5)
+            print('Done!')
+        """)
+        self.assertEqual(res.stdout, b"Started\n")
+        self.assertEqual(res.status, -signal.SIGKILL)
+        log_text = text_of_logs(log_log.mock_calls)
+        self.assertRegex(log_text, r"WARNING: Killing process \d+ .*ran too long")
+
+    def test_cant_write_too_much_output(self):
+        set_limit('CPU', 100)
+        set_limit('REALTIME', 10)
+        set_limit('STDOUT', 100000)
+        res = self.async_jailpy(code="""
+            while True:
+                print('x' * 999)
+        """)
+        self.assertEqual(res.status, -signal.SIGKILL)
+        self.assertEqual(res.stdout, (b'x' * 999 + b'\n') * 100)
+        self.assertTrue(res.stdout_truncated)
+
+    def test_runs_concurrently(self):
+        # Only direct execution is native to asyncio.
+        set_limit('PROXY', 0)
+        set_limit('REALTIME', 5)
+
+        async def run_many():
+            return await asyncio.gather(*(
+                async_jail_code("python", "import time; time.sleep(.5); print(%d)" % i)
+                for i in range(5)
+            ))
+
+        start = time.time()
+        results = asyncio.run(run_many())
+        self.assertLess(time.time() - start, 2.0)
+        for i, res in enumerate(results):
+            self.assertResultOk(res)
+            self.assertEqual(res.stdout, b"%d\n" % i)
+
+    @mock.patch("codejail.subproc.log._log")
+    def test_cancelling(self, log_log):
+        # Only direct execution is native to asyncio.
+        set_limit('PROXY', 0)
+        set_limit('CPU', 100)
+        set_limit('REALTIME', 10)
+        self.assertLess(cancel_async_jailpy("import time; time.sleep(5)"), 3)
+        log_text = text_of_logs(log_log.mock_calls)
+        self.assertRegex(log_text, r"WARNING: Killing process \d+ .*cancelled")
+
+    @mock.patch("codejail.subproc.log._log")
+    def test_cancelling_through_proxy(self, log_log):
+        set_limit('PROXY', 1)
+        set_limit('CPU', 100)
+        set_limit('REALTIME', 10)
+        self.assertLess(cancel_async_jailpy("import time; time.sleep(5)"), 3)
+        log_text = text_of_logs(log_log.mock_calls)
+        self.assertRegex(log_text, r"WARNING: Killing process \d+ .*cancelled")
+        # The proxy is still working.
+        self.assertResultOk(self.async_jailpy(code="print('hi')"))
+
+    def test_staging_is_off_the_event_loop(self):
+        threads = []
+        real_rmtree = shutil.rmtree
+
+        def make_homedir(*args):
+            threads.append(threading.current_thread())
+            return homedirs.make_homedir(*args)
+
+        def rmtree(path):
+            threads.append(threading.current_thread())
+            real_rmtree(path)
+
+        with mock.patch("codejail.jail_code.make_homedir", make_homedir), \
+                mock.patch("codejail.jail_code.shutil.rmtree", rmtree):
+            self.assertResultOk(self.async_jailpy(code="print('hi')"))
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_cancelling_cleans_up(self):
+        set_limit('CPU', 100)
+        set_limit('REALTIME', 10)
+        set_limit('FSIZE', 1000)
+        made = []
+
+        def make_homedir(*args):
+            made.append(homedirs.make_homedir(*args))
+            return made[-1]
+
+        # The sandbox user's directory is removed, so the home directory can be.
+        with mock.patch("codejail.jail_code.make_homedir", make_homedir):
+            cancel_async_jailpy("""
+                import tempfile, time
+                tempfile.NamedTemporaryFile(dir=tempfile.mkdtemp(), delete=False).write(b"scratch")
+                time.sleep(5)
+            """)
+        self.assertEqual(len(made), 1)
+        self.assertFalse(os.path.exists(made[0]))
+
+
 class TestSymlinks(JailCodeHelpersMixin, TestCase):
     """Testing symlink behavior."""
 
@@ -628,23 +884,28 @@ class TestProxyProcess(JailCodeHelpersMixin, TestCase):
         self.assertResultOk(res)
         self.assertEqual(res.stdout, b'Look: %d\n' % num)
 
+    def proxy_pids(self):
+        """The pids of all the proxy processes."""
+        return {p.pid for p in proxy.PROXY_POOL.proxies}
+
     def test_proxy_is_persistent(self):
         # Running code twice, you use the same proxy process.
         self.run_ok()
-        pid = proxy.PROXY_PROCESS.pid
+        pids = self.proxy_pids()
+        self.assertEqual(len(pids), 1)
         self.run_ok()
-        self.assertEqual(proxy.PROXY_PROCESS.pid, pid)
+        self.assertEqual(self.proxy_pids(), pids)
 
     def test_crash_proxy(self):
         # We can run some code.
         self.run_ok()
-        pids = set()
-        pids.add(proxy.PROXY_PROCESS.pid)
+        pids = self.proxy_pids()
 
         # Run this a number of times, to try to catch some cases.
         for i in range(10):
             # The proxy process dies unexpectedly!
-            proxy.PROXY_PROCESS.kill()
+            for proxy_process in proxy.PROXY_POOL.proxies:
+                proxy_process.process.kill()
 
             # The behavior is slightly different if we rush immediately to the
             # next run, or if we wait a bit to let the process truly die, so
@@ -656,6 +917,34 @@ class TestProxyProcess(JailCodeHelpersMixin, TestCase):
             self.run_ok()
 
             # We should have a new proxy process each time.
-            pid = proxy.PROXY_PROCESS.pid
-            self.assertNotIn(pid, pids)
-            pids.add(pid)
+            new_pids = self.proxy_pids()
+            self.assertEqual(len(new_pids), 1)
+            self.assertFalse(new_pids & pids)
+            pids |= new_pids
+
+    def test_concurrent_proxies(self):
+        self.addCleanup(set_limit, "PROXY", LIMITS["PROXY"])
+        self.addCleanup(set_limit, "REALTIME", LIMITS["REALTIME"])
+        set_limit("PROXY", 3)
+        set_limit("REALTIME", 5)
+
+        results = []
+
+        def run_one(num):
+            res = jailpy(code="import time; time.sleep(.5); print('Look: %d')" % num)
+            results.append((num, res))
+
+        threads = [threading.Thread(target=run_one, args=(num,)) for num in range(6)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Six half-second runs on three proxies don't take three seconds.
+        self.assertLess(time.time() - start, 2.5)
+        self.assertEqual(len(results), 6)
+        for num, res in results:
+            self.assertResultOk(res)
+            self.assertEqual(res.stdout, b'Look: %d\n' % num)
+        self.assertLessEqual(len(self.proxy_pids()), 3)
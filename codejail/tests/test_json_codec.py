@@ -0,0 +1,92 @@
+"""Test json_codec.py"""
+
+import importlib.util
+import math
+from unittest import TestCase, skipUnless
+
+from codejail import json_codec, safe_exec
+
+HAS_ORJSON = importlib.util.find_spec("orjson") is not None
+
+# Values whose JSON round trip should be exact with every codec.
+ROUND_TRIP = [
+    {"a": 1, "b": [1.5, True, None, "x"], "c": {"d": []}},
+    ["é☃\U0001f600", "", "\\\"\n"],
+    [2**63 - 1, -2**63, 2**64, -2**100, 10**30],
+    [0.1, 1e300, -0.0],
+]
+
+
+class TestCodecs(TestCase):
+    """Tests of the codecs."""
+
+    def assert_round_trips(self, name):
+        """Check that `ROUND_TRIP` values survive the codec `name`."""
+        _, loads, dumps = json_codec.get_codec(name)
+        for value in ROUND_TRIP:
+            data = dumps(value)
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(loads(data), value)
+            # Anything a codec writes can be read by json.
+            self.assertEqual(json_codec.load_json()[0](data), value)
+
+    def test_json(self):
+        self.assert_round_trips("json")
+
+    def test_simplejson(self):
+        self.assert_round_trips("simplejson")
+
+    @skipUnless(HAS_ORJSON, "orjson isn't installed")
+    def test_orjson(self):
+        self.assertEqual(json_codec.get_codec("orjson")[0], "orjson")
+        self.assert_round_trips("orjson")
+
+    @skipUnless(HAS_ORJSON, "orjson isn't installed")
+    def test_orjson_reads_what_only_json_can(self):
+        _, loads, _ = json_codec.get_codec("orjson")
+        self.assertEqual(loads(b"[123456789012345678901234567890]"), [123456789012345678901234567890])
+        value = loads(b'[NaN, Infinity, "12345678901234567890"]')
+        self.assertTrue(math.isnan(value[0]))
+        self.assertEqual(value[1:], [math.inf, "12345678901234567890"])
+
+    def test_missing_package_falls_back_to_json(self):
+        def load_missing():
+            raise ImportError("No module named 'missing'")
+
+        json_codec.CODECS["missing"] = load_missing
+        self.addCleanup(json_codec.CODECS.pop, "missing")
+        name, loads, dumps = json_codec.get_codec("missing")
+        self.assertEqual(name, "json")
+        self.assertEqual(loads(dumps({"a": 1})), {"a": 1})
+
+
+class TestSafeExecCodecs(TestCase):
+    """Tests of `safe_exec` with each of the codecs."""
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, safe_exec, "JSON_CODEC", safe_exec.JSON_CODEC)
+
+    def assert_safe_exec_works(self, name):
+        """Check that globals pass into and out of the sandbox with the codec `name`."""
+        safe_exec.configure_json_codec(name)
+        globs = {"values": ROUND_TRIP, "big": 2**70, "text": "☃"}
+        safe_exec.safe_exec("big *= 2; text *= 2; new = [values[0], (1, 2)]", globs)
+        self.assertEqual(globs["values"], ROUND_TRIP)
+        self.assertEqual(globs["big"], 2**71)
+        self.assertEqual(globs["text"], "☃☃")
+        self.assertEqual(globs["new"], [ROUND_TRIP[0], [1, 2]])
+
+    def test_json(self):
+        self.assert_safe_exec_works("json")
+
+    def test_simplejson(self):
+        self.assert_safe_exec_works("simplejson")
+
+    @skipUnless(HAS_ORJSON, "orjson isn't installed")
+    def test_orjson(self):
+        self.assert_safe_exec_works("orjson")
+
+    def test_unknown_codec(self):
+        with self.assertRaisesRegex(ValueError, "Unknown JSON codec 'pickle'"):
+            safe_exec.configure_json_codec("pickle")
@@ -0,0 +1,103 @@
+"""Test the proxy process protocol in proxy.py"""
+
+import io
+import os
+import shutil
+import struct
+import tempfile
+from unittest import TestCase, mock
+
+from codejail import proxy
+from codejail.proxy import ProxyProtocolError, read_message, run_subprocess_through_proxy, write_message
+
+
+class TestMessages(TestCase):
+    """Tests of `write_message` and `read_message`."""
+
+    def round_trip(self, header, blobs=()):
+        """Write a message and read it back."""
+        stream = io.BytesIO()
+        write_message(stream, header, blobs)
+        stream.seek(0)
+        message = read_message(stream)
+        self.assertIsNone(read_message(stream))
+        return message
+
+    def test_header_only(self):
+        header, blobs = self.round_trip({"status": 0, "log_calls": [[20, "Hi %s", ["there"]]]})
+        self.assertEqual(header, {"status": 0, "log_calls": [[20, "Hi %s", ["there"]]]})
+        self.assertEqual(blobs, [])
+
+    def test_blobs_are_raw_bytes(self):
+        data = bytes(range(256)) * 40000 + b"\n\x00'\""
+        header, blobs = self.round_trip({"stdin": True}, [data, b"", b"\n"])
+        self.assertEqual(header, {"stdin": True})
+        self.assertEqual(blobs, [data, b"", b"\n"])
+
+    def test_unserializable_values_become_reprs(self):
+        header, _ = self.round_trip({"log_calls": [[10, "%r", [b"bytes"]]]})
+        self.assertEqual(header["log_calls"], [[10, "%r", ["b'bytes'"]]])
+
+    def test_empty_stream(self):
+        self.assertIsNone(read_message(io.BytesIO(b"")))
+
+    def test_truncated_message(self):
+        stream = io.BytesIO()
+        write_message(stream, {"a": 1}, [b"x" * 100])
+        with self.assertRaises(EOFError):
+            read_message(io.BytesIO(stream.getvalue()[:-1]))
+
+    def test_header_too_long(self):
+        with self.assertRaisesRegex(ProxyProtocolError, "too long"):
+            read_message(io.BytesIO(struct.pack("!I", 2**31)))
+
+    def test_bad_header(self):
+        with self.assertRaisesRegex(ProxyProtocolError, "Bad message header"):
+            read_message(io.BytesIO(struct.pack("!I", 3) + b"{{{"))
+
+
+class TestProxyProcess(TestCase):
+    """Tests of running subprocesses through a real proxy process."""
+
+    def test_large_data(self):
+        data = b"0123456789abcdef\n" * 300000
+        status, stdout, stderr, details = run_subprocess_through_proxy(["cat"], stdin=data)
+        self.assertEqual(status, 0)
+        self.assertEqual(stdout, data)
+        self.assertEqual(stderr, b"")
+        self.assertFalse(details["stdout_truncated"])
+        self.assertFalse(details["stderr_truncated"])
+        # The proxy sends the timings of the process it ran.
+        (spawn_start, spawn_end), (run_start, run_end) = details["timings"]["spawn"], details["timings"]["run"]
+        self.assertTrue(spawn_start <= spawn_end == run_start <= run_end)
+
+    def test_positional_arguments(self):
+        status, stdout, _, _ = run_subprocess_through_proxy(["pwd"], None, "/")
+        self.assertEqual(status, 0)
+        self.assertEqual(stdout, b"/\n")
+
+    def test_protocol_version_mismatch(self):
+        with mock.patch.object(proxy, "PROTOCOL_VERSION", 0):
+            with self.assertRaisesRegex(ProxyProtocolError, "speaks protocol 1, not 0"):
+                proxy.ProxyProcess()
+
+    def test_startup_output_is_reported(self):
+        # A proxy that prints something before speaking the protocol reports
+        # what it printed, not just a nonsensical header length.
+        script = os.path.join(self.make_tmp(), "python")
+        with open(script, "w") as f:
+            f.write("#!/bin/sh\necho 'Traceback: ImportError'\necho 'on stderr' >&2\nexit 3\n")
+        os.chmod(script, 0o755)
+        with mock.patch.object(proxy.sys, "executable", script):
+            with self.assertRaises(ProxyProtocolError) as cm:
+                proxy.ProxyProcess()
+        message = str(cm.exception)
+        self.assertIn("b'Trac'", message)
+        self.assertIn("(status 3), then wrote b'eback: ImportError\\n'", message)
+        self.assertNotIn("on stderr", message)
+
+    def make_tmp(self):
+        """Make a temporary directory, removed at the end of the test."""
+        tmp = tempfile.mkdtemp(prefix="codejail-test-proxy-")
+        self.addCleanup(shutil.rmtree, tmp)
+        return tmp
@@ -0,0 +1,145 @@
+"""Test quotas.py"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase, mock
+
+from codejail import jail_code
+from codejail.quotas import QuotaExceeded, Quotas, TokenBucket
+
+from .test_jail_code import JailCodeHelpersMixin, jailpy
+
+
+def limits(cpu=0, rate=0, concurrency=0):
+    """The quota limits of a context."""
+    return {"CPU_QUOTA": cpu, "RATE_QUOTA": rate, "CONCURRENCY_QUOTA": concurrency}
+
+
+class TestQuotas(TestCase):
+    """Tests of `Quotas`, with a clock the tests move."""
+
+    def setUp(self):
+        super().setUp()
+        self.now = 1000.0
+        patcher = mock.patch("codejail.quotas.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = tempfile.mkdtemp(prefix="codejail-test-quotas-")
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.quotas = Quotas(window=60, directory=self.directory)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(10, 2, self.now)
+        self.assertEqual(bucket.level(self.now), 10)
+        bucket.take(15, self.now)
+        self.assertEqual(bucket.level(self.now), -5)
+        self.assertEqual(bucket.level(self.now + 5), 5)
+        self.assertEqual(bucket.level(self.now + 100), 10)
+
+    def test_no_quotas(self):
+        for _ in range(100):
+            self.assertIsNone(self.quotas.start("course", limits()))
+        self.assertEqual(self.quotas.rejections, 0)
+
+    def test_concurrency(self):
+        first = self.quotas.start("course", limits(concurrency=2))
+        self.assertIsNotNone(self.quotas.start("course", limits(concurrency=2)))
+        with self.assertRaisesRegex(QuotaExceeded, "2 executions are already running"):
+            self.quotas.start("course", limits(concurrency=2))
+        # Other contexts have quotas of their own.
+        self.assertIsNotNone(self.quotas.start("other", limits(concurrency=2)))
+        self.quotas.finish(first, 0)
+        self.assertIsNotNone(self.quotas.start("course", limits(concurrency=2)))
+        self.assertEqual(self.quotas.rejections, 1)
+
+    def test_rate(self):
+        for _ in range(5):
+            self.quotas.finish(self.quotas.start("course", limits(rate=5)), 0)
+        with self.assertRaisesRegex(QuotaExceeded, "5 executions a second"):
+            self.quotas.start("course", limits(rate=5))
+        self.now += 0.2
+        self.quotas.start("course", limits(rate=5))
+
+    def test_cpu_is_counted_after_executions(self):
+        self.quotas.finish(self.quotas.start("course", limits(cpu=6)), 10)
+        # The context used more than its quota, so it has to wait for its
+        # bucket to fill again: 4 seconds of CPU at 6 a minute.
+        self.now += 39
+        with self.assertRaisesRegex(QuotaExceeded, "6 CPU seconds in 60 seconds"):
+            self.quotas.start("course", limits(cpu=6))
+        self.now += 2
+        self.quotas.start("course", limits(cpu=6))
+
+    def test_shared_by_processes(self):
+        # Another process using the same directory counts against the same quotas.
+        other = Quotas(window=60, directory=self.directory)
+        running = other.start("course", limits(rate=1, concurrency=1))
+        with self.assertRaisesRegex(QuotaExceeded, "1 executions are already running"):
+            self.quotas.start("course", limits(rate=1, concurrency=1))
+        other.finish(running, 0)
+        with self.assertRaisesRegex(QuotaExceeded, "1 executions a second"):
+            self.quotas.start("course", limits(rate=1, concurrency=1))
+
+    def test_dead_processes_dont_hold_executions(self):
+        code = (
+            "import sys; from codejail.quotas import Quotas; "
+            "Quotas(directory=sys.argv[1]).start('course', {'CPU_QUOTA': 0, 'RATE_QUOTA': 0, 'CONCURRENCY_QUOTA': 1})"
+        )
+        subprocess.run([sys.executable, "-c", code, self.directory], check=True)
+        self.assertIsNotNone(self.quotas.start("course", limits(concurrency=1)))
+
+    def test_idle_contexts_are_removed(self):
+        self.quotas.finish(self.quotas.start("idle", limits(rate=1, concurrency=1)), 0)
+        self.quotas.start("busy", limits(rate=1, concurrency=1))
+        self.quotas.finish(self.quotas.start("used", limits(cpu=6)), 10)
+        self.assertEqual(len(os.listdir(self.directory)), 5)
+
+        # Once a window has passed, the files of the idle context are removed.
+        self.now += 60
+        self.quotas.start("other", limits(rate=1))
+        files = os.listdir(self.directory)
+        self.assertEqual(len(files), 4)
+        for context in ["busy", "used", "other"]:
+            self.assertIn(Quotas._key(context) + ".quota", files)  # pylint: disable=protected-access
+
+    def test_others_directory_is_refused(self):
+        # Anyone could change the buckets in a directory they can write to.
+        os.chmod(self.directory, 0o777)
+        with self.assertRaises(PermissionError):
+            Quotas(directory=self.directory)
+        # A directory that doesn't exist yet is made private.
+        os.chmod(self.directory, 0o700)
+        made = os.path.join(self.directory, "made")
+        Quotas(directory=made)
+        self.assertEqual(os.stat(made).st_mode & 0o777, 0o700)
+
+
+class TestJailCodeWithQuotas(JailCodeHelpersMixin, TestCase):
+    """Tests of `jail_code` with quotas."""
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, jail_code, "QUOTAS", jail_code.QUOTAS)
+        self.addCleanup(setattr, jail_code, "LIMIT_OVERRIDES", jail_code.LIMIT_OVERRIDES)
+        jail_code.LIMIT_OVERRIDES = {}
+        directory = tempfile.mkdtemp(prefix="codejail-test-quotas-")
+        self.addCleanup(shutil.rmtree, directory)
+        jail_code.configure_quotas(directory=directory)
+
+    def test_rate_quota(self):
+        jail_code.override_limit("RATE_QUOTA", 0.001, "course")
+        self.assertResultOk(jailpy(code="print('hello')", limit_overrides_context="course"))
+        with self.assertRaises(QuotaExceeded):
+            jailpy(code="print('hello')", limit_overrides_context="course")
+        # Other contexts aren't affected.
+        self.assertResultOk(jailpy(code="print('hello')"))
+
+    def test_cpu_quota(self):
+        jail_code.override_limit("CPU_QUOTA", 0.001, "course")
+        res = jailpy(code="sum(range(10**6))", limit_overrides_context="course")
+        self.assertResultOk(res)
+        with self.assertRaises(QuotaExceeded):
+            jailpy(code="print('hello')", limit_overrides_context="course")
@@ -0,0 +1,168 @@
+"""Test result_cache.py"""
+
+import os
+import os.path
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from codejail import jail_code, safe_exec
+from codejail.result_cache import MemoryResultCache, SQLiteResultCache, result_key
+
+
+class ResultCacheTests(TestCase):
+    """Tests for any result cache, to be mixed into specific test classes."""
+
+    # ResultCacheTests is abstract, so stop pytest from running the tests.
+    __test__ = False
+
+    def make_cache(self, max_entries, ttl):
+        """Make the cache under test."""
+        raise NotImplementedError       # pragma: no cover
+
+    def test_get_and_set(self):
+        cache = self.make_cache(max_entries=10, ttl=100)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", b'{"x": 1}')
+        self.assertEqual(cache.get("a"), b'{"x": 1}')
+
+    def test_least_recently_used_are_dropped(self):
+        cache = self.make_cache(max_entries=2, ttl=100)
+        with mock.patch("time.time", side_effect=range(1, 100)):
+            cache.set("a", b"1")
+            cache.set("b", b"2")
+            cache.get("a")
+            cache.set("c", b"3")
+            self.assertEqual(cache.get("a"), b"1")
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual(cache.get("c"), b"3")
+
+    def test_entries_expire(self):
+        cache = self.make_cache(max_entries=10, ttl=-1)
+        cache.set("a", b"1")
+        self.assertIsNone(cache.get("a"))
+
+
+class TestMemoryResultCache(ResultCacheTests, TestCase):
+    """Tests of `MemoryResultCache`."""
+
+    __test__ = True
+
+    def make_cache(self, max_entries, ttl):
+        return MemoryResultCache(max_entries=max_entries, ttl=ttl)
+
+    def test_total_size_is_limited(self):
+        cache = MemoryResultCache(max_entries=10, ttl=100, max_bytes=10)
+        cache.set("a", b"1234")
+        cache.set("b", b"5678")
+        cache.set("a", b"12")
+        cache.set("c", b"abcde")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"12")
+        self.assertEqual(cache.get("c"), b"abcde")
+
+        # A result too big for the whole cache isn't stored, and doesn't push
+        # the others out.
+        cache.set("d", b"x" * 11)
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(cache.get("a"), b"12")
+        self.assertEqual(cache.get("c"), b"abcde")
+
+
+class TestSQLiteResultCache(ResultCacheTests, TestCase):
+    """Tests of `SQLiteResultCache`."""
+
+    __test__ = True
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp(prefix="codejail-test-")
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def make_cache(self, max_entries, ttl):
+        return SQLiteResultCache(os.path.join(self.tmp, "results.db"), max_entries=max_entries, ttl=ttl)
+
+    def test_shared_between_instances(self):
+        self.make_cache(max_entries=10, ttl=100).set("a", b"\x00\xff")
+        self.assertEqual(self.make_cache(max_entries=10, ttl=100).get("a"), b"\x00\xff")
+
+
+class TestResultKey(TestCase):
+    """Tests of `result_key`."""
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp(prefix="codejail-test-")
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.lib = os.path.join(self.tmp, "lib")
+        os.mkdir(self.lib)
+        self.write("module.py", "x = 1\n")
+
+    def write(self, name, content):
+        """Write a file in the library directory."""
+        with open(os.path.join(self.lib, name), "w", encoding="utf-8") as f:
+            f.write(content)
+
+    def key(self, *, code="a = 1", argv=(), stdin="[]", files=None, extra_files=(), limits=None):
+        """Compute a key, with defaults for everything."""
+        kwargs = {
+            "code": code,
+            "argv": list(argv),
+            "stdin": stdin,
+            "files": [self.lib] if files is None else files,
+            "extra_files": extra_files,
+        }
+        return result_key(kwargs, limits or {"CPU": 1}, {"cmdline_start": ["python"]})
+
+    def test_same_inputs_same_key(self):
+        self.assertEqual(self.key(), self.key())
+
+    def test_different_inputs_different_keys(self):
+        keys = {
+            self.key(),
+            self.key(code="a = 2"),
+            self.key(argv=["lib"]),
+            self.key(stdin='["x"]'),
+            self.key(files=[]),
+            self.key(extra_files=[("data.txt", b"hi")]),
+            self.key(limits={"CPU": 2}),
+        }
+        self.assertEqual(len(keys), 7)
+
+    def test_changed_file_changes_key(self):
+        before = self.key()
+        self.write("module.py", "x = 2\n")
+        self.assertNotEqual(self.key(), before)
+        self.write("other.py", "")
+        self.assertEqual(len({before, self.key()}), 2)
+
+
+class TestSafeExecWithCache(TestCase):
+    """Tests of `safe_exec` with a result cache."""
+
+    def setUp(self):
+        super().setUp()
+        if not jail_code.is_configured("python"):
+            self.skipTest("python isn't configured")
+        self.cache = MemoryResultCache()
+
+    def test_second_run_is_cached(self):
+        with mock.patch.object(jail_code, "jail_code", wraps=jail_code.jail_code) as jail:
+            for _ in range(2):
+                globs = {"n": 6}
+                safe_exec.safe_exec("n = n * 7", globs, cache=self.cache)
+                self.assertEqual(globs["n"], 42)
+        self.assertEqual(jail.call_count, 1)
+
+    def test_different_globals_arent_cached(self):
+        globs1, globs2 = {"n": 1}, {"n": 2}
+        safe_exec.safe_exec("n = n * 7", globs1, cache=self.cache)
+        safe_exec.safe_exec("n = n * 7", globs2, cache=self.cache)
+        self.assertEqual((globs1["n"], globs2["n"]), (7, 14))
+
+    def test_failures_arent_cached(self):
+        with mock.patch.object(jail_code, "jail_code", wraps=jail_code.jail_code) as jail:
+            for _ in range(2):
+                with self.assertRaises(safe_exec.SafeExecException):
+                    safe_exec.safe_exec("1/0", {}, cache=self.cache)
+        self.assertEqual(jail.call_count, 2)
@@ -1,5 +1,7 @@
 """Test safe_exec.py"""
 
+import asyncio
+import json
 import os.path
 import textwrap
 import zipfile
@@ -9,8 +11,8 @@ from unittest.mock import patch
 
 import pytest
 
-from codejail import safe_exec
-from codejail.jail_code import set_limit
+from codejail import instrumentation, safe_exec
+from codejail.jail_code import DEFAULT_LIMITS, LIMIT_OVERRIDES, override_limit, set_limit
 
 
 class TestJsonSafe(TestCase):
@@ -33,6 +35,53 @@ class TestJsonSafe(TestCase):
 
         self.assertDictEqual(cleaned_dict, {'a': 'b'})
 
+    def test_same_as_json_round_trip(self):
+        test_dict = {
+            'a': [1, 2.5, True, None, ('x', 'y')],
+            1.5: {None: 1, True: 2, 3: 3, 'k': 'v'},
+            None: [],
+            'nested': {'deeper': {'deepest': [{}]}},
+        }
+        cleaned_dict = safe_exec.json_safe(test_dict)
+
+        self.assertDictEqual(cleaned_dict, json.loads(json.dumps(test_dict)))
+
+    def test_unjsonable_values_are_dropped(self):
+        circular = []
+        circular.append(circular)
+        test_dict = {
+            'set': {1, 2},
+            'nested_object': [1, object()],
+            'tuple_key': {(1, 2): 3},
+            'circular': circular,
+            'surrogate': ['\ud800'],
+            'a': 'b',
+        }
+        cleaned_dict = safe_exec.json_safe(test_dict)
+
+        self.assertDictEqual(cleaned_dict, {'a': 'b'})
+
+    def test_strings_as_json_would_decode_them(self):
+        class OtherStr(str):
+            def __str__(self):
+                return 'other'
+
+        test_dict = {
+            'pair': '\ud83d\ude00',
+            'unpaired': 'a\ude00\ud83d',
+            'subclass': OtherStr('abc'),
+        }
+        cleaned_dict = safe_exec.json_safe(test_dict)
+
+        self.assertDictEqual(cleaned_dict, {'pair': '\U0001f600', 'subclass': 'abc'})
+        self.assertIs(type(cleaned_dict['subclass']), str)
+
+    def test_shared_values_are_kept(self):
+        shared = [1, 2]
+        cleaned_dict = safe_exec.json_safe({'a': [shared, shared]})
+
+        self.assertDictEqual(cleaned_dict, {'a': [[1, 2], [1, 2]]})
+
 
 class SafeExecTests(TestCase):
     """The tests for `safe_exec`, to be mixed into specific test classes."""
@@ -204,6 +253,98 @@ class TestSafeExec(SafeExecTests, TestCase):
             files=None, python_path=None, limit_overrides_context=None, slug=None, extra_files=None,
         )
 
+    def test_truncated_globals(self):
+        # The globals are more than the STDOUT limit, but the process can
+        # finish before it's killed.
+        set_limit("STDOUT", 20)
+        self.addCleanup(set_limit, "STDOUT", DEFAULT_LIMITS["STDOUT"])
+        with self.assertRaisesRegex(safe_exec.SafeExecException, "cut off at the STDOUT limit of 20 bytes"):
+            self.safe_exec("x = 'a' * 30", {})
+
+
+class TestProfile(TestCase):
+    """Tests of profiling the code run by `safe_exec`."""
+
+    SLOW_CODE = textwrap.dedent("""\
+        def slow_function(n):
+            return sum(i * i for i in range(n))
+        a = slow_function(200000)
+        """)
+
+    def setUp(self):
+        super().setUp()
+        self.infos = []
+        instrumentation.add_post_execution_hook(self.infos.append)
+        self.addCleanup(instrumentation.remove_execution_hook, self.infos.append)
+
+    def profiled_functions(self, profile):
+        """The names of the functions in `profile`."""
+        return [row["function"].rpartition("(")[2].rstrip(")") for row in profile]
+
+    def test_profile(self):
+        globs = {}
+        safe_exec.safe_exec(self.SLOW_CODE, globs, profile=True)
+        self.assertEqual(globs["a"], sum(i * i for i in range(200000)))
+        profile = self.infos[-1].profile
+        self.assertIn("slow_function", self.profiled_functions(profile))
+        self.assertEqual(
+            set(profile[0]),
+            {"function", "calls", "primitive_calls", "total_time", "cumulative_time"},
+        )
+        self.assertNotIn(b"codejail-profile", self.infos[-1].result.stderr)
+
+    def test_no_profile_by_default(self):
+        globs = {}
+        safe_exec.safe_exec(self.SLOW_CODE, globs)
+        self.assertIsNone(self.infos[-1].profile)
+
+    def test_profile_limit(self):
+        set_limit("PROFILE", False)
+        override_limit("PROFILE", True, "course-v1:profiled")
+        self.addCleanup(LIMIT_OVERRIDES.clear)
+        safe_exec.safe_exec(self.SLOW_CODE, {}, limit_overrides_context="course-v1:profiled")
+        self.assertIn("slow_function", self.profiled_functions(self.infos[-1].profile))
+
+    def test_profile_skips_the_cache(self):
+        cache = {}
+        safe_exec.safe_exec(self.SLOW_CODE, {}, cache=cache, profile=True)
+        self.assertEqual(cache, {})
+
+    def test_profile_of_failing_code(self):
+        with self.assertRaises(safe_exec.SafeExecException) as what_happened:
+            safe_exec.safe_exec(self.SLOW_CODE + "1/0\n", {}, profile=True)
+        self.assertIn("slow_function", self.profiled_functions(what_happened.exception.profile))
+        self.assertIn("ZeroDivisionError", str(what_happened.exception))
+        self.assertNotIn("codejail-profile", str(what_happened.exception))
+
+    def test_profile_at_cpu_limit(self):
+        set_limit("CPU", 1)
+        set_limit("REALTIME", 10)
+        self.addCleanup(set_limit, "REALTIME", DEFAULT_LIMITS["REALTIME"])
+        self.addCleanup(set_limit, "CPU", DEFAULT_LIMITS["CPU"])
+        code = textwrap.dedent("""\
+            def spin():
+                while True:
+                    pass
+            spin()
+            """)
+        with self.assertRaises(safe_exec.SafeExecException) as what_happened:
+            safe_exec.safe_exec(code, {}, profile=True)
+        self.assertIn("spin", self.profiled_functions(what_happened.exception.profile))
+
+    def test_async_profile(self):
+        asyncio.run(safe_exec.async_safe_exec(self.SLOW_CODE, {}, profile=True))
+        self.assertIn("slow_function", self.profiled_functions(self.infos[-1].profile))
+
+
+class TestAsyncSafeExec(SafeExecTests, TestCase):
+    """Run SafeExecTests, with async_safe_exec."""
+
+    __test__ = True
+
+    def safe_exec(self, *args, **kwargs):
+        asyncio.run(safe_exec.async_safe_exec(*args, **kwargs))
+
 
 class TestNotSafeExec(SafeExecTests, TestCase):
     """Run SafeExecTests, with not_safe_exec."""
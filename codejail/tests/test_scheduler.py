@@ -0,0 +1,144 @@
+"""Test scheduler.py"""
+
+import asyncio
+import threading
+import time
+from unittest import TestCase
+
+from codejail import jail_code
+from codejail.admission import Overloaded
+from codejail.scheduler import Scheduler
+
+from .test_jail_code import JailCodeHelpersMixin, jailpy
+
+
+class TestScheduler(TestCase):
+    """Tests of `Scheduler`."""
+
+    def run_queued(self, scheduler, executions):
+        """
+        Queue `executions` while the only slot is held, and return the order they run in.
+
+        `executions` is a list of (context, priority, weight) tuples, queued
+        in that order.
+
+        """
+        scheduler.acquire()
+        order = []
+        threads = []
+        for context, priority, weight in executions:
+            def run(context=context, priority=priority, weight=weight):
+                scheduler.acquire(context, priority, weight)
+                order.append(context)
+                scheduler.release()
+            thread = threading.Thread(target=run)
+            waiting = scheduler.waiting
+            thread.start()
+            threads.append(thread)
+            while scheduler.waiting == waiting:
+                time.sleep(0.001)
+        scheduler.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(scheduler.running, 0)
+        return order
+
+    def test_runs_at_once_when_free(self):
+        scheduler = Scheduler(2)
+        scheduler.acquire("a")
+        scheduler.acquire("b")
+        self.assertEqual(scheduler.running, 2)
+        self.assertEqual(scheduler.waits, 0)
+        scheduler.release()
+        scheduler.release()
+
+    def test_priority(self):
+        order = self.run_queued(Scheduler(1), [
+            ("bulk", -1, 1), ("bulk", -1, 1), ("interactive", 0, 1), ("urgent", 5, 1),
+        ])
+        self.assertEqual(order, ["urgent", "interactive", "bulk", "bulk"])
+
+    def test_fair_share(self):
+        order = self.run_queued(Scheduler(1), [("bulk", 0, 1)] * 4 + [("interactive", 0, 1)] * 2)
+        self.assertEqual(order, ["bulk", "interactive", "bulk", "interactive", "bulk", "bulk"])
+
+    def test_weights(self):
+        order = self.run_queued(Scheduler(1), [("heavy", 0, 1)] * 3 + [("light", 0, 2)] * 4)
+        self.assertEqual(order, ["heavy", "light", "light", "heavy", "light", "light", "heavy"])
+
+    def test_contexts_are_forgotten(self):
+        scheduler = Scheduler(1)
+        for i in range(100):
+            scheduler.acquire("context-%d" % i)
+            scheduler.release()
+            # The scheduler is idle, so it doesn't need to know the context.
+            self.assertEqual(scheduler._finish, {})  # pylint: disable=protected-access
+        self.assertEqual(scheduler._finish_heap, [])  # pylint: disable=protected-access
+
+        # While it's busy, it does.
+        order = self.run_queued(scheduler, [("bulk", 0, 1)] * 3 + [("interactive", 0, 1)])
+        self.assertEqual(order, ["bulk", "interactive", "bulk", "bulk"])
+        self.assertEqual(scheduler._finish, {})  # pylint: disable=protected-access
+
+    def test_weight_must_be_positive(self):
+        scheduler = Scheduler(1)
+        for weight in (0, -1):
+            with self.assertRaisesRegex(ValueError, "WEIGHT must be more than 0"):
+                scheduler.acquire("a", weight=weight)
+            with self.assertRaisesRegex(ValueError, "WEIGHT must be more than 0"):
+                asyncio.run(scheduler.async_acquire("a", weight=weight))
+        self.assertEqual(scheduler.running, 0)
+
+    def test_timeout(self):
+        scheduler = Scheduler(1, timeout=0.1)
+        scheduler.acquire()
+        with self.assertRaises(Overloaded):
+            scheduler.acquire()
+        self.assertEqual(scheduler.rejections, 1)
+        self.assertEqual(scheduler.waiting, 0)
+        scheduler.release()
+        # The slot wasn't lost.
+        scheduler.acquire()
+        scheduler.release()
+
+    def test_async_cancelled(self):
+        scheduler = Scheduler(1)
+
+        async def main():
+            scheduler.acquire()
+            task = asyncio.ensure_future(scheduler.async_acquire("a"))
+            await asyncio.sleep(0.01)
+            self.assertEqual(scheduler.waiting, 1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            scheduler.release()
+            await scheduler.async_acquire("b")
+            scheduler.release()
+
+        asyncio.run(main())
+        self.assertEqual(scheduler.running, 0)
+        self.assertEqual(scheduler.rejections, 0)
+
+
+class TestJailCodeWithScheduler(JailCodeHelpersMixin, TestCase):
+    """Tests of `jail_code` with a scheduler."""
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, jail_code, "SCHEDULER", jail_code.SCHEDULER)
+        jail_code.configure_scheduler(1, timeout=0.1)
+
+    def test_scheduled(self):
+        res = jailpy(code="print('hello')")
+        self.assertResultOk(res)
+        self.assertIn("admission", res.timings.phases)
+        self.assertEqual(jail_code.SCHEDULER.running, 0)
+
+    def test_overloaded(self):
+        jail_code.SCHEDULER.acquire()
+        try:
+            with self.assertRaises(Overloaded):
+                jailpy(code="print('hello')")
+        finally:
+            jail_code.SCHEDULER.release()
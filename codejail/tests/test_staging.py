@@ -0,0 +1,152 @@
+"""Test staging.py"""
+
+import os
+import os.path
+import shutil
+import stat
+import tempfile
+import textwrap
+from unittest import TestCase
+
+from codejail import jail_code
+from codejail.staging import StagingCache
+
+from .test_jail_code import JailCodeHelpersMixin, file_here, jailpy
+
+
+class TestStagingCache(TestCase):
+    """Tests of `StagingCache`."""
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp(prefix="codejail-test-")
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.cache = StagingCache(os.path.join(self.tmp, "cache"), max_size=1000)
+        self.source = os.path.join(self.tmp, "source")
+        os.mkdir(self.source)
+        self.write("hello.txt", "Hello")
+        self.write("lib/module.py", "x = 1\n")
+
+    def write(self, name, content):
+        """Write `content` to `name` in the source directory."""
+        path = os.path.join(self.source, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        return path
+
+    def dest(self, name):
+        """A fresh place to stage something."""
+        return tempfile.mkdtemp(dir=self.tmp) + "/" + name
+
+    def entries(self):
+        """The names of the entries in the cache."""
+        return sorted(name for name in os.listdir(self.cache.cache_dir) if not name.startswith("tmp-"))
+
+    def test_file_is_linked(self):
+        source = os.path.join(self.source, "hello.txt")
+        dest1, dest2 = self.dest("hello.txt"), self.dest("hello.txt")
+        self.cache.stage(source, dest1)
+        self.cache.stage(source, dest2)
+        with open(dest2, encoding="utf-8") as f:
+            self.assertEqual(f.read(), "Hello")
+        self.assertEqual(os.stat(dest1).st_ino, os.stat(dest2).st_ino)
+        self.assertNotEqual(os.stat(source).st_ino, os.stat(dest1).st_ino)
+        self.assertEqual(len(self.entries()), 1)
+
+    def test_files_are_read_only(self):
+        self.cache.stage(self.source, self.dest("source"))
+        for dirpath, _, filenames in os.walk(self.cache.cache_dir):
+            for filename in filenames:
+                mode = stat.S_IMODE(os.stat(os.path.join(dirpath, filename)).st_mode)
+                self.assertEqual(mode & 0o222, 0)
+
+    def test_directory_is_linked(self):
+        dest = self.dest("source")
+        self.cache.stage(self.source, dest)
+        self.assertEqual(sorted(os.listdir(dest)), ["hello.txt", "lib"])
+        with open(os.path.join(dest, "lib", "module.py"), encoding="utf-8") as f:
+            self.assertEqual(f.read(), "x = 1\n")
+        # The staged directory can be removed like any other.
+        shutil.rmtree(dest)
+
+    def test_changed_source_is_copied_again(self):
+        source = os.path.join(self.source, "hello.txt")
+        self.cache.stage(source, self.dest("hello.txt"))
+        self.write("hello.txt", "Goodbye")
+        dest = self.dest("hello.txt")
+        self.cache.stage(source, dest)
+        with open(dest, encoding="utf-8") as f:
+            self.assertEqual(f.read(), "Goodbye")
+        self.assertEqual(len(self.entries()), 2)
+
+    def test_least_recently_used_are_evicted(self):
+        sources = [self.write("file%d.txt" % i, "x" * 400) for i in range(3)]
+        names = ["%s-%d" % self.cache._signature(source) for source in sources]  # pylint: disable=protected-access
+        self.cache.stage(sources[0], self.dest("a"))
+        self.cache.stage(sources[1], self.dest("b"))
+        os.utime(os.path.join(self.cache.cache_dir, names[1]), (100, 100))
+        os.utime(os.path.join(self.cache.cache_dir, names[0]), (100, 100))
+        # Use the first one again, so the second is the least recently used.
+        self.cache.stage(sources[0], self.dest("c"))
+        self.cache.stage(sources[2], self.dest("d"))
+        self.assertEqual(self.entries(), sorted([names[0], names[2]]))
+
+    def test_evicted_entry_falls_back_to_copying(self):
+        source = os.path.join(self.source, "hello.txt")
+        self.cache.stage(source, self.dest("hello.txt"))
+        for name in self.entries():
+            os.remove(os.path.join(self.cache.cache_dir, name, "content"))
+        dest = self.dest("hello.txt")
+        self.cache.stage(source, dest)
+        with open(dest, encoding="utf-8") as f:
+            self.assertEqual(f.read(), "Hello")
+
+    def test_others_directory_isnt_used(self):
+        # Someone else could have put files in a directory others can write to.
+        cache_dir = os.path.join(self.tmp, "open")
+        os.mkdir(cache_dir)
+        os.chmod(cache_dir, 0o777)
+        cache = StagingCache(cache_dir, max_size=1000)
+        self.assertIsNone(cache.cache_dir)
+        dest = self.dest("hello.txt")
+        cache.stage(os.path.join(self.source, "hello.txt"), dest)
+        with open(dest, encoding="utf-8") as f:
+            self.assertEqual(f.read(), "Hello")
+        self.assertEqual(os.listdir(cache_dir), [])
+
+
+class TestJailCodeWithStagingCache(JailCodeHelpersMixin, TestCase):
+    """Tests of `jail_code` with a staging cache configured."""
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp(prefix="codejail-test-")
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        old_cache = jail_code.STAGING_CACHE
+        self.addCleanup(setattr, jail_code, "STAGING_CACHE", old_cache)
+        jail_code.configure_staging_cache(max_size=10 * 1024 * 1024, cache_dir=self.cache_dir)
+
+    def test_files_are_staged(self):
+        for _ in range(2):
+            res = jailpy(
+                code=textwrap.dedent("""\
+                    import os
+                    res = []
+                    for path, dirs, files in os.walk("."):
+                        res.append((path, sorted(dirs), sorted(files)))
+                    for row in sorted(res):
+                        print(row)
+                    print(open('hello.txt').read())
+                """),
+                files=[file_here("hello.txt"), file_here("pylib")],
+            )
+            self.assertResultOk(res)
+            self.assertEqual(res.stdout.decode('utf-8'), textwrap.dedent("""\
+                ('.', ['pylib', 'tmp'], ['hello.txt', 'jailed_code'])
+                ('./pylib', [], ['module.py'])
+                ('./tmp', [], [])
+                Hello there.
+
+                """))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
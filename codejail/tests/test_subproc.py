@@ -0,0 +1,196 @@
+"""Test subproc.py"""
+
+import asyncio
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from unittest import SkipTest, TestCase, mock
+
+from codejail import subproc
+from codejail.subproc import ProcessSupervisor, async_run_subprocess, prlimit_command, run_subprocess, wait_for_rusage
+
+
+class TestProcessSupervisor(TestCase):
+    """Tests of `ProcessSupervisor`."""
+
+    def setUp(self):
+        super().setUp()
+        self.supervisor = ProcessSupervisor()
+
+    def start_sleeper(self, seconds):
+        """Start a process that sleeps for `seconds`, in its own process group."""
+        proc = subprocess.Popen(["sleep", str(seconds)], start_new_session=True)
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.kill)
+        return proc
+
+    def test_kills_at_deadline(self):
+        proc = self.start_sleeper(10)
+        start = time.monotonic()
+        watch = self.supervisor.watch(proc, 0.5)
+        proc.wait()
+        elapsed = time.monotonic() - start
+        self.supervisor.unwatch(watch)
+        self.assertEqual(proc.returncode, -9)
+        self.assertGreaterEqual(elapsed, 0.5)
+        self.assertLess(elapsed, 0.7)
+
+    def test_doesnt_kill_finished_process(self):
+        proc = self.start_sleeper(0.1)
+        watch = self.supervisor.watch(proc, 0.3)
+        proc.wait()
+        time.sleep(0.4)
+        self.supervisor.unwatch(watch)
+        self.assertEqual(proc.returncode, 0)
+
+    @mock.patch("codejail.subproc._pidfd_open", return_value=None)
+    def test_doesnt_reap_ended_process(self, _):
+        # Without a pidfd, the supervisor checks the process at its deadline.
+        proc = self.start_sleeper(0.1)
+        watch = self.supervisor.watch(proc, 0.3)
+        time.sleep(0.5)
+        self.supervisor.unwatch(watch)
+        # The supervisor has seen that the process ended, but left it for us.
+        rusage = wait_for_rusage(proc)
+        self.assertEqual(proc.returncode, 0)
+        self.assertIsNotNone(rusage)
+        self.assertGreater(rusage["max_rss"], 0)
+
+    def test_doesnt_kill_after_unwatch(self):
+        proc = self.start_sleeper(0.6)
+        watch = self.supervisor.watch(proc, 0.2)
+        self.supervisor.unwatch(watch)
+        proc.wait()
+        self.assertEqual(proc.returncode, 0)
+
+    def test_kills_with_lock_held(self):
+        # Until the kill is sent, `unwatch` can't return, so the process
+        # can't be reaped and its pid reused.
+        # Other processes can be watched meanwhile.
+        locked = []
+        real_kill = subproc.kill_process_group
+
+        def kill_process_group(proc, reason):
+            locked.append((watch.lock.locked(), self.supervisor._lock.locked()))  # pylint: disable=protected-access
+            real_kill(proc, reason)
+
+        proc = self.start_sleeper(10)
+        with mock.patch("codejail.subproc.kill_process_group", kill_process_group):
+            watch = self.supervisor.watch(proc, 0.2)
+            proc.wait()
+        self.supervisor.unwatch(watch)
+        self.assertEqual(locked, [(True, False)])
+
+    def test_survives_failed_kill(self):
+        proc = self.start_sleeper(10)
+        with mock.patch("codejail.subproc.kill_process_group", side_effect=FileNotFoundError):
+            watch = self.supervisor.watch(proc, 0.1)
+            time.sleep(0.3)
+        self.supervisor.unwatch(watch)
+        self.assertIsNone(proc.poll())
+
+        # Later processes are still killed.
+        proc = self.start_sleeper(10)
+        watch = self.supervisor.watch(proc, 0.2)
+        proc.wait()
+        self.supervisor.unwatch(watch)
+        self.assertEqual(proc.returncode, -9)
+
+    def test_restarts_dead_thread(self):
+        proc = self.start_sleeper(10)
+        watch = self.supervisor.watch(proc, 10)
+        self.supervisor.unwatch(watch)
+        # Make it look as though the thread died.
+        dead = threading.Thread(target=lambda: None)
+        dead.start()
+        dead.join()
+        self.supervisor._thread = dead  # pylint: disable=protected-access
+
+        watch = self.supervisor.watch(proc, 0.2)
+        proc.wait()
+        self.supervisor.unwatch(watch)
+        self.assertEqual(proc.returncode, -9)
+
+    def test_unwatched_before_reaping(self):
+        still_there = []
+
+        def unwatch(watch):
+            # The first call is when the process has ended, but before it's reaped.
+            if not still_there:
+                still_there.append(os.waitid(os.P_PID, proc_pids[0], os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None)
+            real_unwatch(watch)
+
+        proc_pids = []
+        real_unwatch = subproc.SUPERVISOR.unwatch
+        with mock.patch.object(subproc.SUPERVISOR, "unwatch", unwatch):
+            status, _, _, _ = run_subprocess(
+                ["sleep", "0.1"], realtime=5, on_start=lambda proc: proc_pids.append(proc.pid),
+            )
+        self.assertEqual(status, 0)
+        self.assertEqual(still_there, [True])
+
+    def test_one_thread_for_many_processes(self):
+        procs = [self.start_sleeper(10) for _ in range(5)]
+        threads_before = threading.active_count()
+        watches = [self.supervisor.watch(proc, 0.2 + i * 0.1) for i, proc in enumerate(procs)]
+        self.assertLessEqual(threading.active_count(), threads_before + 1)
+        for proc, watch in zip(procs, watches):
+            proc.wait()
+            self.supervisor.unwatch(watch)
+            self.assertEqual(proc.returncode, -9)
+
+
+class TestPrlimit(TestCase):
+    """Tests of starting processes with `prlimit`."""
+
+    # Print the session, and the soft and hard CPU and file size limits.
+    SHOW_LIMITS = [sys.executable, "-c", (
+        "import os, resource; "
+        "print(os.getsid(0), *resource.getrlimit(resource.RLIMIT_CPU), *resource.getrlimit(resource.RLIMIT_FSIZE))"
+    )]
+
+    RLIMITS = [
+        (resource.RLIMIT_CPU, (3, 4)),
+        (resource.RLIMIT_FSIZE, (1024 * 1024, resource.RLIM_INFINITY)),
+    ]
+
+    def setUp(self):
+        super().setUp()
+        prlimit = shutil.which("prlimit")
+        if prlimit is None:
+            raise SkipTest("prlimit isn't installed")
+        self.addCleanup(setattr, subproc, "PRLIMIT", subproc.PRLIMIT)
+        subproc.PRLIMIT = prlimit
+
+    def assert_limited(self, status, stdout):
+        """Check the output of SHOW_LIMITS run with RLIMITS."""
+        self.assertEqual(status, 0)
+        sid, *limits = stdout.decode("utf-8").split()
+        # The process is in a session of its own.
+        self.assertNotEqual(int(sid), os.getsid(0))
+        self.assertEqual(limits, ["3", "4", "1048576", str(resource.RLIM_INFINITY)])
+
+    def test_prlimit_command(self):
+        self.assertEqual(prlimit_command("/usr/bin/prlimit", self.RLIMITS), [
+            "/usr/bin/prlimit", "--cpu=3:4", "--fsize=1048576:unlimited", "--",
+        ])
+        with self.assertRaisesRegex(ValueError, "prlimit can't set"):
+            prlimit_command("/usr/bin/prlimit", [(resource.RLIMIT_RSS, (1, 1))])
+
+    def test_run_subprocess(self):
+        with mock.patch("codejail.subproc.set_process_limits") as set_process_limits:
+            status, stdout, _, _ = run_subprocess(self.SHOW_LIMITS, rlimits=self.RLIMITS)
+        self.assert_limited(status, stdout)
+        set_process_limits.assert_not_called()
+
+    def test_async_run_subprocess(self):
+        status, stdout, _, _ = asyncio.run(async_run_subprocess(self.SHOW_LIMITS, rlimits=self.RLIMITS))
+        self.assert_limited(status, stdout)
+
+    def test_no_limits(self):
+        status, stdout, _, _ = run_subprocess(["/bin/echo", "hello"])
+        self.assertEqual((status, stdout), (0, b"hello\n"))
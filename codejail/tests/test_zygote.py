@@ -0,0 +1,198 @@
+"""Test running jailed code through a zygote."""
+
+import os
+import signal
+import textwrap
+from unittest import TestCase, mock
+
+from codejail import jail_code, zygote
+from codejail.jail_code import LIMITS, configure_zygote, set_limit
+
+from .test_jail_code import JailCodeHelpersMixin, cancel_async_jailpy, jailpy, text_of_logs
+
+
+class TestZygote(JailCodeHelpersMixin, TestCase):
+    """Test running Python through a zygote."""
+
+    def setUp(self):
+        super().setUp()
+        self.old_limits = dict(LIMITS)
+        configure_zygote("python", preload_modules=["colorsys"])
+
+    def tearDown(self):
+        del jail_code.PRELOAD_MODULES["python"]
+        for name, value in self.old_limits.items():
+            set_limit(name, value)
+        super().tearDown()
+
+    def running_zygote(self):
+        """Get the one zygote that should be running."""
+        zygotes = list(zygote.ZYGOTES.values())
+        self.assertEqual(len(zygotes), 1)
+        return zygotes[0]
+
+    def test_hello_world(self):
+        res = jailpy(code="""
+            print('Hello, world!')
+        """)
+        self.assertResultOk(res)
+        self.assertEqual(res.stdout, b'Hello, world!\n')
+
+    def test_rusage(self):
+        res = jailpy(code="""
+            data = bytearray(50 * 1024 * 1024)
+        """)
+        self.assertResultOk(res)
+        self.assertGreaterEqual(res.rusage["max_rss"], 50 * 1024 * 1024)
+        self.assertGreater(res.rusage["user_time"] + res.rusage["system_time"], 0)
+
+    def test_modules_are_preloaded(self):
+        res = jailpy(code="""
+            import sys
+            print('colorsys' in sys.modules, __name__)
+        """)
+        self.assertResultOk(res)
+        self.assertEqual(res.stdout, b'True __main__\n')
+
+    def test_each_run_is_a_new_process(self):
+        code = """
+            import os
+            print(os.getpid(), os.getpgid(0) == os.getpid())
+        """
+        res1 = jailpy(code=code)
+        zygote_pid = self.running_zygote().process.pid
+        res2 = jailpy(code=code)
+        self.assertResultOk(res1)
+        self.assertResultOk(res2)
+        self.assertTrue(res1.stdout.endswith(b' True\n'))
+        self.assertNotEqual(res1.stdout, res2.stdout)
+        self.assertEqual(self.running_zygote().process.pid, zygote_pid)
+
+    def test_each_run_has_its_own_random_numbers(self):
+        configure_zygote("python", preload_modules=["numpy.random"])
+        self.addCleanup(zygote.close_zygotes)
+        set_limit("REALTIME", 10)
+        code = """
+            import random
+            import numpy
+            print(random.random(), numpy.random.random())
+        """
+        res1 = jailpy(code=code)
+        res2 = jailpy(code=code)
+        self.assertResultOk(res1)
+        self.assertResultOk(res2)
+        random1, numpy1 = res1.stdout.split()
+        random2, numpy2 = res2.stdout.split()
+        self.assertNotEqual(random1, random2)
+        self.assertNotEqual(numpy1, numpy2)
+
+    def test_argv_and_stdin(self):
+        res = jailpy(
+            code="""
+                import sys
+                print(':'.join(sys.argv[1:]), sys.stdin.read())
+            """,
+            argv=["Hello", "world"],
+            stdin="from stdin",
+        )
+        self.assertResultOk(res)
+        self.assertEqual(res.stdout, b"Hello:world from stdin\n")
+
+    def test_ends_with_exception(self):
+        res = jailpy(code="""raise Exception('FAIL')""")
+        self.assertEqual(res.status, 1)
+        self.assertEqual(res.stdout, b"")
+        regex = textwrap.dedent("""
+            (?m)^Traceback [(]most recent call last[)]:
+              File "jailed_code", line 1, in <module>
+                raise Exception[(]'FAIL'[)]
+            Exception: FAIL
+            """).strip() + "\n"
+        self.assertRegex(res.stderr.decode('utf-8'), regex)
+
+    def test_exit_status(self):
+        res = jailpy(code="""
+            import sys
+            print("Leaving")
+            sys.exit(17)
+        """)
+        self.assertEqual(res.status, 17)
+        self.assertEqual(res.stdout, b"Leaving\n")
+
+    def test_cant_use_too_much_cpu(self):
+        set_limit('CPU', 1)
+        set_limit('REALTIME', 10)
+        res = jailpy(code="""
+            print(sum(range(2**31-1)))
+        """)
+        self.assertEqual(res.stdout, b"")
+        self.assertEqual(res.status, -signal.SIGXCPU)
+
+    def test_cant_use_too_much_time(self):
+        set_limit('CPU', 100)
+        set_limit('REALTIME', 1)
+        res = jailpy(code="""
+            import time
+            time.sleep(1.5)
+            print('Done!')
+        """)
+        self.assertEqual(res.stdout, b"")
+        self.assertEqual(res.status, -signal.SIGKILL)
+
+    @mock.patch("codejail.subproc.log._log")
+    def test_async_cancelling(self, log_log):
+        set_limit('CPU', 100)
+        set_limit('REALTIME', 10)
+        self.assertLess(cancel_async_jailpy("import time; time.sleep(5)"), 3)
+        log_text = text_of_logs(log_log.mock_calls)
+        self.assertRegex(log_text, r"WARNING: Killing process \d+ .*cancelled")
+
+    @mock.patch("codejail.jail_code.run_subprocess_through_proxy")
+    @mock.patch("codejail.jail_code.run_subprocess")
+    def test_cleaned_up_without_sudo(self, run_subprocess, run_subprocess_through_proxy):
+        set_limit('FSIZE', 1000)
+        # A directory made by the sandbox can only be emptied by the sandbox user.
+        res = jailpy(code="""
+            import os, tempfile
+            subdir = tempfile.mkdtemp()
+            with open(os.path.join(subdir, "scratch.txt"), "w") as f:
+                f.write("scratch")
+            print(os.getcwd())
+        """)
+        self.assertResultOk(res)
+        self.assertFalse(os.path.exists(res.stdout.decode("utf-8").strip()))
+        run_subprocess.assert_not_called()
+        run_subprocess_through_proxy.assert_not_called()
+
+    def test_clean_failure(self):
+        jailpy(code="print('hi')")
+        self.assertFalse(self.running_zygote().clean(["/no/such/codejail/dir"]))
+        # The zygote is still working.
+        self.assertResultOk(jailpy(code="print('hi')"))
+
+    def test_cant_write_too_much_output(self):
+        set_limit('CPU', 100)
+        set_limit('REALTIME', 10)
+        set_limit('STDOUT', 100000)
+        res = jailpy(code="""
+            while True:
+                print('x' * 999)
+        """)
+        self.assertEqual(res.status, -signal.SIGKILL)
+        self.assertEqual(res.stdout, (b'x' * 999 + b'\n') * 100)
+        self.assertTrue(res.stdout_truncated)
+
+    def test_zygote_is_restarted(self):
+        jailpy(code="print('first')")
+        old = self.running_zygote()
+        old.process.kill()
+        old.process.wait()
+        res = jailpy(code="print('second')")
+        self.assertResultOk(res)
+        self.assertEqual(res.stdout, b"second\n")
+        self.assertNotEqual(self.running_zygote().process.pid, old.process.pid)
+
+    def test_bad_preload_module(self):
+        configure_zygote("python", preload_modules=["no_such_module_here"])
+        with self.assertRaisesRegex(zygote.ZygoteError, "No module named 'no_such_module_here'"):
+            jailpy(code="print('hi')")
@@ -22,9 +22,27 @@ class ResetJailCodeStateMixin:
         self._COMMANDS = jail_code.COMMANDS
         self._LIMITS = jail_code.LIMITS
         self._LIMIT_OVERRIDES = jail_code.LIMIT_OVERRIDES
+        self._PRELOAD_MODULES = jail_code.PRELOAD_MODULES
+        self._STAGING_CACHE = jail_code.STAGING_CACHE
+        self._CLEANUP_REAPER = jail_code.CLEANUP_REAPER
+        self._HOMEDIR_POOL = jail_code.HOMEDIR_POOL
+        self._CGROUP_ROOT = jail_code.CGROUP_ROOT
+        self._ADMISSION = jail_code.ADMISSION
+        self._SCHEDULER = jail_code.SCHEDULER
+        self._QUOTAS = jail_code.QUOTAS
+        self._BACKEND = jail_code.BACKEND
         jail_code.COMMANDS = {}
         jail_code.LIMITS = jail_code.DEFAULT_LIMITS.copy()
         jail_code.LIMIT_OVERRIDES = {}
+        jail_code.PRELOAD_MODULES = {}
+        jail_code.STAGING_CACHE = None
+        jail_code.CLEANUP_REAPER = None
+        jail_code.HOMEDIR_POOL = None
+        jail_code.CGROUP_ROOT = None
+        jail_code.ADMISSION = None
+        jail_code.SCHEDULER = None
+        jail_code.QUOTAS = None
+        jail_code.BACKEND = None
 
     def tearDown(self):
         """
@@ -34,3 +52,12 @@ class ResetJailCodeStateMixin:
         jail_code.COMMANDS = self._COMMANDS
         jail_code.LIMITS = self._LIMITS
         jail_code.LIMIT_OVERRIDES = self._LIMIT_OVERRIDES
+        jail_code.PRELOAD_MODULES = self._PRELOAD_MODULES
+        jail_code.STAGING_CACHE = self._STAGING_CACHE
+        jail_code.CLEANUP_REAPER = self._CLEANUP_REAPER
+        jail_code.HOMEDIR_POOL = self._HOMEDIR_POOL
+        jail_code.CGROUP_ROOT = self._CGROUP_ROOT
+        jail_code.ADMISSION = self._ADMISSION
+        jail_code.SCHEDULER = self._SCHEDULER
+        jail_code.QUOTAS = self._QUOTAS
+        jail_code.BACKEND = self._BACKEND
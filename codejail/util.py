@@ -3,6 +3,7 @@
 import contextlib
 import os
 import shutil
+import stat
 import tempfile
 
 
@@ -20,6 +21,32 @@ def temp_directory():
         shutil.rmtree(temp_dir)
 
 
+def make_private_directory(path):
+    """
+    Make the directory `path`, usable only by this user, unless it exists.
+
+    The directory is often at a predictable path in the shared temp
+    directory, where another user could have made it first.  So raises
+    `PermissionError` unless `path` is a directory, not a symlink, owned by
+    this user, with mode 0o700.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    else:
+        # Whatever the umask took away.
+        os.chmod(path, 0o700)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+        raise PermissionError(
+            "%s must be a directory owned by user %d with mode 0o700, not %s owned by user %d"
+            % (path, os.getuid(), stat.filemode(st.st_mode), st.st_uid)
+        )
+
+
 @contextlib.contextmanager
 def change_directory(new_dir):
     """
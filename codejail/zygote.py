@@ -0,0 +1,340 @@
+"""
+A fork server ("zygote") for running jailed Python code.
+
+Starting a sandboxed Python interpreter, and importing the modules the jailed
+code needs, can take much longer than running the code itself.  A zygote is a
+long-lived process, started once with the sandboxed Python as the sandbox user,
+that imports a list of modules up front.  Each execution is then a fresh
+process forked from the zygote, with its own resource limits, home directory,
+and process group.  Because the zygote runs the sandboxed Python executable,
+it and every process forked from it are confined by the same AppArmor profile
+as ordinary executions.
+
+Because it runs as the sandbox user, a zygote also cleans up the temp
+directories of executions, without the `sudo` that would otherwise take.
+Processes that run too long are still killed with `sudo`, since a profile
+that let the zygote send signals would let every execution signal the
+others.
+
+The server side is in `zygote_server.py`, which is copied to a directory the
+sandbox can read, and run from there.
+
+"""
+
+import atexit
+import functools
+import json
+import logging
+import os
+import os.path
+import select
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+from .subproc import SUPERVISOR, communicate, rusage_details
+
+log = logging.getLogger("codejail")
+
+# How long to wait for a zygote to import its modules and say it's ready.
+START_TIMEOUT = 60
+
+# The running zygotes, keyed by their command lines.
+ZYGOTES = {}
+ZYGOTES_LOCK = threading.Lock()
+
+
+class ZygoteError(Exception):
+    """The zygote couldn't be started, or couldn't start a process."""
+
+
+class ZygoteProcess:
+    """
+    A process forked by a zygote.
+
+    This has the parts of the `subprocess.Popen` interface that CodeJail uses:
+    `pid`, `returncode`, `stdin`, `stdout`, `stderr`, `poll`, and `wait`.
+    Once it has ended, `rusage` is its resource usage, as the "rusage" details
+    of `run_subprocess`.  Call `close` when done with it.
+
+    """
+    # pylint: disable=too-many-positional-arguments
+    def __init__(self, zygote, stdin, stdout, stderr, status_fd):
+        self.zygote = zygote
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.pid = None
+        self.returncode = None
+        self.rusage = None
+        self._status_fd = status_fd
+        self._status_buffer = b""
+        self._status_eof = False
+        self._lock = threading.Lock()
+        os.set_blocking(status_fd, False)
+
+        # The first line is the pid of the new process, unless it couldn't be
+        # started at all.
+        while self.pid is None and self.returncode is None:
+            if not self._read_status(timeout=None):
+                self.close()
+                raise ZygoteError("Zygote failed to start a process")
+
+    def _read_status(self, timeout):
+        """
+        Read and handle status lines from the zygote.
+
+        Waits up to `timeout` seconds for a line, or forever if `timeout` is
+        None.  Returns False if the status pipe has closed.
+
+        """
+        if not self._status_eof:
+            select.select([self._status_fd], [], [], timeout)
+        with self._lock:
+            if self._status_eof:
+                return False
+            try:
+                data = os.read(self._status_fd, 1024)
+            except BlockingIOError:
+                return True
+            if not data:
+                self._status_eof = True
+                return False
+            self._status_buffer += data
+            *lines, self._status_buffer = self._status_buffer.split(b"\n")
+            for line in lines:
+                kind, value = line.split()
+                if kind == b"pid":
+                    self.pid = int(value)
+                elif kind == b"rusage":
+                    self.rusage = rusage_details(json.loads(value))
+                elif kind == b"exit":
+                    self.returncode = int(value)
+        return True
+
+    def poll(self):
+        """Return the exit status if the process has ended, else None."""
+        if self.returncode is None:
+            self._read_status(timeout=0)
+        return self.returncode
+
+    def wait(self):
+        """Wait for the process to end, and return its exit status."""
+        while self.returncode is None:
+            if not self._read_status(timeout=None) and self.returncode is None:
+                raise ZygoteError("Zygote lost track of process %s" % self.pid)
+        return self.returncode
+
+    def close(self):
+        """Close our connections to the process."""
+        for pipe in (self.stdin, self.stdout, self.stderr):
+            pipe.close()
+        os.close(self._status_fd)
+
+
+class Zygote:
+    """
+    A running zygote process, and our connection to it.
+    """
+    def __init__(self, cmd):
+        """
+        Start a zygote.
+
+        `cmd` is the command line to run the zygote server with the sandboxed
+        Python, as the sandbox user: see `get_zygote`.
+
+        """
+        self.server_dir = tempfile.mkdtemp(prefix="codejail-zygote-")
+        os.chmod(self.server_dir, 0o755)
+        server_py = os.path.join(self.server_dir, "zygote_server.py")
+        shutil.copy(os.path.join(os.path.dirname(__file__), "zygote_server.py"), server_py)
+        os.chmod(server_py, 0o644)
+
+        self.control, server_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.lock = threading.Lock()
+        try:
+            self.process = subprocess.Popen(
+                cmd, cwd=self.server_dir, env={},
+                stdin=server_control, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        finally:
+            server_control.close()
+
+        self.control.settimeout(START_TIMEOUT)
+        try:
+            hello = self.control.recv(65536)
+        except OSError:
+            hello = b""
+        self.control.settimeout(None)
+        if not hello:
+            self.close()
+            raise ZygoteError("Zygote died while starting")
+        hello = json.loads(hello.decode("utf-8"))
+        if not hello["ready"]:
+            self.close()
+            raise ZygoteError("Zygote couldn't start: %s" % hello["error"])
+        log.info("Started CodeJail zygote process (pid %d)", self.process.pid)
+
+    def is_alive(self):
+        """Is the zygote process still running?"""
+        return self.process.poll() is None
+
+    def spawn(self, argv, cwd, rlimits):
+        """
+        Start a process from the zygote.
+
+        `argv` is the program to run and its arguments, relative to `cwd`.
+        `rlimits` is a list of arguments to `resource.setrlimit`.
+
+        Returns a `ZygoteProcess`.
+
+        """
+        request = json.dumps({
+            "argv": argv,
+            "cwd": cwd,
+            "rlimits": rlimits,
+        }).encode("utf-8")
+
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+        status_r, status_w = os.pipe()
+        try:
+            with self.lock:
+                socket.send_fds(self.control, [request], [stdin_r, stdout_w, stderr_w, status_w])
+        except OSError:
+            for fd in (stdin_w, stdout_r, stderr_r, status_r):
+                os.close(fd)
+            raise
+        finally:
+            for fd in (stdin_r, stdout_w, stderr_w, status_w):
+                os.close(fd)
+
+        return ZygoteProcess(
+            zygote=self,
+            stdin=open(stdin_w, "wb", buffering=0),
+            stdout=open(stdout_r, "rb", buffering=0),
+            stderr=open(stderr_r, "rb", buffering=0),
+            status_fd=status_r,
+        )
+
+    def clean(self, dirs):
+        """
+        Remove everything in the directories `dirs`, as the sandbox user.
+
+        Returns True if everything was removed.
+
+        """
+        request = json.dumps({"op": "clean", "dirs": list(dirs)}).encode("utf-8")
+        status_r, status_w = os.pipe()
+        try:
+            with self.lock:
+                socket.send_fds(self.control, [request], [status_w])
+        finally:
+            os.close(status_w)
+        with open(status_r, "rb") as status:
+            return status.read() == b"exit 0\n"
+
+    def close(self):
+        """Stop the zygote, and clean up after it."""
+        self.control.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            log.warning("CodeJail zygote process (pid %d) didn't exit", self.process.pid)
+        shutil.rmtree(self.server_dir, ignore_errors=True)
+
+
+def get_zygote(cmd, preload_modules):
+    """
+    Get a running zygote, starting it if needed.
+
+    `cmd` is the command line to run the sandboxed Python, as the sandbox
+    user.  `preload_modules` is the list of modules to import in the zygote.
+
+    """
+    key = tuple(cmd) + tuple(preload_modules)
+    with ZYGOTES_LOCK:
+        zygote = ZYGOTES.get(key)
+        if zygote is not None and not zygote.is_alive():
+            log.info(
+                "CodeJail zygote process (pid %d) ended with status code %d",
+                zygote.process.pid,
+                zygote.process.returncode,
+            )
+            zygote.close()
+            zygote = None
+        if zygote is None:
+            zygote = ZYGOTES[key] = Zygote(list(cmd) + ["zygote_server.py"] + list(preload_modules))
+    return zygote
+
+
+@atexit.register
+def close_zygotes():
+    """Stop all the running zygotes."""
+    with ZYGOTES_LOCK:
+        for zygote in ZYGOTES.values():
+            zygote.close()
+        ZYGOTES.clear()
+
+
+@functools.lru_cache(maxsize=None)
+def zygote_cleaner(cmd, preload_modules):
+    """
+    Get a function to clean up temp directories with a zygote.
+
+    `cmd` and `preload_modules` are tuples, as for `get_zygote`.  The function
+    takes a list of directories, removes everything in them, and returns True
+    if it succeeded.  The same function is returned for the same zygote, so
+    the cleanup of several executions can be done together.
+
+    """
+    def clean(dirs):
+        try:
+            return get_zygote(cmd, preload_modules).clean(dirs)
+        except (OSError, ZygoteError):
+            log.exception("CodeJail zygote couldn't clean up")
+            return False
+    return clean
+
+
+# pylint: disable=too-many-positional-arguments
+def run_subprocess_through_zygote(
+        cmd, argv, preload_modules, stdin=None, cwd=None, rlimits=None,
+        realtime=None, slug=None, stdout_limit=None, stderr_limit=None, on_start=None,
+):
+    """
+    Works like :ref:`run_subprocess`, but forks the process from a zygote.
+
+    `cmd` is the command line to run the sandboxed Python, up to but not
+    including the program name.  `argv` is the program to run and its
+    arguments.  `preload_modules` is the list of modules the zygote imports.
+
+    """
+    start = time.monotonic()
+    try:
+        proc = get_zygote(cmd, preload_modules).spawn(argv, cwd, rlimits or [])
+    except OSError:
+        # The zygote died since we checked it.  Try once more with a new one.
+        log.exception("CodeJail zygote failed")
+        proc = get_zygote(cmd, preload_modules).spawn(argv, cwd, rlimits or [])
+    started = time.monotonic()
+
+    if slug:
+        log.info("Executed jailed code %s in %s, with PID %s", slug, cwd, proc.pid)
+    if on_start is not None:
+        on_start(proc)
+
+    watch = SUPERVISOR.watch(proc, realtime) if realtime else None
+    try:
+        stdout, stderr, details = communicate(proc, stdin, stdout_limit, stderr_limit)
+    finally:
+        if watch:
+            SUPERVISOR.unwatch(watch)
+        proc.close()
+    details["timings"] = {"spawn": (start, started), "run": (started, time.monotonic())}
+    return proc.returncode, stdout, stderr, details
@@ -0,0 +1,207 @@
+"""
+The fork server ("zygote") program for CodeJail.
+
+This file is not imported by CodeJail.  It is copied into a directory the
+sandbox can read and run with the sandboxed Python, as the sandbox user, so
+that it is confined by the same AppArmor profile as ordinary executions.  It
+must only use the standard library, since the sandbox may not have CodeJail
+installed.
+
+Usage::
+
+    python -E -B zygote_server.py [module ...]
+
+The modules named on the command line are imported once, up front.  Then the
+server reads requests from its stdin, which must be a SOCK_SEQPACKET Unix
+socket.  Each request is one message: a JSON header, and four file descriptors
+for the new process: its stdin, stdout, and stderr, and a status pipe.
+
+For each request, the server forks a waiter process, which forks the process
+that runs the code.  That process writes ``pid <pid>`` to the status pipe once
+it is in its own session, and the waiter writes ``exit <returncode>`` when it
+has ended.
+
+Since the server runs as the sandbox user, it also does what would otherwise
+take ``sudo``, when the header has an ``"op"``:
+
+* ``"clean"``: remove everything in the directories ``"dirs"``, with one file
+  descriptor, a status pipe.  A forked process does the work, and writes
+  ``exit 0`` to the status pipe if it succeeded.
+
+"""
+
+import builtins
+import json
+import os
+import resource
+import shutil
+import signal
+import socket
+import sys
+import traceback
+import types
+
+# The largest request header we accept.
+MAX_REQUEST = 1024 * 1024
+
+
+def reseed_random():
+    """
+    Give this (forked) process random numbers of its own.
+
+    `random` reseeds itself in a forked child, but the global generator of a
+    preloaded `numpy.random` doesn't, so every child would get the same
+    numbers.
+    """
+    numpy_random = sys.modules.get("numpy.random")
+    if numpy_random is not None:
+        numpy_random.seed()
+
+
+def run_child(request, stdin_fd, stdout_fd, stderr_fd, status_fd):
+    """
+    Run the requested program in this (forked) process.  Never returns.
+    """
+    os.setsid()
+    os.dup2(stdin_fd, 0)
+    os.dup2(stdout_fd, 1)
+    os.dup2(stderr_fd, 2)
+    os.write(status_fd, b"pid %d\n" % os.getpid())
+    # Nothing but stdin, stdout, and stderr are available to the program,
+    # in particular not the control socket or the status pipe.
+    os.closerange(3, resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+
+    sys.stdin = sys.__stdin__ = open(0, "r", encoding="utf-8", closefd=False)
+    sys.stdout = sys.__stdout__ = open(1, "w", encoding="utf-8", closefd=False)
+    sys.stderr = sys.__stderr__ = open(
+        2, "w", encoding="utf-8", errors="backslashreplace", closefd=False,
+    )
+
+    try:
+        reseed_random()
+        for limit, value in request["rlimits"]:
+            resource.setrlimit(limit, tuple(value))
+        os.chdir(request["cwd"])
+    except Exception:  # pylint: disable=broad-except
+        traceback.print_exc()
+        sys.stderr.flush()
+        os._exit(1)  # pylint: disable=protected-access
+
+    # The temp directory is relative to the current directory, which has
+    # changed since a preloaded module might have used it.
+    if "tempfile" in sys.modules:
+        sys.modules["tempfile"].tempdir = None
+
+    argv = request["argv"]
+    sys.argv = argv
+    sys.path[0] = os.path.dirname(os.path.abspath(argv[0]))
+
+    main_module = types.ModuleType("__main__")
+    main_module.__file__ = argv[0]
+    main_module.__builtins__ = builtins
+    sys.modules["__main__"] = main_module
+
+    try:
+        with open(argv[0], "rb") as source:
+            code = compile(source.read(), argv[0], "exec")
+        exec(code, main_module.__dict__)  # pylint: disable=exec-used
+    except SystemExit:
+        raise
+    except BaseException:  # pylint: disable=broad-except
+        # Report the exception as the interpreter would, without our frame.
+        exc_type, exc_value, exc_tb = sys.exc_info()
+        exc_value.__traceback__ = exc_tb.tb_next
+        sys.excepthook(exc_type, exc_value, exc_tb.tb_next)
+        sys.exit(1)
+    # Exiting with SystemExit lets the interpreter shut down normally: flush
+    # the output, join threads, and run atexit functions.
+    sys.exit(0)
+
+
+def run_waiter(request, fds):
+    """
+    Fork the process for `request`, and report its exit status.  Never returns.
+    """
+    stdin_fd, stdout_fd, stderr_fd, status_fd = fds
+    # The server ignores SIGCHLD so that waiters are reaped automatically, but
+    # we need to wait for our child, and the child needs normal behavior.
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    pid = os.fork()
+    if pid == 0:
+        run_child(request, stdin_fd, stdout_fd, stderr_fd, status_fd)
+
+    for fd in (stdin_fd, stdout_fd, stderr_fd):
+        os.close(fd)
+    _, status, usage = os.wait4(pid, 0)
+    usage = [usage.ru_utime, usage.ru_stime, usage.ru_maxrss, usage.ru_nvcsw, usage.ru_nivcsw]
+    os.write(status_fd, b"rusage %s\n" % json.dumps(usage, separators=(",", ":")).encode("utf-8"))
+    os.write(status_fd, b"exit %d\n" % os.waitstatus_to_exitcode(status))
+    os._exit(0)  # pylint: disable=protected-access
+
+
+def run_cleaner(request, status_fd):
+    """
+    Remove everything in the directories in `request`.  Never returns.
+    """
+    status = 0
+    try:
+        for directory in request["dirs"]:
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+    except Exception:  # pylint: disable=broad-except
+        status = 1
+    os.write(status_fd, b"exit %d\n" % status)
+    os._exit(0)  # pylint: disable=protected-access
+
+
+def main(argv):
+    """
+    The main program for the fork server.
+    """
+    control = socket.socket(fileno=0)
+
+    try:
+        for module in argv[1:]:
+            __import__(module)
+    except Exception:  # pylint: disable=broad-except
+        control.send(json.dumps({"ready": False, "error": traceback.format_exc()}).encode("utf-8"))
+        return 1
+    control.send(json.dumps({"ready": True, "pid": os.getpid()}).encode("utf-8"))
+
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    while True:
+        msg, fds, _, _ = socket.recv_fds(control, MAX_REQUEST, 4)
+        if not msg:
+            # The parent closed the socket: we're done.
+            return 0
+        pid = None
+        op = None
+        try:
+            request = json.loads(msg.decode("utf-8"))
+            op = request.get("op", "spawn")
+            expected_fds = {"spawn": 4, "clean": 1}[op]
+            if len(fds) != expected_fds:
+                raise ValueError("Expected %d file descriptors, got %d" % (expected_fds, len(fds)))
+            pid = os.fork()
+        except Exception:  # pylint: disable=broad-except
+            # A bad request shouldn't end the server.  The requester will see
+            # its status pipe close without a pid.
+            pass
+        if pid == 0:
+            # The program's SystemExit will unwind through here, so this must
+            # not be inside a try block.
+            control.close()
+            if op == "clean":
+                run_cleaner(request, fds[0])
+            run_waiter(request, fds)
+        for fd in fds:
+            os.close(fd)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))